@@ -0,0 +1,86 @@
+"""synthetic docker-make projects: a configuration of N builds shaped as a
+deep chain, a wide fan-out or layers of a DAG, and their contexts.
+"""
+import os
+
+import yaml
+
+
+def _deps_wide(i, n):
+    return ['b0'] if i else []
+
+
+def _deps_deep(i, n):
+    return ['b%d' % (i - 1)] if i else []
+
+
+def _deps_layered(i, n, width=20):
+    # every build of a layer depends on two builds of the previous one
+    layer = i // width
+    if not layer:
+        return []
+    previous = (layer - 1) * width
+    return sorted(set(['b%d' % (previous + i % width),
+                       'b%d' % (previous + (i + 1) % width)]))
+
+
+SHAPES = {
+    'wide': _deps_wide,
+    'deep': _deps_deep,
+    'layered': _deps_layered,
+}
+
+
+def _write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_project(root, builds, shape='wide', contexts=20, tag_names=(),
+                 extract=None):
+    """write a project of `builds` builds under `root`, sharing `contexts`
+    contexts, and return the path of its configuration file.
+    """
+    deps = SHAPES[shape]
+    for c in range(contexts):
+        _write(os.path.join(root, 'ctx%d' % c, 'Dockerfile'),
+               'FROM busybox\nCOPY . /app\nRUN make\n')
+        _write(os.path.join(root, 'ctx%d' % c, 'src', 'main.py'),
+               'print %d\n' % c)
+
+    config = {'tag-names': list(tag_names), 'builds': {}}
+    for i in range(builds):
+        build = {
+            'context': '/ctx%d' % (i % contexts),
+            'dockerfile': 'Dockerfile',
+            'labels': ['com.example.commit={fcommitid}',
+                       'com.example.build=b%d' % i],
+            'pushes': ['always=registry%d.example.com/b%d:{fcommitid}' %
+                       (i % 2, i),
+                       'on_branch:master=registry0.example.com/b%d:latest' %
+                       i],
+        }
+        if extract:
+            build['extract'] = list(extract)
+        depends_on = deps(i, builds)
+        if depends_on:
+            build['depends_on'] = depends_on
+        config['builds']['b%d' % i] = build
+
+    filename = os.path.join(root, '.docker-make.yml')
+    with open(filename, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return filename
+
+
+def make_large_context(root, files=2000, size=16 << 10):
+    """a context of `files` files of `size` bytes in nested directories"""
+    chunk = os.urandom(1024)
+    content = chunk * (size // 1024) + chunk[:size % 1024]
+    _write(os.path.join(root, 'Dockerfile'), 'FROM busybox\nCOPY . /app\n')
+    for i in range(files):
+        _write(os.path.join(root, 'd%d' % (i % 50), 'd%d' % (i % 7),
+                            'f%d.bin' % i), content)
+    return root
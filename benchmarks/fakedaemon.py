@@ -0,0 +1,280 @@
+"""a stand-in for the docker daemon, serving the part of the engine API used
+by docker-make on a unix socket, with configurable latency and sizes.
+
+build and push responses are streamed with chunked encoding like dockerd
+does, so that the client side of docker-make does its usual work.
+"""
+import io
+import os
+import re
+import json
+import time
+import base64
+import sys
+import shutil
+import socket
+import hashlib
+import tarfile
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+
+API_VERSION = '1.30'
+
+
+class Profile(object):
+    """what the fake daemon sends back, and how slowly."""
+
+    def __init__(self, steps=5, lines_per_step=20, step_latency=0.0,
+                 layers=3, layer_size=10 << 20, push_latency=0.0,
+                 archive_size=1 << 20, cached_steps=0):
+        self.steps = steps
+        self.lines_per_step = lines_per_step
+        self.step_latency = step_latency
+        self.layers = layers
+        self.layer_size = layer_size
+        self.push_latency = push_latency
+        self.archive_size = archive_size
+        self.cached_steps = cached_steps
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.context_bytes = 0
+
+    def count(self, name, context_bytes=0):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.context_bytes += context_bytes
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'^(/v[\d.]+)?/(version|_ping)$', 'version'),
+        ('POST', r'^/v[\d.]+/build$', 'build'),
+        ('GET', r'^/v[\d.]+/images/(.+)/json$', 'inspect_image'),
+        ('POST', r'^/v[\d.]+/images/(.+)/tag$', 'tag'),
+        ('POST', r'^/v[\d.]+/images/(.+)/push$', 'push'),
+        ('POST', r'^/v[\d.]+/containers/create$', 'create_container'),
+        ('GET', r'^/v[\d.]+/containers/([^/]+)/archive$', 'get_archive'),
+        ('DELETE', r'^/v[\d.]+/containers/([^/]+)$', 'remove_container'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def _dispatch(self):
+        url = urlparse.urlparse(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        for method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if method == self.command and match:
+                self.server.stats.count(name)
+                arg = match.group(match.lastindex) if match.lastindex else None
+                return getattr(self, 'do_' + name)(arg)
+        self._reply(404, {'message': 'no such route: %s' % url.path})
+
+    do_GET = do_POST = do_DELETE = _dispatch
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            size = 0
+            while True:
+                n = int(self.rfile.readline().strip(), 16)
+                if not n:
+                    self.rfile.readline()
+                    return size
+                while n:
+                    data = self.rfile.read(min(n, 1 << 16))
+                    n -= len(data)
+                    size += len(data)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1 << 16)))
+        return length
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, messages, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for message in messages:
+            if not isinstance(message, str):
+                message = json.dumps(message) + '\r\n'
+            self.wfile.write('%x\r\n%s\r\n' % (len(message), message))
+            self.wfile.flush()
+        self.wfile.write('0\r\n\r\n')
+
+    def do_version(self, _):
+        self._reply(200, {'ApiVersion': API_VERSION, 'Version': '17.06.0'})
+
+    def do_build(self, _):
+        self.server.stats.count('context', self._body())
+        profile = self.server.profile
+        image_id = 'sha256:' + hashlib.sha256(os.urandom(8)).hexdigest()
+
+        def messages():
+            for step in range(1, profile.steps + 1):
+                yield {'stream': 'Step %d/%d : RUN make step%d' %
+                       (step, profile.steps, step)}
+                yield {'stream': '\n'}
+                if step <= profile.cached_steps:
+                    yield {'stream': ' ---> Using cache\n'}
+                else:
+                    if profile.step_latency:
+                        time.sleep(profile.step_latency)
+                    for i in range(profile.lines_per_step):
+                        yield {'stream': 'npm http fetch GET 200 '
+                               'https://registry.example.com/pkg%d 12ms\n'
+                               % i}
+                yield {'stream': ' ---> %s\n' % image_id[7:19]}
+            yield {'aux': {'ID': image_id}}
+            yield {'stream': 'Successfully built %s\n' % image_id[7:19]}
+        self._stream(messages())
+
+    def do_inspect_image(self, name):
+        digest = hashlib.sha256(name).hexdigest()
+        self._reply(200, {'Id': 'sha256:' + digest,
+                          'Config': {'Labels': {}}, 'RepoDigests': []})
+
+    def do_tag(self, _):
+        self._reply(201)
+
+    def do_push(self, name):
+        profile = self.server.profile
+        tag = self.query.get('tag', 'latest')
+
+        def messages():
+            yield {'status': 'The push refers to a repository [%s]' % name}
+            layers = ['%012x' % i for i in range(profile.layers)]
+            for layer in layers:
+                yield {'status': 'Preparing', 'id': layer,
+                       'progressDetail': {}}
+            for layer in layers:
+                for current in range(0, profile.layer_size, 1 << 20):
+                    yield {'status': 'Pushing', 'id': layer,
+                           'progressDetail': {'current': current,
+                                              'total': profile.layer_size}}
+                if profile.push_latency:
+                    time.sleep(profile.push_latency)
+                yield {'status': 'Pushed', 'id': layer, 'progressDetail': {}}
+            digest = 'sha256:' + hashlib.sha256(name + tag).hexdigest()
+            yield {'status': '%s: digest: %s size: 1234' % (tag, digest)}
+            yield {'progressDetail': {},
+                   'aux': {'Tag': tag, 'Digest': digest, 'Size': 1234}}
+        self._stream(messages())
+
+    def do_create_container(self, _):
+        self._body()
+        self._reply(201, {'Id': 'c%d' % id(self), 'Warnings': None})
+
+    def do_get_archive(self, _):
+        path = self.query.get('path', '/')
+        stat = base64.b64encode(json.dumps({'name': os.path.basename(path),
+                                            'size': 0, 'mode': 0o755}))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.send_header('X-Docker-Container-Path-Stat', stat)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in self.server.archive():
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write('0\r\n\r\n')
+
+    def do_remove_container(self, _):
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    # parallel builds and pushes connect at once
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('unix', 0)
+
+    def handle_error(self, request, client_address):
+        # clients hanging up early are not worth a traceback
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.UnixStreamServer.handle_error(self, request,
+                                                       client_address)
+
+    def archive(self):
+        with self.lock:
+            if self._archive is None:
+                buf = io.BytesIO()
+                archive = tarfile.open(fileobj=buf, mode='w')
+                size = self.profile.archive_size
+                info = tarfile.TarInfo('bin/app')
+                info.size = size
+                archive.addfile(info, io.BytesIO(os.urandom(1024) *
+                                                 (size // 1024 + 1)))
+                archive.close()
+                self._archive = buf.getvalue()
+        data = self._archive
+        for i in range(0, len(data), 1 << 16):
+            yield data[i:i + (1 << 16)]
+
+
+class FakeDaemon(object):
+    """serve on a temporary unix socket until `stop`.
+
+    with FakeDaemon(Profile(steps=10)) as daemon:
+        os.environ['DOCKER_HOST'] = daemon.url
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile or Profile()
+        self.stats = Stats()
+        self._dir = tempfile.mkdtemp(prefix='dmake-fakedaemon.')
+        self.path = os.path.join(self._dir, 'docker.sock')
+        self.url = 'unix://' + self.path
+        self._server = None
+
+    def start(self):
+        self._server = _Server(self.path, _Handler)
+        self._server.profile = self.profile
+        self._server.stats = self.stats
+        self._server.lock = threading.Lock()
+        self._server._archive = None
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
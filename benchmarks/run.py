@@ -0,0 +1,272 @@
+"""benchmarks of docker-make's own overhead, run offline against a fake
+docker daemon.
+
+    python benchmarks/run.py [--quick] [--save FILE] [--compare FILE] [NAME]
+
+each benchmark is run several times and its best and median times are
+reported, `--compare benchmarks/baseline.json` shows the ratio to a stored
+run, and `--save` stores one.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from configs import make_project, make_large_context  # noqa
+from fakedaemon import FakeDaemon, Profile  # noqa
+from dmake import build as dmake_build  # noqa
+from dmake import config as dmake_config  # noqa
+from dmake import context  # noqa
+from dmake import template_args  # noqa
+from dmake import utils  # noqa
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, repeat=5, quick=True):
+    """register `func(workdir)`, which prepares what to measure in workdir
+    and returns a callable to time, and optionally a dict of facts about
+    it: `bytes` processed and a `cleanup` function.
+    """
+    def decorator(func):
+        BENCHMARKS.append((name, func, repeat, quick))
+        return func
+    return decorator
+
+
+def _git_init(root):
+    for args in (('init', '-q'), ('add', '.'),
+                 ('-c', 'user.name=bench',
+                  '-c', 'user.email=bench@example.com',
+                  'commit', '-qm', 'bench')):
+        subprocess.check_call(('git',) + args, cwd=root)
+
+
+def _config_load(builds, shape, use_cache=False):
+    def setup(workdir):
+        filename = make_project(workdir, builds, shape)
+        cache_dir = os.path.join(workdir, 'cache')
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        if use_cache:
+            dmake_config.load(filename, use_cache=True)
+        return lambda: dmake_config.load(filename, use_cache=use_cache)
+    return setup
+
+
+for _n in (10, 100, 1000, 5000):
+    benchmark('config_load[wide,%d]' % _n, quick=_n <= 1000)(
+        _config_load(_n, 'wide'))
+benchmark('config_load_cached[wide,5000]', quick=False)(
+    _config_load(5000, 'wide', use_cache=True))
+
+
+def _plan(builds, shape):
+    def setup(workdir):
+        config = dmake_config.load(make_project(workdir, builds, shape))
+        last = config.order[-1]
+
+        def plan():
+            config.graph.topological_order()
+            utils.expand_wants(config.graph, [last])
+            config.graph.descendants(['b0'])
+        return plan
+    return setup
+
+
+for _shape in ('deep', 'wide', 'layered'):
+    benchmark('plan[%s,5000]' % _shape)(_plan(5000, _shape))
+
+
+@benchmark('template_args[5 cmds,1 used]', repeat=3)
+def _template_args(workdir):
+    tag_names = [{'name': 'slow%d' % i, 'type': 'cmd',
+                  'value': 'sleep 0.2; echo v%d' % i} for i in range(5)]
+    filename = make_project(workdir, 10, tag_names=tag_names)
+    config = dmake_config.load(filename)
+    build = config.builds['b0']
+    build.pushes.append(dmake_config.PushRule.parse(
+        'always=registry.example.com/b0:{slow0}'))
+    _git_init(workdir)
+    os.chdir(workdir)
+
+    def init():
+        template_args._tag_template_args = None
+        template_args._label_template_args = None
+        template_args._git_metadata = template_args.GitMetadata()
+        template_args.init_tag_names(config)
+    return init
+
+
+def _build_stream(messages):
+    for i in range(messages):
+        if i % 100 == 0:
+            yield ('{"stream":"Step %d/%d : RUN npm install"}\r\n' %
+                   (i // 100 + 1, messages // 100))
+        yield ('{"stream":"npm http fetch GET 200 '
+               'https://registry.example.com/pkg%d 12ms\\n"}\r\n' % i)
+    yield '{"aux":{"ID":"sha256:%s"}}\r\n' % ('f' * 64)
+
+
+@benchmark('stream_parse[50000 lines]')
+def _stream_parse(workdir):
+    chunks = list(_build_stream(50000))
+
+    def parse():
+        output = dmake_build.BuildOutput('bench')
+        for chunk in chunks:
+            output.feed(chunk)
+        output.close()
+        assert output.image_id
+    return parse, {'bytes': sum(len(c) for c in chunks)}
+
+
+@benchmark('context_stream[2000x16KB]', repeat=3)
+def _context_stream(workdir):
+    root = make_large_context(os.path.join(workdir, 'ctx'))
+    index = os.path.join(workdir, 'index')
+
+    def stream():
+        # a fresh scanner with a persisted index, as in a second run
+        context.ContextScanner = context._ContextScanner(index)
+        scan = context.ContextScanner.scan(root, [], 'Dockerfile')
+        size = sum(len(chunk) for chunk in context.stream_context(scan))
+        context.ContextScanner.save()
+        assert size > scan.total_bytes
+    return stream, {'bytes': 2000 * (16 << 10)}
+
+
+@benchmark('extract[64MB,unpack]', repeat=3)
+def _extract(workdir):
+    daemon = FakeDaemon(Profile(archive_size=64 << 20)).start()
+    os.environ['DOCKER_HOST'] = daemon.url
+    utils.DockerClients.reset()
+    os.chdir(workdir)
+    template_args._label_template_args = {}
+    build = dmake_build.Build('bench', '/', 'Dockerfile',
+                              extract=['/usr/bin:./out/'])
+
+    def extract():
+        shutil.rmtree(os.path.join(workdir, 'out'), ignore_errors=True)
+        build._extract_contents('img', build.extract)
+    return extract, {'bytes': 64 << 20, 'cleanup': daemon.stop}
+
+
+def _end_to_end(builds, shape, jobs=8):
+    def setup(workdir):
+        make_project(workdir, builds, shape)
+        _git_init(workdir)
+        daemon = FakeDaemon(Profile(steps=5, lines_per_step=50,
+                                    layers=3, layer_size=4 << 20)).start()
+        env = dict(os.environ, DOCKER_HOST=daemon.url, PYTHONPATH=ROOT,
+                   XDG_CACHE_HOME=os.path.join(workdir, 'cache'))
+        command = [sys.executable, '-c',
+                   'import sys; from dmake.cli import main; sys.exit(main())',
+                   '-j', str(jobs), '--push-jobs', '2', '--no-cache-db']
+
+        def run():
+            process = subprocess.Popen(command, cwd=workdir, env=env,
+                                       stderr=subprocess.PIPE)
+            errors = process.communicate()[1]
+            if process.returncode:
+                sys.stderr.write(errors[-4096:])
+                raise RuntimeError("docker-make exited with %d" %
+                                   process.returncode)
+        return run, {'cleanup': daemon.stop}
+    return setup
+
+
+benchmark('end_to_end[wide,10]', repeat=3)(_end_to_end(10, 'wide'))
+benchmark('end_to_end[layered,100]', repeat=3)(_end_to_end(100, 'layered'))
+benchmark('end_to_end[layered,1000]', repeat=1, quick=False)(
+    _end_to_end(1000, 'layered'))
+
+
+def run_benchmark(func, repeat):
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    workdir = tempfile.mkdtemp(prefix='dmake-bench.')
+    facts = {}
+    try:
+        timed = func(workdir)
+        if isinstance(timed, tuple):
+            timed, facts = timed
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            timed()
+            times.append(time.time() - start)
+    finally:
+        cleanup = facts.pop('cleanup', None)
+        if cleanup is not None:
+            cleanup()
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(workdir, ignore_errors=True)
+    times.sort()
+    result = {'best': times[0], 'median': times[len(times) // 2],
+              'repeat': repeat}
+    if 'bytes' in facts:
+        result['MB/s'] = facts['bytes'] / 1024.0 / 1024.0 / times[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='run the benchmarks whose name starts so.')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest configurations.')
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the results in FILE.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results stored in FILE.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print('%-34s %10s %10s %10s %8s' % ('benchmark', 'best(ms)', 'median(ms)',
+                                        'MB/s', 'ratio'))
+    for name, func, repeat, quick in BENCHMARKS:
+        if args.quick and not quick:
+            continue
+        if args.names and not any(name.startswith(n) for n in args.names):
+            continue
+        result = results[name] = run_benchmark(func, repeat)
+        ratio = ''
+        if name in baseline:
+            ratio = '%.2fx' % (result['best'] / baseline[name]['best'])
+        mbps = '%.1f' % result['MB/s'] if 'MB/s' in result else ''
+        print('%-34s %10.1f %10.1f %10s %8s' % (
+            name, result['best'] * 1000, result['median'] * 1000, mbps,
+            ratio))
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': time.strftime('%Y-%m-%d'),
+                       'results': results}, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
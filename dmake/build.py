@@ -1,23 +1,191 @@
 import os
+import re
+import copy
+import time
+import hashlib
+import inspect
+import tarfile
+import itertools
 import tempfile
 import logging
+import threading
 
 import json
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from docker import auth as docker_auth
+from docker import errors as docker_errors
 from docker import utils as docker_utils
 
+from dmake import cache
+from dmake import config
+from dmake import context
+from dmake import registry
+from dmake import report
 from dmake import utils
 from dmake import template_args
 from dmake.errors import *  # noqa
 
 
 LOG = logging.getLogger(__name__)
+EXTRACT_CHUNK_SIZE = 1 << 20
+EXTRACT_JOBS = 4
+# temporary files and directories of extracts, next to their destination
+EXTRACT_PREFIX = '.dmake-extract.'
+PLATFORM_JOBS = 2
+CACHE_PULL_JOBS = 4
+FROM_PATTERN = re.compile(r'^(\s*from\s+)((?:--\S+\s+)*)(\S+)', re.I)
+STAGE_PATTERN = re.compile(r'\s+as\s+(\S+)\s*$', re.I)
+STEP_PATTERN = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+WHITESPACE_PATTERN = re.compile(r'\s*')
+VARIABLE_PATTERN = re.compile(r'\$(?:\{(\w+)(?::([-+])([^}]*))?\}|(\w+))')
+
+
+def rewrite_dockerfile(dockerfile, image):
+    """the content of a Dockerfile with its parent images replaced by
+    `image`, stages referring to earlier stages are left untouched.
+    """
+    stages = set()
+    lines = []
+    for line in dockerfile.splitlines(True):
+        match = FROM_PATTERN.match(line)
+        if match is not None:
+            prefix, flags, parent = match.groups()
+            rest = line[match.end():]
+            if parent.lower() not in stages:
+                line = prefix + flags + image + rest
+            stage = STAGE_PATTERN.search(rest)
+            if stage is not None:
+                stages.add(stage.group(1).lower())
+        lines.append(line)
+    return ''.join(lines)
+
+
+def expand_args(text, values):
+    """`text` with `$NAME`, `${NAME}`, `${NAME:-word}` and `${NAME:+word}`
+    replaced as `docker build` does, None if it uses an undefined argument.
+    """
+    undefined = []
+
+    def expand(match):
+        name, modifier, word, bare = match.groups()
+        value = values.get(name or bare)
+        if modifier == '-':
+            return value or word
+        if modifier == '+':
+            return word if value else ''
+        if value is None:
+            undefined.append(name or bare)
+            return ''
+        return value
+    text = VARIABLE_PATTERN.sub(expand, text)
+    return None if undefined else text
+
+
+def _global_args(lines, buildargs):
+    # ARGs declared before the first FROM, which FROM lines may use
+    values = {}
+    for line in lines:
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if words[0].upper() != 'ARG':
+            break
+        for arg in words[1:]:
+            name, eq, default = arg.partition('=')
+            if name in buildargs:
+                values[name] = buildargs[name]
+            elif eq:
+                values[name] = expand_args(default.strip('"\''), values)
+    return dict((k, v) for k, v in values.items() if v is not None)
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def _safe_member(member, root):
+    # neither the member, nor what it links to, may end up outside `root`,
+    # directories of earlier members being symlinks included
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+        return False
+    parent = os.path.realpath(os.path.join(root, os.path.dirname(name)))
+    if not _inside(parent, root):
+        return False
+    if member.issym():
+        target = os.path.join(parent, member.linkname)
+    elif member.islnk():
+        target = os.path.join(root, member.linkname)
+    else:
+        return True
+    return _inside(os.path.realpath(target), root)
+
+
+def platform_suffix(platform):
+    """`linux/arm/v7` as `linux-arm-v7`, for tags and paths"""
+    return platform.replace('/', '-')
+
+
+def _platform_path(path, platform):
+    # out/ as out-linux-arm64/, out/app.tar.gz as out/app-linux-arm64.tar.gz
+    suffix = '-' + platform_suffix(platform)
+    if path.endswith('/'):
+        return path.rstrip('/') + suffix + '/'
+    dirname, basename = os.path.split(path)
+    name, dot, ext = basename.lstrip('.').partition('.')
+    name = basename[:len(basename) - len(basename.lstrip('.'))] + name
+    return os.path.join(dirname, name + suffix + dot + ext)
+
+
+def _same_repo(a, b):
+    # the daemon drops the default registry and library/ from names
+    def normalize(repo):
+        for prefix in ('docker.io/', 'index.docker.io/', 'library/'):
+            if repo.startswith(prefix):
+                repo = repo[len(prefix):]
+        return repo
+    return normalize(a) == normalize(b)
+
+
+class _QueryParams(threading.local):
+    # query parameters added to the builds of the current thread
+    params = None
+
+
+_QUERY_PARAMS = _QueryParams()
+
+
+def _build_with_query(client, params, query):
+    """`client.build(**params)`, with query parameters the installed
+    docker-py has no argument for.
+    """
+    if not getattr(client, '_dmake_query', False):
+        post = client._post
+
+        def posted(url, **kwargs):
+            if _QUERY_PARAMS.params and url.endswith('/build'):
+                kwargs['params'] = dict(kwargs.get('params') or {},
+                                        **_QUERY_PARAMS.params)
+            return post(url, **kwargs)
+        client._post = posted
+        client._dmake_query = True
+    # the request is sent before build() returns the output stream
+    _QUERY_PARAMS.params = query
+    try:
+        return client.build(**params)
+    finally:
+        _QUERY_PARAMS.params = None
 
 
 class Build(object):
     def __init__(self, name, context, dockerfile,
                  buildargs=None, dockerignore=None, labels=None, depends_on=None,
                  extract=None, pushes=None, rewrite_from=None,
-                 remove_intermediate=None):
+                 remove_intermediate=None, context_compression=None,
+                 force_push=False, platforms=None, platform_jobs=PLATFORM_JOBS,
+                 cache_from=None, cache_to=None):
         self.name = name
         self.context = os.path.join(os.getcwd(), context.lstrip('/'))
         self.dockerfile = dockerfile
@@ -27,7 +195,20 @@ class Build(object):
             self.dockerignore.append('.dockerignore')
         self.depends_on = depends_on or []
         self.rewrite_from = rewrite_from
+        # rewrite_from is replaced by the image of that build when built
+        self.rewrite_from_name = rewrite_from
+        self.non_labeled_image = None
+        self.final_image = None
         self.remove_intermediate = remove_intermediate
+        self.context_compression = context_compression
+        self.force_push = force_push
+        self.platforms = platforms or []
+        self.platform_jobs = platform_jobs
+        self.platform = None
+        self.variants = OrderedDict()
+        self.rewrite_from_platforms = {}
+        self.cache_from = cache_from or []
+        self.cache_to = cache_to
 
         self.collect_pushes(pushes)
         self.collect_labels(labels)
@@ -39,24 +220,21 @@ class Build(object):
 
     def collect_pushes(self, pushes):
         self.pushes = []
-        push_rules = pushes or []
-
-        for line in push_rules:
-            try:
-                push_mode, line = line.split('=', 1)
-                repo, tag_template = line.rsplit(':', 1)
-                self.pushes.append((push_mode, repo, tag_template))
-            except ValueError:
-                raise ConfigurationError("wrong format for push %s" % line)
+        for rule in pushes or []:
+            if not isinstance(rule, config.PushRule):
+                rule = config.PushRule.parse(rule)
+            self.pushes.append(rule)
 
     def collect_labels(self, labels=None):
         self.labels = []
+        self.label_values = OrderedDict()
         labels = labels or []
         elements = template_args.label_template_args()
         for label_template in labels:
             try:
                 key, value = label_template.split('=', 1)
                 value = value.format(**elements)
+                self.label_values[key] = value
                 value = value.replace('"', r'\"')
                 self.labels.append('%s="%s"' % (key, value))
             except KeyError:
@@ -66,42 +244,117 @@ class Build(object):
                                          label_template)
 
     def parse_extract(self, extract=None):
-        extract = extract or []
         self.extract = []
-        for item in extract:
-            try:
-                src, dst = item.split(':', 1)
-            except ValueError:
-                raise ConfigurationError('invalid extract rule: %s' % item)
+        for rule in extract or []:
+            if not isinstance(rule, config.ExtractRule):
+                rule = config.ExtractRule.parse(rule)
             self.extract.append({
-                'src': src,
-                'dst': os.path.join(self.context, dst)
+                'src': rule.src,
+                'dst': os.path.join(self.context, rule.dst),
+                'unpack': rule.unpack,
+                'sha256': rule.sha256,
             })
 
     def dryrun(self):
         command = ["docker", "build", "-f", self.dockerfile]
         for label in self.labels:
             command.extend(["--label", label])
-        print ("%s: %s" % (self.name, " ".join(command)))
+        if not self.platforms:
+            print ("%s: %s" % (self.name, " ".join(command)))
+        for platform in self.platforms:
+            print ("%s: %s --platform %s" %
+                   (self.name, " ".join(command), platform))
+
+    def for_platform(self, platform):
+        """a copy of this build making the image of `platform`"""
+        variant = copy.copy(self)
+        variant.name = '%s@%s' % (self.name, platform)
+        variant.platform = platform
+        variant.platforms = []
+        variant.variants = OrderedDict()
+        variant.rewrite_from = self.rewrite_from_platforms.get(
+            platform, self.rewrite_from)
+        variant.extract = [
+            dict(path, dst=_platform_path(path['dst'], platform))
+            for path in self.extract]
+        return variant
+
+    def extract_destinations(self):
+        """the paths extracts of the build write to, of every platform"""
+        return [_platform_path(path['dst'], platform) if platform
+                else path['dst']
+                for platform in self.platforms or [None]
+                for path in self.extract]
+
+    def platform_images(self):
+        return dict((platform, variant.non_labeled_image)
+                    for platform, variant in self.variants.items())
 
     def build(self):
+        if self.platforms:
+            return self._build_platforms()
         self._update_progress("building")
+        self.labels_applied = False
         self.non_labeled_image = self._build()
 
-        if self.labels:
+        if self.labels and not self.labels_applied:
             self._update_progress("attaching labels")
-            self.final_image = self._attach_labels()
+            with report.Recorder.phase(self.name, 'labels',
+                                       labels=len(self.labels)):
+                self.final_image = self._attach_labels()
         else:
             self.final_image = self.non_labeled_image
         self._update_progress("build succeed: %s" % self.final_image)
 
         if self.extract:
             self._update_progress("extracting archives")
-            self._extract_contents(self.final_image, self.extract)
+            try:
+                self._extract_contents(self.final_image, self.extract)
+            finally:
+                # later builds of the run may use what was extracted
+                for path in self.extract:
+                    context.SharedContexts.changed(path['dst'])
             self._update_progress("extracting archives succeed")
 
+    def _build_platforms(self):
+        self.variants = OrderedDict((platform, self.for_platform(platform))
+                                    for platform in self.platforms)
+        self._update_progress("building for %s" % ", ".join(self.platforms))
+        pool = ThreadPool(max(1, min(self.platform_jobs, len(self.variants))))
+        try:
+            results = [pool.apply_async(variant.build)
+                       for variant in self.variants.values()]
+        finally:
+            pool.close()
+            pool.join()
+        errors = []
+        for result in results:
+            try:
+                result.get()
+            except BuildFailed as e:
+                errors.append(e.message)
+        if errors:
+            raise BuildFailed("; ".join(errors))
+        first = self.variants.values()[0]
+        self.non_labeled_image = first.non_labeled_image
+        self.final_image = first.final_image
+        self._update_progress("build succeed for %s" %
+                              ", ".join(self.platforms))
+
     def tag(self):
+        with report.Recorder.phase(self.name, 'tag') as facts:
+            if not self.variants:
+                facts['tags'] = self._tag()
+                return
+            # every platform's image is pushed under a suffixed tag, for
+            # the manifest list to refer to.
+            facts['tags'] = sum(
+                variant._tag('-' + platform_suffix(platform))
+                for platform, variant in self.variants.items())
+
+    def _tag(self, suffix=''):
         template_kwargs = template_args.tag_template_args()
+        tags = 0
         for push_mode, repo, tag_template in self.pushes:
             # continue to next item if not needed
             need_push = self.need_push(push_mode)
@@ -109,17 +362,29 @@ class Build(object):
                 continue
 
             try:
-                tag_name = tag_template.format(**template_kwargs)
-                kwargs = {}
-                if docker_utils.compare_version('1.22', self.docker._version) < 0:
-                    kwargs['force'] = True
-                self.docker.tag(self.final_image, repo, tag_name, **kwargs)
-                self._update_progress("tag added: %s:%s" % (repo, tag_name))
+                tag_name = tag_template.format(**template_kwargs) + suffix
+                self._tag_image(repo, tag_name)
+                tags += 1
             except KeyError as e:
                 LOG.warn('invalid tag_template for this build: %s', e.message)
+        return tags
+
+    def _tag_image(self, repo, tag_name):
+        kwargs = {}
+        if docker_utils.compare_version('1.22', self.docker._version) < 0:
+            kwargs['force'] = True
+        self.docker.tag(self.final_image, repo, tag_name, **kwargs)
+        self._update_progress("tag added: %s:%s" % (repo, tag_name))
 
-    def push(self):
+    def push(self, jobs=1):
+        """push every needed tag, pushes to different repos in parallel.
+
+        tags of the same repo are pushed one after another, so that layers
+        are uploaded by the first push only and the rest of the tags just
+        add a manifest.
+        """
         template_kwargs = template_args.tag_template_args()
+        repos = OrderedDict()
         for push_mode, repo, tag_template in self.pushes:
             # continue to next item if not needed
             need_push = self.need_push(push_mode)
@@ -130,10 +395,207 @@ class Build(object):
                 tag_name = tag_template.format(**template_kwargs)
             except KeyError:
                 raise PushFailed("can not get tag name for tag_template: %s" % tag_template)
+            tags = repos.setdefault(repo, [])
+            if tag_name not in tags:
+                tags.append(tag_name)
+
+        # group repos by registry, and interleave the groups so that
+        # workers start on different registries first.
+        registries = OrderedDict()
+        for repo, tags in repos.items():
+            registry, _ = docker_auth.resolve_repository_name(repo)
+            registries.setdefault(registry, []).append((repo, tags))
+        chains = [chain
+                  for group in itertools.izip_longest(*registries.values())
+                  for chain in group if chain is not None]
+        jobs = min(jobs, len(chains))
+        if jobs <= 1:
+            for repo, tags in chains:
+                self._push_repo(repo, tags)
+        else:
+            self._push_chains(chains, jobs)
+        self._push_cache()
+
+    def _push_chains(self, chains, jobs):
+        pool = ThreadPool(jobs)
+        try:
+            results = [pool.apply_async(self._push_repo, chain)
+                       for chain in chains]
+        finally:
+            pool.close()
+            pool.join()
+        errors = []
+        for result in results:
+            try:
+                result.get()
+            except PushFailed as e:
+                errors.append(e.message)
+        if errors:
+            raise PushFailed("; ".join(errors))
+
+    def _push_cache(self):
+        """push the image as `cache_to`, for later builds to use as cache.
+        failing to do so does not fail the build.
+        """
+        if self.variants:
+            for variant in self.variants.values():
+                variant._push_cache()
+            return
+        image = self.cache_to and self._cache_image(self.cache_to)
+        if not image:
+            return
+        repo, tag = image
+        try:
+            self._tag_image(repo, tag)
+            self._push_tag(repo, tag)
+        except (PushFailed, docker_errors.APIError) as e:
+            LOG.warn("%s: failed to push cache image %s:%s: %s", self.name,
+                     repo, tag, e)
+            return
+        utils.Summary.count('cache images pushed')
+
+    def _cache_image(self, template):
+        """(repo, tag) of an image of `cache_from` or `cache_to`, None when
+        its template can not be formatted, like `{git_tag}` on a branch.
+        """
+        try:
+            name = template.format(**template_args.tag_template_args())
+        except (KeyError, IndexError, ValueError) as e:
+            LOG.warn("%s: cache image %s skipped: %s", self.name, template, e)
+            return None
+        repo, tag = docker_utils.parse_repository_tag(name)
+        tag = tag or 'latest'
+        if self.platform and not tag.startswith('sha256:'):
+            tag += '-' + platform_suffix(self.platform)
+        return repo, tag
+
+    def _pull_cache(self):
+        """pull the images of `cache_from` in parallel, and return the ones
+        available. missing ones are fine, a new branch has no cache yet.
+        """
+        images = []
+        for template in self.cache_from:
+            image = self._cache_image(template)
+            if image and image not in images:
+                images.append(image)
+        if not images:
+            return []
+        pool = ThreadPool(min(CACHE_PULL_JOBS, len(images)))
+        try:
+            pulled = pool.map(self._pull, images)
+        finally:
+            pool.close()
+            pool.join()
+        names = [name for name in pulled if name]
+        utils.Summary.count('cache images pulled', len(names))
+        return names
+
+    def _pull(self, image):
+        repo, tag = image
+        name = ('%s@%s' if tag.startswith('sha256:') else '%s:%s') % image
+        with report.Recorder.phase(self.name, 'cache pull',
+                                   image=name) as facts:
+            facts['pulled'] = False
+            try:
+                # pulls wait on the daemon like pushes
+                for line in utils.docker_client('push').pull(
+                        repo, tag, stream=True, decode=True):
+                    if 'error' in line:
+                        raise docker_errors.DockerException(line['error'])
+            except docker_errors.DockerException as e:
+                LOG.info("%s: cache image %s not pulled: %s", self.name, name,
+                         e)
+                return None
+            facts['pulled'] = True
+        self._update_progress("pulled cache image %s" % name)
+        return name
+
+    def _push_repo(self, repo, tags):
+        for tag_name in tags:
+            if not self.variants:
+                self._push_tag(repo, tag_name)
+                continue
+            for platform, variant in self.variants.items():
+                variant._push_tag(repo,
+                                  tag_name + '-' + platform_suffix(platform))
+            self._push_manifest_list(repo, tag_name)
+
+    def _push_tag(self, repo, tag_name):
+        if self._in_registry(repo, tag_name):
+            utils.Summary.count('pushes skipped, already in registry')
+            self._update_progress("%s:%s is up to date in its registry, "
+                                  "push skipped" % (repo, tag_name))
+            return
+        self._update_progress("pushing to %s:%s" % (repo, tag_name))
+        with report.Recorder.phase(self.name, 'push', repo=repo,
+                                   tag=tag_name) as facts:
+            progress = self._do_push(repo, tag_name)
+            uploaded = progress.uploaded
+            facts.update(layers=len(progress.layers),
+                         uploaded=len(uploaded),
+                         bytes=sum(progress.sizes.get(layer, 0)
+                                   for layer in uploaded),
+                         digest=progress.digest)
+        self._update_progress("pushed to %s:%s (%s)" %
+                              (repo, tag_name, progress))
+
+    def _push_manifest_list(self, repo, tag_name):
+        """point repo:tag at the images of every platform"""
+        server, path = registry.registry(repo)
+        with report.Recorder.phase(self.name, 'manifest list', repo=repo,
+                                   tag=tag_name) as facts:
+            manifests = [(platform, server.manifest(
+                path, tag_name + '-' + platform_suffix(platform)))
+                for platform in self.variants]
+            digest = facts['digest'] = server.put_manifest_list(
+                path, tag_name, manifests)
+        self._update_progress("pushed manifest list %s:%s for %s (%s)" %
+                              (repo, tag_name, ", ".join(self.variants),
+                               digest))
+
+    def _in_registry(self, repo, tag):
+        """whether the registry has repo:tag pointing at the manifest the
+        local image was pushed or pulled as already.
+        """
+        if self.force_push:
+            return False
+        name = '%s:%s' % (repo, tag)
+        try:
+            image = self.docker.inspect_image(name)
+        except docker_errors.APIError:
+            return False
+        local = set(digest for image_repo, digest in
+                    (d.rsplit('@', 1) for d in image.get('RepoDigests') or [])
+                    if _same_repo(image_repo, repo))
+        if not local:
+            # never pushed from here, nothing to compare with
+            return False
+        with report.Recorder.phase(self.name, 'push check', repo=repo,
+                                   tag=tag) as facts:
+            remote = facts['digest'] = self._registry_digest(name)
+        return remote in local
 
-            self._update_progress("pushing to %s:%s" % (repo, tag_name))
-            self._do_push(repo, tag_name)
-            self._update_progress("pushed to %s:%s" % (repo, tag_name))
+    def _registry_digest(self, name):
+        """manifest digest of image `name` in its registry, as the docker
+        daemon sees it, None when unknown.
+        """
+        docker = self.docker
+        if docker_utils.compare_version('1.30', docker._version) < 0:
+            return None
+        registry, _ = docker_auth.resolve_repository_name(name)
+        headers = {}
+        header = docker_auth.get_config_header(docker, registry)
+        if header:
+            headers['X-Registry-Auth'] = header
+        url = docker._url('/distribution/{0}/json', name)
+        try:
+            result = docker._result(docker._get(url, headers=headers),
+                                    json=True)
+            return result['Descriptor']['digest']
+        except (docker_errors.APIError, KeyError, TypeError) as e:
+            LOG.debug("%s: can not get the digest of %s in its registry: %s",
+                      self.name, name, e)
+            return None
 
     def need_push(self, push_mode):
         tag_template_args = template_args.tag_template_args()
@@ -152,63 +614,325 @@ class Build(object):
         temp_container = self.docker.create_container(img, 'true')
         assert 'Id' in temp_container
         try:
-            for path in paths:
-                src, dst = path['src'], path['dst']
-                stream, stat = self.docker.get_archive(temp_container, src)
-                with open(dst, 'w') as f:
-                    f.write(stream.data)
-                utils.GarbageCleaner.register(dst)
+            if len(paths) == 1:
+                self._extract(temp_container, paths[0])
+                return
+
+            pool = ThreadPool(min(EXTRACT_JOBS, len(paths)))
+            try:
+                results = [pool.apply_async(self._extract,
+                                            (temp_container, path))
+                           for path in paths]
+            finally:
+                pool.close()
+                pool.join()
+            for result in results:
+                result.get()
         finally:
             self.docker.remove_container(temp_container)
 
-    def _build(self):
-        dockerfile = os.path.join(self.context, self.dockerfile)
-        dockerignore = os.path.join(self.context, '.dockerignore')
-        created_dockerignore = False
-        if not os.path.exists(dockerignore):
-            with open(dockerignore, 'w') as f:
-                f.write("\n".join(self.dockerignore))
-                created_dockerignore = True
-            utils.GarbageCleaner.register(dockerignore)
+    def _extract(self, container, path):
+        """extract a path, its destination appears once it is complete."""
+        with report.Recorder.phase(self.name, 'extract',
+                                   src=path['src']) as facts:
+            reader = self._extract_to(container, path)
+            facts['bytes'] = reader.size
 
-        if self.rewrite_from:
-            original_lines = open(dockerfile).readlines()
-            with open(dockerfile, 'w') as f:
-                for line in original_lines:
-                    line = line.strip()
-                    if not line.startswith("FROM"):
-                        f.write("%s\n" % line)
-                        continue
+    def _extract_to(self, container, path):
+        src, dst = path['src'], path['dst']
+        start = time.time()
+        stream, stat = self.docker.get_archive(container, src)
+        reader = _ArchiveReader(stream)
+        if path['unpack']:
+            tmp = tempfile.mkdtemp(dir=os.path.dirname(dst.rstrip('/')),
+                                   prefix=EXTRACT_PREFIX)
+        else:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst),
+                                       prefix=EXTRACT_PREFIX)
+            os.close(fd)
+        try:
+            if path['unpack']:
+                self._unpack(reader, tmp)
+            else:
+                with open(tmp, 'wb') as f:
+                    for chunk in iter(lambda: reader.read(EXTRACT_CHUNK_SIZE),
+                                      b''):
+                        f.write(chunk)
 
-                    if " AS " not in line:
-                        f.write("FROM %s\n" % self.rewrite_from)
-                    else:
-                        from_text, intermediate_name = line.split(" AS ")
-                        f.write("FROM %s AS %s\n" % (self.rewrite_from, intermediate_name))
+            if path['sha256'] and reader.sha256.hexdigest() != path['sha256']:
+                raise ExtractFailed(
+                    "checksum mismatch for %s: expected %s, got %s" %
+                    (src, path['sha256'], reader.sha256.hexdigest()))
 
+            if path['unpack']:
+                self._move_unpacked(tmp, dst)
+            else:
+                os.rename(tmp, dst)
+                utils.GarbageCleaner.register(dst)
+        finally:
+            if os.path.lexists(tmp):
+                utils.GarbageCleaner.clean(tmp)
+
+        elapsed = max(time.time() - start, 0.001)
+        size = reader.size / 1024.0 / 1024.0
+        self._update_progress("extracted %s to %s: %.1fMB in %.1fs(%.1fMB/s)" %
+                              (src, dst, size, elapsed, size / elapsed))
+        return reader
+
+    def _unpack(self, reader, dst):
+        archive = tarfile.open(fileobj=reader, mode='r|')
+        root = os.path.realpath(dst)
+        for member in archive:
+            if not _safe_member(member, root):
+                LOG.warn("%s: skipped unsafe path in archive: %s",
+                         self.name, member.name)
+                continue
+            archive.extract(member, dst)
+        # read what is left of the stream, so that the checksum is complete
+        for _ in iter(lambda: reader.read(EXTRACT_CHUNK_SIZE), b''):
+            pass
+
+    def _move_unpacked(self, tmp, dst):
+        # entries are renamed one by one, replacing existing ones
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+            utils.GarbageCleaner.register(dst)
+        for name in os.listdir(tmp):
+            target = os.path.join(dst, name)
+            if os.path.lexists(target):
+                utils.GarbageCleaner.clean(target)
+            os.rename(os.path.join(tmp, name), target)
+            utils.GarbageCleaner.register(target)
+
+    def _build(self):
+        buildargs = self._buildargs()
+        if not cache.BuildCache.enabled:
+            return self._build_image(buildargs)
+
+        with report.Recorder.phase(self.name, 'cache') as facts:
+            key = self.cache_key(buildargs)
+            if key is None:
+                image_id = None
+                cache.BuildCache.record(hit=False)
+            else:
+                image_id = self._cached_image(key)
+            facts['hit'] = image_id is not None
+        if image_id is None:
+            image_id = self._build_image(buildargs)
+            if image_id is not None and key is not None:
+                cache.BuildCache.put(key, image_id, self.name)
+        return image_id
 
+    def _buildargs(self):
         buildargs = {}
         if self.buildargs:
             buildargs = {k: os.path.expandvars(v) for k, v in [arg.split('=') for arg in self.buildargs]}
+        return buildargs
+
+    def ignore_patterns(self):
+        # an existing .dockerignore takes precedence, as with `docker build`
+        dockerignore = os.path.join(self.context, '.dockerignore')
+        if os.path.exists(dockerignore):
+            with open(dockerignore) as f:
+                return list(filter(bool, f.read().splitlines()))
+        return self.dockerignore
+
+    def cache_key(self, buildargs):
+        """fingerprint everything the result of a build depends on, None
+        when some parent image can not be told.
+        """
+        parents = self._parent_image_ids(buildargs)
+        if parents is None:
+            return None
+        parts = [
+            ('dockerfile', self.dockerfile),
+            ('buildargs', json.dumps(sorted(buildargs.items()))),
+            ('parents', json.dumps(parents)),
+            ('context', self.scan_context().digest),
+        ]
+        if self.platform:
+            parts.append(('platform', self.platform))
+        h = hashlib.sha256()
+        for name, value in parts:
+            h.update('%s=%s\0' % (name, value))
+        return h.hexdigest()
+
+    def _parent_image_ids(self, buildargs):
+        if self.rewrite_from:
+            return [self.rewrite_from]
+
+        stages = set()
+        parents = []
+        with open(os.path.join(self.context, self.dockerfile)) as f:
+            lines = f.read().splitlines()
+        args = _global_args(lines, buildargs)
+        for line in lines:
+            words = line.split()
+            if not words or words[0].upper() != 'FROM':
+                continue
+            words = [w for w in words[1:] if not w.startswith('--')]
+            if not words:
+                continue
+            image = expand_args(words[0], args)
+            if image is None:
+                LOG.debug("%s: can not expand %s", self.name, words[0])
+                return None
+            if len(words) == 3 and words[1].upper() == 'AS':
+                stages.add(words[2])
+            if image in stages or image == 'scratch':
+                continue
+            try:
+                parents.append(self.docker.inspect_image(image)['Id'])
+            except docker_errors.NotFound:
+                parents.append(None)
+            except docker_errors.APIError as e:
+                LOG.debug("%s: can not inspect %s: %s", self.name, image, e)
+                return None
+        return parents
+
+    def share_context(self):
+        """declare the context to be archived once for all builds using it"""
+        for _ in self.platforms or [None]:
+            context.SharedContexts.register(self.context,
+                                            self.ignore_patterns(),
+                                            self.dockerfile)
+
+    def scan_context(self):
+        with report.Recorder.phase(self.name, 'context') as facts:
+            scan = context.SharedContexts.scan(self.context,
+                                               self.ignore_patterns(),
+                                               self.dockerfile)
+            facts.update(files=scan.file_count, bytes=scan.total_bytes)
+        LOG.debug("%s: context: %s", self.name, scan)
+        return scan
+
+    def _cached_image(self, key):
+        image_id = cache.BuildCache.get(key)
+        if image_id is None:
+            cache.BuildCache.record(hit=False)
+            return None
+        try:
+            self.docker.inspect_image(image_id)
+        except docker_errors.NotFound:
+            LOG.debug("%s: cached image %s is gone", self.name, image_id)
+            cache.BuildCache.record(hit=False, stale=True)
+            return None
+        cache.BuildCache.record(hit=True)
+        self._update_progress("unchanged, using cached image %s" % image_id)
+        self.labels_applied = self._has_labels(image_id)
+        return image_id
+
+    def _has_labels(self, image_id):
+        if not self.label_values:
+            return True
+        config = self.docker.inspect_image(image_id).get('Config') or {}
+        labels = config.get('Labels') or {}
+        return all(labels.get(k) == v for k, v in self.label_values.items())
+
+    def _labels_supported(self):
+        # labels of `docker build` need API 1.23, and docker-py >= 2.0
+        return self._build_supports('labels', '1.23')
 
+    def _build_supports(self, arg, api_version):
+        try:
+            args = inspect.getargspec(self.docker.build).args
+        except TypeError:
+            return False
+        return (arg in args and docker_utils.compare_version(
+            api_version, self.docker._version) >= 0)
+
+    def _start_build(self, params):
+        """send the build to the daemon, returning the output stream"""
+        docker = utils.docker_client('build')
+        if not self.platform:
+            return docker.build(**params)
+        # `platform` of `docker build` needs docker-py >= 3.1, the query
+        # parameter is sent by hand with older ones
+        try:
+            args = inspect.getargspec(docker.build).args
+        except TypeError:
+            args = []
+        if 'platform' in args:
+            return docker.build(platform=self.platform, **params)
+        if docker_utils.compare_version('1.32', docker._version) < 0:
+            raise BuildFailed("%s: building for a platform needs docker api "
+                              "1.32 or later" % self.name)
+        return _build_with_query(docker, params, {'platform': self.platform})
+
+    def _context_overrides(self):
+        """files replaced in the context sent to the daemon"""
+        if not self.rewrite_from:
+            return None
+        # the rewritten Dockerfile is appended to the archive at the same
+        # path, the files of the context are never modified.
+        with open(os.path.join(self.context, self.dockerfile)) as f:
+            dockerfile = rewrite_dockerfile(f.read(), self.rewrite_from)
+        return [(os.path.normpath(self.dockerfile).replace(os.sep, '/'),
+                 dockerfile)]
+
+    def _build_image(self, buildargs):
+        cache_from = []
+        if self.cache_from:
+            # cache_from of `docker build` needs API 1.25
+            if self._build_supports('cache_from', '1.25'):
+                cache_from = self._pull_cache()
+            else:
+                LOG.warn("%s: cache_from ignored, it needs docker api 1.25",
+                         self.name)
+        if self.cache_to:
+            # for daemons using BuildKit, cache metadata is not kept in the
+            # image unless asked for
+            buildargs = dict(buildargs, BUILDKIT_INLINE_CACHE='1')
+
+        compression = self.context_compression
+        if compression == 'auto':
+            compression = 'gzip' if utils.docker_is_remote() else None
+        elif compression == 'none':
+            compression = None
+
+        stream = context.SharedContexts.stream(self.context,
+                                               self.ignore_patterns(),
+                                               self.dockerfile, compression,
+                                               self._context_overrides())
         params = {
-            'path': self.context,
+            'fileobj': stream,
+            'custom_context': True,
+            'encoding': compression,
             'dockerfile': self.dockerfile,
             'buildargs': buildargs,
+            # docker-py builds with no timeout, whatever the client has
+            'timeout': utils.DockerClients.timeouts['build'],
         }
 
         if self.remove_intermediate:
             LOG.debug("Removing intermediate containers after each build")
             params['rm'] = self.remove_intermediate
 
-        try:
-            image_id = self._do_build(params)
-        finally:
-            if created_dockerignore:
-                os.remove(dockerignore)
-            if self.rewrite_from:
-                with open(dockerfile, 'w') as f:
-                    f.write(''.join(original_lines))
+        if self.label_values and self._labels_supported():
+            params['labels'] = dict(self.label_values)
+        if cache_from:
+            params['cache_from'] = cache_from
+
+        # the context is sent before the daemon starts to respond
+        with report.Recorder.phase(self.name, 'upload',
+                                   compression=compression) as facts:
+            params['fileobj'] = report.counted(params['fileobj'], facts)
+            response = self._start_build(params)
+        with report.Recorder.phase(self.name, 'build') as facts:
+            output = self._read_build(response)
+            facts.update(steps=len(output.steps),
+                         cached_steps=output.cached_steps,
+                         image=output.image_id)
+        image_id = output.image_id
+        if self.cache_from:
+            self._update_progress("%d of %d steps served from cache" %
+                                  (output.cached_steps, len(output.steps)))
+
+        if 'labels' in params:
+            self.labels_applied = True
+            utils.Summary.count('label builds avoided')
+            for label in self.labels:
+                self._update_progress("label added: %s" % label)
         return image_id
 
     def _attach_labels(self):
@@ -234,26 +958,185 @@ class Build(object):
         return image_id
 
     def _do_build(self, params):
-        response = self.docker.build(**params)
-        image_id = None
-        for data in response:
-            for line in data.splitlines():
-                ret = json.loads(line)
-                if 'stream' in ret:
-                    msg = ret['stream']
-                    LOG.debug("%s: %s", self.name, msg)
-                if 'errorDetail' in ret:
-                    raise BuildFailed(ret['errorDetail']['message'])
-                if 'Successfully built' in ret.get('stream', ''):
-                    image_id = ret['stream'].strip().split()[-1]
-        return image_id
+        return self._read_build(self._start_build(params)).image_id
+
+    def _read_build(self, response):
+        output = BuildOutput(self.name)
+        for chunk in response:
+            output.feed(chunk)
+        output.close()
+        if output.cached_steps:
+            utils.Summary.count('build steps served from cache',
+                                output.cached_steps)
+        for step, instruction, elapsed, cached in output.steps:
+            report.Recorder.record(self.name, 'step %d' % step,
+                                   output.step_started[step], elapsed,
+                                   instruction=instruction, cached=cached)
+        return output
 
     def _do_push(self, repo, tag):
-        response = self.docker.push(repo, tag, stream=True)
+        progress = PushProgress(self.name, repo, tag)
+        response = utils.docker_client('push').push(repo, tag, stream=True,
+                                                    decode=True)
         for line in response:
-            LOG.debug("%s: %s", self.name, line)
-            if 'errorDetail' in line:
-                raise PushFailed("error in push %s:%s: %s" % (repo, tag, line))
+            progress.feed(line)
+        return progress
 
     def __repr__(self):
         return "Build: %s(%s)" % (self.name, self.progress)
+
+
+class _ArchiveReader(object):
+    """file-like wrapper of an archive stream, counting and hashing it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=EXTRACT_CHUNK_SIZE):
+        data = self.stream.read(size)
+        self.size += len(data)
+        self.sha256.update(data)
+        return data
+
+
+class BuildOutput(object):
+    """decode the json stream of a build, as sent by the daemon.
+
+    messages may be split across chunks, or several of them sent in one.
+    the time spent on each `Step N/M` is recorded in `steps`, as a list of
+    (step, instruction, seconds, cached).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.image_id = None
+        self.built_id = None
+        self.steps = []
+        self.step_started = {}
+        self._step = None
+        self._buf = ''
+        self._decoder = json.JSONDecoder()
+        self._debug = LOG.isEnabledFor(logging.DEBUG)
+
+    @property
+    def cached_steps(self):
+        return sum(1 for step in self.steps if step[3])
+
+    def feed(self, chunk):
+        buf = self._buf + chunk if self._buf else chunk
+        pos, end = 0, len(buf)
+        while True:
+            pos = WHITESPACE_PATTERN.match(buf, pos).end()
+            if pos == end:
+                break
+            try:
+                message, pos = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                # messages do not contain newlines, a complete line which
+                # does not decode is not going to.
+                newline = buf.find('\n', pos)
+                if newline < 0:
+                    break
+                LOG.warn("%s: unexpected build output: %s", self.name,
+                         buf[pos:newline])
+                pos = newline + 1
+                continue
+            self._message(message)
+        self._buf = buf[pos:]
+
+    def close(self):
+        self._end_step()
+        if self.image_id is None:
+            self.image_id = self.built_id
+
+    def _message(self, message):
+        if 'errorDetail' in message or 'error' in message:
+            error = (message.get('errorDetail') or {}).get(
+                'message', message.get('error'))
+            raise BuildFailed(error)
+
+        aux = message.get('aux')
+        if isinstance(aux, dict) and 'ID' in aux:
+            self.image_id = aux['ID']
+
+        stream = message.get('stream')
+        if not stream:
+            return
+        if self._debug:
+            LOG.debug("%s: %s", self.name, stream.rstrip())
+        if stream.startswith('Step '):
+            match = STEP_PATTERN.match(stream.rstrip())
+            if match is not None:
+                self._end_step()
+                self._step = [match.group(1), match.group(3), time.time(),
+                              False]
+        elif stream.startswith(' ---> Using cache'):
+            if self._step is not None:
+                self._step[3] = True
+        elif stream.startswith('Successfully built '):
+            self.built_id = stream.split()[-1]
+
+    def _end_step(self):
+        if self._step is None:
+            return
+        step, instruction, started, cached = self._step
+        self._step = None
+        elapsed = time.time() - started
+        self.steps.append((int(step), instruction, elapsed, cached))
+        self.step_started[int(step)] = started
+        if self._debug:
+            LOG.debug("%s: step %s took %.2fs%s", self.name, step, elapsed,
+                      " (cached)" if cached else "")
+
+
+class PushProgress(object):
+    """digest the json stream of a push into per layer states."""
+
+    def __init__(self, name, repo, tag):
+        self.name = name
+        self.repo = repo
+        self.tag = tag
+        self.layers = {}
+        self.sizes = {}
+        self.digest = None
+
+    def feed(self, line):
+        if 'errorDetail' in line or 'error' in line:
+            error = line.get('errorDetail', {}).get('message',
+                                                    line.get('error'))
+            raise PushFailed("error in push %s:%s: %s" %
+                             (self.repo, self.tag, error))
+        if 'aux' in line:
+            self.digest = line['aux'].get('Digest', self.digest)
+            return
+
+        layer, status = line.get('id'), line.get('status')
+        if not layer or not status or layer == self.tag:
+            return
+        total = line.get('progressDetail', {}).get('total')
+        if total:
+            self.sizes[layer] = total
+        if self.layers.get(layer) != status:
+            if status != 'Pushing':
+                LOG.debug("%s: %s: %s", self.name, layer, status)
+            self.layers[layer] = status
+
+    @property
+    def uploaded(self):
+        return [layer for layer, status in self.layers.items()
+                if status == 'Pushed']
+
+    @property
+    def existed(self):
+        return [layer for layer, status in self.layers.items()
+                if status == 'Layer already exists' or
+                status.startswith('Mounted from')]
+
+    def __str__(self):
+        uploaded = self.uploaded
+        size = sum(self.sizes.get(layer, 0) for layer in uploaded)
+        return "%d layers uploaded(%.1fMB), %d already existed, digest: %s" % (
+            len(uploaded), size / 1024.0 / 1024.0, len(self.existed),
+            self.digest)
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+
+LOG = logging.getLogger(__name__)
+CACHE_VERSION = 1
+MAX_ENTRIES = 2000
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'docker-make')
+
+
+def save_file(path, dump, what, mode='w'):
+    """replace `path` with what `dump(fileobj)` writes, atomically.
+
+    failures only cost later runs some time, they are logged and reported
+    by returning False.
+    """
+    dirname = os.path.dirname(path)
+    tmp = None
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname,
+                                   prefix='.%s.' % os.path.basename(path))
+        with os.fdopen(fd, mode) as f:
+            dump(f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        LOG.warn("failed to save %s %s: %s", what, path, e)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+class _BuildCache(object):
+    """persistent map from a build's input fingerprint to its image id."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._entries = None
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def _path(self):
+        return self.filename or os.path.join(cache_dir(), 'builds.json')
+
+    def _read(self):
+        try:
+            with open(self._path()) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get('version') != CACHE_VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._load().get(key)
+        return entry and entry['image']
+
+    def put(self, key, image_id, name=None):
+        entry = {'image': image_id, 'build': name, 'time': time.time()}
+        with self._lock:
+            self._load()[key] = entry
+            self._updated[key] = entry
+
+    def record(self, hit, stale=False):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if stale:
+                self.stale += 1
+
+    def save(self):
+        if not self.enabled or not self._updated:
+            return
+        # merge with what other runs may have written meanwhile
+        entries = self._read()
+        entries.update(self._updated)
+        if len(entries) > MAX_ENTRIES:
+            newest = sorted(entries.items(), key=lambda kv: kv[1]['time'],
+                            reverse=True)[:MAX_ENTRIES]
+            entries = dict(newest)
+
+        data = {'version': CACHE_VERSION, 'entries': entries}
+        if save_file(self._path(), lambda f: json.dump(data, f),
+                     'build cache'):
+            self._updated = {}
+
+    def stats(self):
+        return "%d hits, %d misses(%d stale)" % (self.hits, self.misses,
+                                                 self.stale)
+
+
+BuildCache = _BuildCache()
@@ -0,0 +1,68 @@
+import os
+import logging
+import subprocess
+
+from dmake.context import IgnoreRules
+from dmake.errors import *  # noqa
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(('git',) + args,
+                                       stderr=subprocess.STDOUT)
+    except OSError as e:
+        raise DmakeError("failed to run git: %s" % e)
+    except subprocess.CalledProcessError as e:
+        raise DmakeError("failed to run git %s: %s" %
+                         (args[0], e.output.strip()))
+
+
+def changed_files(ref):
+    """paths under the current directory, relative to it, which differ
+    between `ref` and the working tree, untracked files included.
+    """
+    # both sides of a move count, a rename would only list the new path
+    diff = _git('diff', '--name-only', '--no-renames', '--relative', '-z',
+                ref, '--')
+    untracked = _git('ls-files', '--others', '--exclude-standard', '-z')
+    return set(p for p in (diff + untracked).split('\0') if p)
+
+
+def ignore_rules(build):
+    """the rules telling the files of the context of `build`"""
+    return IgnoreRules(build.ignore_patterns(),
+                       (os.path.normpath(build.dockerfile), '.dockerignore'))
+
+
+def _affects(build, paths):
+    root = os.path.relpath(build.context)
+    prefix = '' if root == '.' else root + '/'
+    dockerfile = os.path.normpath(build.dockerfile)
+    rules = None
+    for path in paths:
+        if not path.startswith(prefix):
+            continue
+        relpath = path[len(prefix):]
+        if relpath == dockerfile:
+            return True
+        if rules is None:
+            rules = ignore_rules(build)
+        if not rules.excluded(relpath):
+            return True
+    return False
+
+
+def affected_builds(builds, paths, dmakefile=None):
+    """names of the builds whose context includes some of `paths`.
+
+    `builds` are `dmake.build.Build` objects, and `paths` are relative to
+    the current directory. a change to `dmakefile` affects every build.
+    """
+    paths = set(os.path.normpath(p).replace(os.sep, '/') for p in paths)
+    if dmakefile is not None and os.path.relpath(dmakefile) in paths:
+        LOG.info("%s changed, every build is affected", dmakefile)
+        return set(build.name for build in builds)
+    return set(build.name for build in builds if _affects(build, paths))
@@ -1,3 +1,4 @@
+import os
 import argparse
 import logging
 
@@ -5,7 +6,14 @@ from dotenv import load_dotenv
 
 from dmake.errors import *  # noqa
 from dmake import utils
+from dmake import changes
+from dmake import config as dmake_config
+from dmake import report
 from dmake import template_args
+from dmake import watch
+from dmake.cache import BuildCache
+from dmake.context import ContextScanner, SharedContexts
+from dmake.scheduler import Scheduler, PushQueue
 import dmake.build
 
 LOG = logging.getLogger(__name__)
@@ -28,9 +36,212 @@ def argparser():
                         default=False, help='print docker commands only')
     parser.add_argument('--no-push', dest='nopush', action='store_true',
                         default=False, help='build only, dont push images.')
+    parser.add_argument('--force-push', dest='force_push', action='store_true',
+                        default=False,
+                        help='push even tags the registry has up to date.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of builds to run in parallel.')
+    parser.add_argument('--push-jobs', dest='push_jobs', type=int, default=1,
+                        help='number of repos a build pushes to in parallel.')
+    parser.add_argument('--platform-jobs', dest='platform_jobs', type=int,
+                        default=dmake.build.PLATFORM_JOBS,
+                        help='number of platforms a build builds for in '
+                             'parallel.')
+    parser.add_argument('--context-compression', dest='context_compression',
+                        choices=['auto', 'gzip', 'none'], default='auto',
+                        help='compression of build contexts sent to the '
+                             'docker daemon, "auto" compresses for remote '
+                             'daemons only.')
+    parser.add_argument('--no-cache-db', dest='cache_db', action='store_false',
+                        default=True,
+                        help='always build, dont skip builds whose inputs '
+                             'are unchanged since a previous run.')
+    parser.add_argument('--cache-stats', dest='cache_stats',
+                        action='store_true', default=False,
+                        help='print out build cache statistics.')
+    parser.add_argument('--config-cache', dest='config_cache',
+                        action='store_true', default=False,
+                        help='reuse the parsed configuration file across '
+                             'runs as long as it is unchanged.')
+    parser.add_argument('--changed-since', dest='changed_since',
+                        metavar='REF', default=None,
+                        help='only run builds affected by the changes since '
+                             'git REF, and the builds depending on them.')
+    parser.add_argument('--report', dest='report', metavar='FILE',
+                        default=None,
+                        help='write timings of the phases of every build to '
+                             'FILE, as json lines.')
+    parser.add_argument('--trace', dest='trace', metavar='FILE',
+                        default=None,
+                        help='write the phases of every build to FILE as '
+                             'chrome trace events.')
+    parser.add_argument('--docker-clients', dest='docker_clients', type=int,
+                        default=None,
+                        help='number of connections to the docker daemon of '
+                             'each kind, defaults to the number of jobs.')
+    parser.add_argument('--build-timeout', dest='build_timeout', type=int,
+                        default=utils.DOCKER_TIMEOUTS['build'],
+                        metavar='SECONDS',
+                        help='how long a build may wait for output of the '
+                             'docker daemon.')
+    parser.add_argument('--push-timeout', dest='push_timeout', type=int,
+                        default=utils.DOCKER_TIMEOUTS['push'],
+                        metavar='SECONDS',
+                        help='how long a push may wait for progress of the '
+                             'docker daemon.')
+    parser.add_argument('-w', '--watch', default=False, action='store_true',
+                        help='keep watching the build contexts, and rebuild '
+                             'the builds affected by changes.')
     return parser
 
 
+def _run_build(builds, name, push_queue=None):
+    build = builds[name]
+    if build.rewrite_from_name:
+        parent = builds[build.rewrite_from_name]
+        build.rewrite_from = parent.non_labeled_image
+        build.rewrite_from_platforms = parent.platform_images()
+    # left unset by a failure, so that watching builds it again
+    build.final_image = None
+    try:
+        with report.Recorder.phase(name, 'total'):
+            build.build()
+            build.tag()
+    except BuildFailed as e:
+        LOG.error("failed to build %s: %s", build.name, e.message)
+        raise
+    except Exception:
+        LOG.exception("failed to build %s", build.name)
+        raise
+
+    if push_queue is not None:
+        push_queue.submit(name)
+
+
+def _push_build(build, jobs=1):
+    try:
+        build.push(jobs)
+    except PushFailed as e:
+        LOG.error("failed to push %s: %s", build.name, e.message)
+        raise
+    except Exception:
+        LOG.exception("failed to push %s", build.name)
+        raise
+
+
+def _affected_wants(config, builds, wants, args):
+    paths = changes.changed_files(args.changed_since)
+    affected = changes.affected_builds(
+        [builds[name] for name in wants], paths, args.dmakefile)
+    affected |= config.graph.descendants(affected)
+    affected &= wants
+    LOG.info("builds affected by changes since %s: %s", args.changed_since,
+             ", ".join(n for n in config.order if n in affected) or "none")
+    return utils.expand_wants(config.graph, affected)
+
+
+def _run(config, builds, order, args):
+    """build, and push unless told not to, the builds of `order`"""
+    push_queue = None
+    if not args.nopush:
+        push_queue = PushQueue(
+            lambda name: _push_build(builds[name], args.push_jobs))
+
+    for name in order:
+        builds[name].share_context()
+    scheduler = Scheduler(order, config.graph, jobs=args.jobs)
+    try:
+        failures = scheduler.run(
+            lambda name: _run_build(builds, name, push_queue))
+    finally:
+        push_failures = push_queue.join() if push_queue is not None else []
+        BuildCache.save()
+        ContextScanner.save()
+
+    utils.Summary.report(LOG)
+    if args.report:
+        report.Recorder.write_report(args.report, utils.Summary.counts())
+    if args.trace:
+        report.Recorder.write_trace(args.trace)
+    if args.cache_stats:
+        LOG.info("build cache: %s", BuildCache.stats())
+        LOG.info("context scans: %.1fMB rehashed",
+                 ContextScanner.hashed_bytes / 1024.0 / 1024.0)
+
+    if push_failures:
+        LOG.error("failed to push %d build(s): %s", len(push_failures),
+                  ", ".join(name for name, _ in push_failures))
+    if failures or push_failures:
+        return 1
+
+
+def _without_outputs(paths, builds):
+    """`paths` less the ones docker-make wrote itself, extracts of builds"""
+    outputs = [os.path.relpath(dst).replace(os.sep, '/').rstrip('/')
+               for build in builds.values()
+               for dst in build.extract_destinations()]
+    kept = set()
+    for path in paths:
+        if any(part.startswith(dmake.build.EXTRACT_PREFIX)
+               for part in path.split('/')):
+            continue
+        if any(path == output or path.startswith(output + '/')
+               for output in outputs):
+            continue
+        kept.add(path)
+    return kept
+
+
+def _watch(config, builds, built, args, status=None):
+    """rebuild the builds affected by changes of their contexts, until
+    interrupted, and return the status of the last run.
+
+    the configuration, the docker clients and the template args of the first
+    run are reused, a change of the dmakefile needs a restart.
+    """
+    # builds which failed, or were skipped, are built again on any change
+    pending = set(name for name in built if builds[name].final_image is None)
+    roots = watch.watch_roots(build.context for build in builds.values())
+    # the dockerignore rules of the first run are kept too
+    contexts = [(build.context, changes.ignore_rules(build))
+                for build in builds.values()]
+    watcher = watch.watcher(roots, [args.dmakefile], contexts)
+    dmakefile = os.path.relpath(args.dmakefile).replace(os.sep, '/')
+    LOG.info("watching %s for changes, ctrl-c to stop", ", ".join(
+        os.path.relpath(root) for root in roots))
+    try:
+        while True:
+            paths = _without_outputs(watch.wait(watcher), builds)
+            if dmakefile in paths:
+                LOG.warning("%s changed, restart docker-make to use it",
+                            args.dmakefile)
+                paths.discard(dmakefile)
+            if not paths:
+                continue
+            affected = changes.affected_builds(builds.values(), paths)
+            affected |= config.graph.descendants(affected)
+            affected &= set(builds)
+            affected |= pending
+            if not affected:
+                continue
+            order = [name for name in config.order if name in affected]
+            LOG.info("rebuilding builds affected by changes: %s",
+                     ", ".join(order))
+            ContextScanner.forget_scans()
+            SharedContexts.reset()
+            utils.Summary.reset()
+            # a run interrupted counts as failed
+            status = 1
+            status = _run(config, builds, order, args)
+            pending = set(name for name in order
+                          if builds[name].final_image is None)
+    except KeyboardInterrupt:
+        LOG.info("stopped watching")
+    finally:
+        watcher.close()
+    return status
+
+
 def _main():
     global LOG
 
@@ -44,10 +255,14 @@ def _main():
 
     load_dotenv()
 
+    utils.DockerClients.size = (args.docker_clients or
+                                max(args.jobs, args.push_jobs))
+    utils.DockerClients.timeouts['build'] = args.build_timeout
+    utils.DockerClients.timeouts['push'] = args.push_timeout
+
     try:
-        template_args.init_tag_names(args.dmakefile)
-        builds_order, builds_dict = utils.get_sorted_build_dicts_from_yaml(
-            args.dmakefile)
+        config = dmake_config.load(args.dmakefile, args.config_cache)
+        template_args.init_tag_names(config)
     except ConfigurationError as e:
         LOG.error("failed to parse %s: %s", args.dmakefile, e.message)
         return 1
@@ -55,24 +270,43 @@ def _main():
         LOG.error("wrong configuration: %s", e.message)
         return 1
     except DmakeError as e:
-        LOG.eror(e.message)
+        LOG.error(e.message)
         return 1
 
-    builds = {}
-    for name in builds_order:
-        if (args.remove):
-            builds_dict[name]['remove_intermediate'] = args.remove
-        builds[name] = dmake.build.Build(name=name, **builds_dict[name])
-
+    builds_order = config.order
     if args.builds:
         try:
-            wants = utils.expand_wants(builds, args.builds)
+            wants = utils.expand_wants(config.graph, args.builds)
         except BuildUnDefined as e:
             LOG.error("No such build:  %s", e.build)
             return 1
     else:
         wants = set(builds_order)
 
+    # only the wanted builds are made, like one build of a large matrix
+    builds = {}
+    for name in builds_order:
+        if name not in wants:
+            continue
+        kwargs = config.builds[name].kwargs()
+        if (args.remove):
+            kwargs['remove_intermediate'] = args.remove
+        kwargs['context_compression'] = args.context_compression
+        kwargs['force_push'] = args.force_push
+        kwargs['platform_jobs'] = args.platform_jobs
+        builds[name] = dmake.build.Build(name=name, **kwargs)
+
+    if args.changed_since:
+        try:
+            wants = _affected_wants(config, builds, wants, args)
+        except DmakeError as e:
+            LOG.error(e.message)
+            return 1
+        if not wants:
+            LOG.info("no build affected by changes since %s",
+                     args.changed_since)
+            return
+
     if args.dryrun:
         for name in builds_order:
             if name not in wants:
@@ -81,31 +315,13 @@ def _main():
             build.dryrun()
         return
 
-    for name in builds_order:
-        if name not in wants:
-            continue
-        build = builds[name]
-        if build.rewrite_from:
-            build.rewrite_from = builds[build.rewrite_from].non_labeled_image
-        try:
-            build.build()
-            build.tag()
-        except BuildFailed as e:
-            LOG.error("failed to build %s: %s", build.name, e.message)
-            return 1
-        except Exception:
-            LOG.exception("failed to build %s", build.name)
-            return 1
-
-        if not args.nopush:
-            try:
-                build.push()
-            except PushFailed as e:
-                LOG.error("failed to push %s: %s", build.name, e.message)
-                return 1
-            except Exception as e:
-                LOG.exception("failed to push %s", build.name)
-                return 1
+    BuildCache.enabled = args.cache_db
+    report.Recorder.enabled = bool(args.report or args.trace)
+    order = [name for name in builds_order if name in wants]
+    status = _run(config, builds, order, args)
+    if args.watch:
+        return _watch(config, builds, order, args, status)
+    return status
 
 
 def main():
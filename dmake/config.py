@@ -0,0 +1,246 @@
+import os
+import re
+import hashlib
+import logging
+import cPickle as pickle
+
+import yaml
+
+from dmake import cache
+from dmake import utils
+from dmake.graph import BuildGraph
+from dmake.errors import *  # noqa
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+LOG = logging.getLogger(__name__)
+CONFIG_CACHE_VERSION = 4
+EXTRACT_CHECKSUM_PATTERN = re.compile(r'^(.*):sha256=([0-9a-fA-F]{64})$')
+PLATFORM_PATTERN = re.compile(r'^[a-z0-9]+/[a-z0-9_]+(/[a-z0-9]+)?$')
+BUILD_OPTIONS = ('context', 'dockerfile', 'buildargs', 'dockerignore',
+                 'labels', 'depends_on', 'extract', 'pushes', 'rewrite_from',
+                 'platforms', 'cache_from', 'cache_to')
+
+
+class PushRule(object):
+    """`<push_mode>=<repo>:<tag_template>`"""
+
+    __slots__ = ('mode', 'repo', 'tag_template')
+
+    def __init__(self, mode, repo, tag_template):
+        self.mode = mode
+        self.repo = repo
+        self.tag_template = tag_template
+
+    def __iter__(self):
+        return iter((self.mode, self.repo, self.tag_template))
+
+    @classmethod
+    def parse(cls, line):
+        try:
+            push_mode, rest = line.split('=', 1)
+            repo, tag_template = rest.rsplit(':', 1)
+        except ValueError:
+            raise ConfigurationError("wrong format for push %s" % line)
+        return cls(push_mode, repo, tag_template)
+
+
+class ExtractRule(object):
+    """`<src>:<dst>[:sha256=<hex>]`, dst is relative to the build context"""
+
+    __slots__ = ('src', 'dst', 'unpack', 'sha256')
+
+    def __init__(self, src, dst, unpack=False, sha256=None):
+        self.src = src
+        self.dst = dst
+        self.unpack = unpack
+        self.sha256 = sha256
+
+    @classmethod
+    def parse(cls, item):
+        try:
+            src, dst = item.split(':', 1)
+        except ValueError:
+            raise ConfigurationError('invalid extract rule: %s' % item)
+        checksum = None
+        match = EXTRACT_CHECKSUM_PATTERN.match(dst)
+        if match is not None:
+            dst, checksum = match.group(1), match.group(2).lower()
+        return cls(src, dst, dst.endswith('/'), checksum)
+
+
+class TagNameConfig(object):
+    """an item of `tag-names`"""
+
+    __slots__ = ('name', 'type', 'value', 'timeout')
+
+    def __init__(self, name, type, value, timeout=None):
+        self.name = name
+        self.type = type
+        self.value = value
+        self.timeout = timeout
+
+    @classmethod
+    def from_dict(cls, data):
+        """None if `data` misses some essential key"""
+        for key in ('name', 'type', 'value'):
+            if key not in data:
+                LOG.warn("%s absent in %s", key, data)
+                return None
+        return cls(data['name'], data['type'], data['value'],
+                   data.get('timeout'))
+
+
+class BuildConfig(object):
+    __slots__ = ('name',) + BUILD_OPTIONS
+
+    def __init__(self, name, context, dockerfile, buildargs=None,
+                 dockerignore=None, labels=None, depends_on=None,
+                 extract=None, pushes=None, rewrite_from=None,
+                 platforms=None, cache_from=None, cache_to=None):
+        self.name = name
+        self.context = context
+        self.dockerfile = dockerfile
+        self.buildargs = buildargs
+        self.dockerignore = dockerignore or []
+        self.labels = labels or []
+        self.depends_on = depends_on or []
+        self.extract = [ExtractRule.parse(item) for item in extract or []]
+        self.pushes = [PushRule.parse(line) for line in pushes or []]
+        self.rewrite_from = rewrite_from
+        self.platforms = platforms or []
+        self.cache_from = cache_from or []
+        self.cache_to = cache_to
+
+    @classmethod
+    def from_dict(cls, name, data):
+        if not isinstance(data, dict):
+            raise ValidateError("build %s should be a dict" % name)
+        unknown = set(data) - set(BUILD_OPTIONS)
+        if unknown:
+            raise ValidateError("unknown options of build %s: %s" %
+                                (name, ', '.join(sorted(unknown))))
+        for key in ('context', 'dockerfile'):
+            if key not in data:
+                raise ValidateError("%s absent in build %s" % (key, name))
+        platforms = data.get('platforms') or []
+        if not isinstance(platforms, list):
+            raise ValidateError("platforms of build %s should be a list" %
+                                name)
+        for platform in platforms:
+            if not PLATFORM_PATTERN.match(str(platform)):
+                raise ValidateError("invalid platform of build %s: %s, "
+                                    "expected os/architecture[/variant]" %
+                                    (name, platform))
+        if len(set(platforms)) != len(platforms):
+            raise ValidateError("duplicated platforms in build %s" % name)
+        cache_from = data.get('cache_from') or []
+        if (not isinstance(cache_from, list) or
+                not all(isinstance(i, basestring) for i in cache_from)):
+            raise ValidateError("cache_from of build %s should be a list of "
+                                "images" % name)
+        if not isinstance(data.get('cache_to') or '', basestring):
+            raise ValidateError("cache_to of build %s should be an image" %
+                                name)
+        return cls(name, **data)
+
+    def kwargs(self):
+        """keyword arguments of `dmake.build.Build`"""
+        kwargs = dict((key, getattr(self, key)) for key in BUILD_OPTIONS)
+        # Build adds .dockerignore to the list
+        kwargs['dockerignore'] = list(self.dockerignore)
+        return kwargs
+
+
+class Config(object):
+    """validated content of a .docker-make.yml"""
+
+    __slots__ = ('filename', 'builds', 'graph', 'order', 'tag_names')
+
+    def __init__(self, filename, builds, tag_names):
+        self.filename = filename
+        self.builds = builds
+        self.graph = BuildGraph.from_builds(builds.values())
+        self.order = self.graph.topological_order()
+        self.tag_names = tag_names
+
+    @classmethod
+    def from_dict(cls, data, filename=None):
+        if not isinstance(data, dict):
+            raise ValidateError("configuration should be a dict")
+        data = dict(data, builds=utils.expand_matrix(data.get('builds')))
+        utils.validate(data)
+        builds = dict((name, BuildConfig.from_dict(name, build))
+                      for name, build in data['builds'].iteritems())
+        tag_names = []
+        for item in data.get('tag-names') or []:
+            tag_name = TagNameConfig.from_dict(item)
+            if tag_name is not None:
+                tag_names.append(tag_name)
+        return cls(filename, builds, tag_names)
+
+
+def _cache_path(filename):
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(cache.cache_dir(), 'configs', key + '.pickle')
+
+
+def _read_cache(filename, stat):
+    """the cached entry of `filename`, and whether its mtime still matches"""
+    try:
+        with open(_cache_path(filename), 'rb') as f:
+            entry = pickle.load(f)
+    except Exception:
+        return None, False
+    if entry.get('version') != CONFIG_CACHE_VERSION:
+        return None, False
+    return entry, (entry['mtime'], entry['size']) == (stat.st_mtime,
+                                                      stat.st_size)
+
+
+def _write_cache(filename, stat, digest, config):
+    entry = {'version': CONFIG_CACHE_VERSION, 'mtime': stat.st_mtime,
+             'size': stat.st_size, 'digest': digest, 'config': config}
+    cache.save_file(_cache_path(filename),
+                    lambda f: pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL),
+                    'config cache', 'wb')
+
+
+def _parse(content, filename):
+    try:
+        data = yaml.load(content, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        err_msg = getattr(e, '__module__', '') + '.' + e.__class__.__name__
+        raise ConfigurationError(u"{}: {}".format(err_msg, e))
+    return Config.from_dict(data, filename)
+
+
+def load(filename='.docker-make.yml', use_cache=False):
+    """load and validate a configuration file.
+
+    with `use_cache`, the validated model is pickled next to the build cache
+    and reused as long as the file keeps its mtime, or its content.
+    """
+    try:
+        stat = os.stat(filename)
+        entry, fresh = (_read_cache(filename, stat) if use_cache
+                        else (None, False))
+        if fresh:
+            return entry['config']
+        with open(filename, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError) as e:
+        raise ConfigurationError(u"{}: {}".format(e.__class__.__name__, e))
+
+    digest = hashlib.sha256(content).hexdigest()
+    if entry is not None and entry['digest'] == digest:
+        config = entry['config']
+    else:
+        config = _parse(content, filename)
+    if use_cache:
+        _write_cache(filename, stat, digest, config)
+    return config
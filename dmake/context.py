@@ -0,0 +1,602 @@
+import io
+import os
+import re
+import json
+import stat
+import time
+import zlib
+import hashlib
+import logging
+import tarfile
+import tempfile
+import itertools
+import threading
+
+from dmake.cache import cache_dir, save_file
+
+
+LOG = logging.getLogger(__name__)
+INDEX_VERSION = 1
+# files modified this close to a scan may change again within the mtime
+# granularity of the file system, so their digests are not remembered.
+MTIME_SAFETY = 2
+
+
+def _translate(pattern):
+    i, n, res = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i + 1] == '*':
+                i += 1
+                # `**/` matches no directory too
+                if pattern[i:i + 1] == '/':
+                    i += 1
+                    res.append('(.*/)?')
+                else:
+                    res.append('.*')
+            else:
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i)
+            if j == -1:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j]
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff.replace('\\', '\\\\'))
+                i = j + 1
+        elif c == '\\' and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+    return re.compile(''.join(res) + '$')
+
+
+class IgnoreRules(object):
+    """.dockerignore rules, later rules take precedence over earlier ones."""
+
+    def __init__(self, patterns, always_include=()):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            exception = pattern.startswith('!')
+            if exception:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern.strip('/')).replace(os.sep,
+                                                                   '/')
+            if pattern == '.':
+                continue
+            self.rules.append((pattern, pattern.count('/') + 1,
+                               _translate(pattern), exception))
+        self.exceptions = [rule for rule in self.rules if rule[3]]
+        self.always_include = set(always_include)
+
+    @staticmethod
+    def _match(path, rule):
+        pattern, depth, regex, _ = rule
+        if regex.match(path):
+            return True
+        # a pattern matching a parent directory matches its content too
+        parts = path.split('/')
+        if '**' in pattern:
+            return any(regex.match('/'.join(parts[:n]))
+                       for n in range(1, len(parts)))
+        if len(parts) > depth:
+            return regex.match('/'.join(parts[:depth])) is not None
+        return False
+
+    def excluded(self, path):
+        if path in self.always_include:
+            return False
+        result = False
+        for rule in self.rules:
+            if rule[3] == result and self._match(path, rule):
+                result = not rule[3]
+        return result
+
+    def may_include_below(self, directory):
+        """whether an excluded directory may still contain included files"""
+        prefix = directory + '/'
+        if any(p.startswith(prefix) for p in self.always_include):
+            return True
+        depth = directory.count('/') + 1
+        for pattern, _, _, _ in self.exceptions:
+            if '**' in pattern:
+                return True
+            parts = pattern.split('/')
+            if len(parts) > depth and _translate(
+                    '/'.join(parts[:depth])).match(directory):
+                return True
+        return False
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class ContextScan(object):
+    """files of a build context, after applying ignore rules.
+
+    `entries` is a sorted list of (path, mode, size, digest), `digest` being
+    the sha256 of a regular file, or the target of a symlink.
+    """
+
+    def __init__(self, root, entries):
+        self.root = root
+        self.entries = entries
+        self.file_count = sum(1 for e in entries if stat.S_ISREG(e[1]))
+        self.total_bytes = sum(e[2] for e in entries if stat.S_ISREG(e[1]))
+        self._digest = None
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            h = hashlib.sha256()
+            for path, mode, _, digest in self.entries:
+                h.update('%s\0%o\0%s\0' % (path, mode, digest or ''))
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def __str__(self):
+        return "%d files, %.1fMB" % (self.file_count,
+                                     self.total_bytes / 1024.0 / 1024.0)
+
+
+class _ContextScanner(object):
+    """scan build contexts once per run, rehashing changed files only.
+
+    digests of files are remembered in an index per context root, keyed by
+    path, and only trusted as long as size, mtime and inode are unchanged.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._scans = {}
+        self._indexes = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hashed_bytes = 0
+
+    def _index_path(self, root):
+        directory = self.directory or os.path.join(cache_dir(), 'contexts')
+        return os.path.join(directory,
+                            hashlib.sha1(root).hexdigest() + '.json')
+
+    def _index(self, root):
+        if root not in self._indexes:
+            try:
+                with open(self._index_path(root)) as f:
+                    data = json.load(f)
+                if data.get('version') != INDEX_VERSION:
+                    raise ValueError('index version changed')
+                self._indexes[root] = data['files']
+            except (IOError, ValueError, KeyError):
+                self._indexes[root] = {}
+            self._seen[root] = {}
+        return self._indexes[root], self._seen[root]
+
+    def scan(self, root, patterns, dockerfiles=('Dockerfile',)):
+        """scan `root`, `dockerfiles` are included despite `patterns`."""
+        root = os.path.abspath(root)
+        if isinstance(dockerfiles, basestring):
+            dockerfiles = (dockerfiles,)
+        dockerfiles = tuple(sorted(set(dockerfiles)))
+        key = (root, tuple(patterns), dockerfiles)
+        with self._lock:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._scans:
+                start = time.time()
+                scan = self._scan(root, patterns, dockerfiles)
+                LOG.debug("scanned %s in %.3fs: %s", root,
+                          time.time() - start, scan)
+                self._scans[key] = scan
+            return self._scans[key]
+
+    def extend(self, scan, paths):
+        """`scan` with `paths` added, as if they had been always included"""
+        known = set(entry[0] for entry in scan.entries)
+        with self._lock:
+            index, seen = self._index(scan.root)
+        now = time.time()
+        entries = []
+        for path in paths:
+            path = os.path.normpath(path).replace(os.sep, '/')
+            full_path = os.path.join(scan.root, path)
+            if path in known or not os.path.lexists(full_path):
+                continue
+            st = os.lstat(full_path)
+            if stat.S_ISLNK(st.st_mode):
+                entries.append((path, st.st_mode, 0, os.readlink(full_path)))
+            elif stat.S_ISREG(st.st_mode):
+                digest = self._file_digest(full_path, st, index, seen, now)
+                entries.append((path, st.st_mode, st.st_size, digest))
+        if not entries:
+            return scan
+        return ContextScan(scan.root, sorted(scan.entries + entries))
+
+    def forget_scans(self, path=None):
+        """scan again from now on the contexts containing `path`, or all of
+        them, for a new run in the same process. the digests of unchanged
+        files are kept.
+        """
+        with self._lock:
+            if path is None:
+                self._scans = {}
+                return
+            path = os.path.abspath(path)
+            for key in list(self._scans):
+                if _inside(path, key[0]):
+                    del self._scans[key]
+
+    def _scan(self, root, patterns, dockerfiles):
+        always_include = [os.path.normpath(d).replace(os.sep, '/')
+                          for d in dockerfiles]
+        rules = IgnoreRules(patterns,
+                            always_include=always_include + ['.dockerignore'])
+        with self._lock:
+            index, seen = self._index(root)
+        now = time.time()
+        entries = []
+
+        for parent, dirs, files in os.walk(root):
+            rel_parent = os.path.relpath(parent, root).replace(os.sep, '/')
+            rel_parent = '' if rel_parent == '.' else rel_parent + '/'
+
+            kept_dirs = []
+            for d in sorted(dirs):
+                path = rel_parent + d
+                full_path = os.path.join(parent, d)
+                excluded = rules.excluded(path)
+                if excluded and not rules.may_include_below(path):
+                    continue
+                if os.path.islink(full_path):
+                    files.append(d)
+                    continue
+                kept_dirs.append(d)
+                if not excluded:
+                    entries.append((path, os.lstat(full_path).st_mode, 0,
+                                    None))
+            dirs[:] = kept_dirs
+
+            for name in files:
+                path = rel_parent + name
+                if rules.excluded(path):
+                    continue
+                full_path = os.path.join(parent, name)
+                st = os.lstat(full_path)
+                if stat.S_ISLNK(st.st_mode):
+                    entries.append((path, st.st_mode, 0,
+                                    os.readlink(full_path)))
+                elif stat.S_ISREG(st.st_mode):
+                    digest = self._file_digest(full_path, st, index, seen,
+                                               now)
+                    entries.append((path, st.st_mode, st.st_size, digest))
+        entries.sort()
+        return ContextScan(root, entries)
+
+    def _file_digest(self, full_path, st, index, seen, now):
+        stamp = [st.st_size, st.st_mtime, st.st_ino]
+        entry = index.get(full_path)
+        if entry is not None and entry[:3] == stamp:
+            seen[full_path] = entry
+            return entry[3]
+
+        h = hashlib.sha256()
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.hashed_bytes += st.st_size
+        if st.st_mtime < now - MTIME_SAFETY:
+            seen[full_path] = stamp + [digest]
+        return digest
+
+    def save(self):
+        """persist the indexes, keeping only the files seen in this run."""
+        for root, seen in self._seen.items():
+            if not seen:
+                continue
+            data = {'version': INDEX_VERSION, 'root': root, 'files': seen}
+            save_file(self._index_path(root),
+                      lambda f: json.dump(data, f), 'context index')
+
+
+ContextScanner = _ContextScanner()
+
+
+CHUNK_SIZE = 1 << 20
+SPOOL_MEMORY_SIZE = 32 << 20
+
+
+def _file_chunks(full_path, size):
+    remaining = size
+    with open(full_path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    if remaining:
+        LOG.warn("%s shrank while being sent, padding it with zeros",
+                 full_path)
+        while remaining > 0:
+            n = min(CHUNK_SIZE, remaining)
+            remaining -= n
+            yield b'\0' * n
+
+
+def _tar_member(tarinfo, chunks):
+    yield tarinfo.tobuf(tarfile.GNU_FORMAT)
+    for chunk in chunks:
+        yield chunk
+    _, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder:
+        yield b'\0' * (tarfile.BLOCKSIZE - remainder)
+
+
+def tar_members(scan):
+    """tar the files of a scan, member by member, without an end marker."""
+    archive = tarfile.open(fileobj=io.BytesIO(), mode='w')
+    for path in (entry[0] for entry in scan.entries):
+        full_path = os.path.join(scan.root, path)
+        tarinfo = archive.gettarinfo(full_path, arcname=path)
+        if tarinfo is None:
+            # sockets can not be added to an archive
+            continue
+        chunks = ()
+        if tarinfo.isreg():
+            chunks = _file_chunks(full_path, tarinfo.size)
+        for data in _tar_member(tarinfo, chunks):
+            yield data
+
+
+def tar_files(root, files):
+    """tar in-memory files, given as (path, content), keeping the mode and
+    mtime of the files they replace under `root`.
+    """
+    for path, content in files:
+        tarinfo = tarfile.TarInfo(path)
+        tarinfo.size = len(content)
+        try:
+            st = os.stat(os.path.join(root, path))
+            tarinfo.mode, tarinfo.mtime = stat.S_IMODE(st.st_mode), st.st_mtime
+        except OSError:
+            tarinfo.mode, tarinfo.mtime = 0o644, time.time()
+        for data in _tar_member(tarinfo, (content,)):
+            yield data
+
+
+def tar_end():
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+def _buffered(chunks):
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _encoded(chunks, compression):
+    chunks = _buffered(chunks)
+    if compression == 'gzip':
+        chunks = _gzipped(chunks)
+    return chunks
+
+
+def _encoded_overrides(root, overrides, compression):
+    if not overrides:
+        return ()
+    return _encoded(tar_files(root, overrides), compression)
+
+
+def stream_context(scan, compression=None, overrides=None):
+    """generate the tar archive of a build context while reading it.
+
+    `overrides` are in-memory files as (path, content), appended after the
+    files of the context, so that they replace them on extraction.
+
+    members and the end of the archive are encoded separately, which allows
+    to replay the members of a shared context, see `SharedContexts`.
+    gzip decoders of docker, like most, read concatenated gzip streams.
+    """
+    return itertools.chain(
+        _encoded(tar_members(scan), compression),
+        _encoded_overrides(scan.root, overrides, compression),
+        _encoded(tar_end(), compression))
+
+
+class _ContextGroup(object):
+    def __init__(self, root, patterns):
+        self.root = root
+        self.patterns = patterns
+        self.dockerfiles = set()
+        self.registered = 0
+        self.users = 0
+        self.spool = None
+        self.spool_compression = None
+        self.spooling = False
+        self.spooled = threading.Event()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def _tee(self, chunks, spool, generation, spooled):
+        try:
+            for chunk in chunks:
+                spool.write(chunk)
+                yield chunk
+        except BaseException:
+            spool.close()
+            spool = None
+            raise
+        finally:
+            with self.lock:
+                # an archive of a context changed meanwhile is not kept
+                if generation == self.generation:
+                    self.spool = spool
+            spooled.set()
+
+    def invalidate(self):
+        """archive the context again for the next build using it. a spool
+        being replayed is left to the garbage collector.
+        """
+        with self.lock:
+            self.generation += 1
+            self.spool = None
+            self.spooling = False
+            self.spooled.set()
+            self.spooled = threading.Event()
+
+    def _replay(self, spool):
+        position = 0
+        while True:
+            with self.lock:
+                spool.seek(position)
+                chunk = spool.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+    def members(self, scan, compression):
+        """encoded archive members, read from the context once per run."""
+        with self.lock:
+            first = not self.spooling
+            self.spooling = True
+            generation, spooled = self.generation, self.spooled
+        if first:
+            self.spool_compression = compression
+            spool = tempfile.SpooledTemporaryFile(SPOOL_MEMORY_SIZE)
+            return self._tee(_encoded(tar_members(scan), compression), spool,
+                             generation, spooled)
+
+        spooled.wait()
+        with self.lock:
+            spool = self.spool
+        if spool is None or self.spool_compression != compression:
+            return _encoded(tar_members(scan), compression)
+        LOG.debug("replaying the archive of %s", self.root)
+        return self._replay(spool)
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users <= 0 and self.spool is not None:
+                self.spool.close()
+                self.spool = None
+
+
+class _SharedContexts(object):
+    """share the archive of a context among the builds of a run using it.
+
+    builds register the context root and ignore rules they use before the
+    run, contexts registered more than once are read and archived once,
+    and the archive is kept in a spooled temporary file to be replayed.
+
+    the shared archive has the files the ignore rules keep, a Dockerfile
+    they exclude is added to the context of its own build only.
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """forget the contexts registered, for a new run"""
+        with self._lock:
+            self._groups = {}
+
+    def _group(self, root, patterns):
+        return self._groups.get((os.path.abspath(root), tuple(patterns)))
+
+    def register(self, root, patterns, dockerfile):
+        root = os.path.abspath(root)
+        with self._lock:
+            group = self._groups.setdefault((root, tuple(patterns)),
+                                            _ContextGroup(root, patterns))
+            group.dockerfiles.add(dockerfile)
+            group.registered += 1
+            group.users += 1
+
+    def changed(self, path):
+        """`path` was written during the run: the contexts containing it are
+        scanned and archived again for the builds using them later.
+        """
+        path = os.path.abspath(path)
+        ContextScanner.forget_scans(path)
+        with self._lock:
+            groups = [group for group in self._groups.values()
+                      if _inside(path, group.root)]
+        for group in groups:
+            group.invalidate()
+
+    def _shared_scan(self, root, patterns):
+        return ContextScanner.scan(root, patterns, ())
+
+    def scan(self, root, patterns, dockerfile):
+        group = self._group(root, patterns)
+        if group is None or dockerfile not in group.dockerfiles:
+            return ContextScanner.scan(root, patterns, dockerfile)
+        return ContextScanner.extend(self._shared_scan(root, patterns),
+                                     [dockerfile])
+
+    def stream(self, root, patterns, dockerfile, compression=None,
+               overrides=None):
+        group = self._group(root, patterns)
+        if (group is None or group.registered < 2 or
+                dockerfile not in group.dockerfiles):
+            return stream_context(self.scan(root, patterns, dockerfile),
+                                  compression, overrides)
+
+        shared = self._shared_scan(root, patterns)
+        scan = self.scan(root, patterns, dockerfile)
+        # the Dockerfile of this build, when the ignore rules exclude it
+        shared_entries = set(shared.entries)
+        own = [entry for entry in scan.entries
+               if entry not in shared_entries]
+
+        def chunks():
+            try:
+                for chunk in group.members(shared, compression):
+                    yield chunk
+                if own:
+                    for chunk in _encoded(tar_members(ContextScan(
+                            shared.root, own)), compression):
+                        yield chunk
+                for chunk in _encoded_overrides(scan.root, overrides,
+                                                compression):
+                    yield chunk
+                for chunk in _encoded(tar_end(), compression):
+                    yield chunk
+            finally:
+                group.release()
+        return chunks()
+
+
+SharedContexts = _SharedContexts()
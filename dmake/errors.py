@@ -18,6 +18,10 @@ class BuildFailed(DmakeError):
     pass
 
 
+class ExtractFailed(BuildFailed):
+    pass
+
+
 class PushFailed(DmakeError):
     pass
 
@@ -0,0 +1,97 @@
+import heapq
+from collections import deque
+
+from dmake.errors import *  # noqa
+
+
+class BuildGraph(object):
+    """dependencies between builds, with both directions indexed.
+
+    `dependencies` maps a build's name to the names it waits for, i.e. its
+    `depends_on` and `rewrite_from`, and `dependents` is the reverse.
+    """
+
+    __slots__ = ('dependencies', 'dependents')
+
+    def __init__(self, dependencies):
+        self.dependencies = {}
+        self.dependents = {}
+        for name, deps in dependencies.iteritems():
+            self.dependencies[name] = set(deps)
+            self.dependents.setdefault(name, set())
+            for dep in deps:
+                self.dependents.setdefault(dep, set()).add(name)
+        for name in self.dependents:
+            self.dependencies.setdefault(name, set())
+
+    @classmethod
+    def from_builds(cls, builds):
+        """graph of objects having `name`, `depends_on` and `rewrite_from`"""
+        dependencies = {}
+        for build in builds:
+            deps = set(build.depends_on or [])
+            if build.rewrite_from:
+                deps.add(build.rewrite_from)
+            dependencies[build.name] = deps
+        return cls(dependencies)
+
+    def __contains__(self, name):
+        return name in self.dependencies
+
+    def __len__(self):
+        return len(self.dependencies)
+
+    def topological_order(self):
+        """names sorted so that dependencies come first, ties are broken by
+        name to keep the order stable across runs.
+        """
+        waiting = dict((name, len(deps))
+                       for name, deps in self.dependencies.iteritems())
+        ready = [name for name, count in waiting.iteritems() if not count]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            name = heapq.heappop(ready)
+            order.append(name)
+            for dependent in self.dependents[name]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    heapq.heappush(ready, dependent)
+
+        if len(order) < len(waiting):
+            self._raise_cycle(set(n for n, count in waiting.iteritems()
+                                  if count))
+        return order
+
+    def _raise_cycle(self, remaining):
+        # every remaining node waits for some other remaining node, so
+        # following dependencies from any of them runs into a cycle
+        name = min(remaining)
+        path, seen = [], {}
+        while name not in seen:
+            seen[name] = len(path)
+            path.append(name)
+            name = min(d for d in self.dependencies[name] if d in remaining)
+        cycle = path[seen[name]:] + [name]
+        if len(cycle) == 2:
+            raise DependencyError('A build can not depend on itself: %s' %
+                                  name)
+        raise DependencyError('Circular dependency: %s' % ' -> '.join(cycle))
+
+    def _reachable(self, names, edges):
+        result = set()
+        queue = deque(names)
+        while queue:
+            for n in edges[queue.popleft()]:
+                if n not in result:
+                    result.add(n)
+                    queue.append(n)
+        return result
+
+    def ancestors(self, names):
+        """builds the given builds depend on, directly or not"""
+        return self._reachable(names, self.dependencies)
+
+    def descendants(self, names):
+        """builds depending on the given builds, directly or not"""
+        return self._reachable(names, self.dependents)
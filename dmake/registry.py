@@ -0,0 +1,147 @@
+"""the part of the docker registry http api v2 the docker daemon does not
+cover: looking up manifests of tags and putting manifest lists together.
+"""
+import re
+import json
+import logging
+import threading
+
+import requests
+from docker import auth as docker_auth
+
+from dmake.errors import *  # noqa
+
+
+LOG = logging.getLogger(__name__)
+MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+HUB_URL = 'https://registry-1.docker.io'
+CHALLENGE_PATTERN = re.compile(r'(\w+)="([^"]*)"')
+TIMEOUT = 60
+
+
+def split_platform(platform):
+    """`os/architecture[/variant]` as the platform of a manifest list"""
+    parts = platform.split('/')
+    result = {'os': parts[0], 'architecture': parts[1]}
+    if len(parts) > 2:
+        result['variant'] = parts[2]
+    return result
+
+
+class Registry(object):
+    """a registry, with the credentials of the docker configuration.
+
+    bearer tokens are asked for on the first `401` of each repo.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        if name == docker_auth.INDEX_NAME:
+            self.url = HUB_URL
+        elif name.split(':')[0] in ('localhost', '127.0.0.1'):
+            self.url = 'http://' + name
+        else:
+            self.url = 'https://' + name
+        self._session = requests.Session()
+        self._tokens = {}
+        self._basic = None
+
+    def _credentials(self):
+        config = docker_auth.resolve_authconfig(docker_auth.load_config(),
+                                                self.name) or {}
+        username = config.get('username') or config.get('Username')
+        password = config.get('password') or config.get('Password')
+        return (username, password) if username else None
+
+    def _request(self, method, repo, path, **kwargs):
+        url = '%s/v2/%s/%s' % (self.url, repo, path)
+        headers = kwargs.pop('headers', {})
+        for retry in (False, True):
+            if repo in self._tokens:
+                headers['Authorization'] = 'Bearer ' + self._tokens[repo]
+            try:
+                response = self._session.request(method, url, headers=headers,
+                                                 auth=self._basic,
+                                                 timeout=TIMEOUT, **kwargs)
+            except requests.RequestException as e:
+                raise PushFailed("failed to reach registry %s: %s" %
+                                 (self.name, e))
+            if response.status_code != 401 or retry:
+                break
+            self._authenticate(repo, response.headers.get(
+                'WWW-Authenticate', ''))
+        return response
+
+    def _authenticate(self, repo, challenge):
+        scheme = challenge.split(' ', 1)[0].lower()
+        if scheme == 'basic':
+            self._basic = self._credentials()
+            return
+        if scheme != 'bearer':
+            raise PushFailed("unsupported authentication of registry %s: %s" %
+                             (self.name, challenge))
+        params = dict(CHALLENGE_PATTERN.findall(challenge))
+        realm = params.pop('realm', None)
+        if not realm:
+            raise PushFailed("no realm in challenge of registry %s" %
+                             self.name)
+        params['scope'] = 'repository:%s:pull,push' % repo
+        try:
+            response = self._session.get(realm, params=params,
+                                         auth=self._credentials(),
+                                         timeout=TIMEOUT)
+            response.raise_for_status()
+            token = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise PushFailed("failed to authenticate to registry %s: %s" %
+                             (self.name, e))
+        self._tokens[repo] = token.get('token') or token.get('access_token')
+
+    def manifest(self, repo, reference):
+        """the descriptor of the manifest `reference` of `repo`"""
+        response = self._request('HEAD', repo, 'manifests/' + reference,
+                                 headers={'Accept': MANIFEST})
+        if response.status_code != 200:
+            raise PushFailed("no manifest %s:%s in registry %s (%d)" %
+                             (repo, reference, self.name,
+                              response.status_code))
+        return {
+            'mediaType': response.headers.get('Content-Type', MANIFEST),
+            'digest': response.headers['Docker-Content-Digest'],
+            'size': int(response.headers['Content-Length']),
+        }
+
+    def put_manifest_list(self, repo, tag, manifests):
+        """point `tag` of `repo` at a list of `(platform, descriptor)`, and
+        return the digest of the list.
+        """
+        body = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_LIST,
+            'manifests': [dict(descriptor, platform=split_platform(platform))
+                          for platform, descriptor in manifests],
+        })
+        response = self._request('PUT', repo, 'manifests/' + tag, data=body,
+                                 headers={'Content-Type': MANIFEST_LIST})
+        if response.status_code not in (200, 201):
+            raise PushFailed("failed to put manifest list %s:%s to registry "
+                             "%s (%d): %s" % (repo, tag, self.name,
+                                              response.status_code,
+                                              response.text[:200]))
+        return response.headers.get('Docker-Content-Digest')
+
+
+_registries = {}
+_lock = threading.Lock()
+
+
+def registry(repo):
+    """the registry of `repo`, and the name of the repo in it"""
+    name, path = docker_auth.resolve_repository_name(repo)
+    if name == docker_auth.INDEX_NAME and '/' not in path:
+        path = 'library/' + path
+    with _lock:
+        if name not in _registries:
+            _registries[name] = Registry(name)
+        return _registries[name], path
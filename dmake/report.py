@@ -0,0 +1,121 @@
+import json
+import time
+import logging
+import threading
+import contextlib
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _Recorder(object):
+    """timings and facts of the phases of each build of a run.
+
+    phases are recorded only when `enabled`, and written out as json lines
+    by `write_report`, or as chrome trace events by `write_trace`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self._phases = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, build, name, **facts):
+        """time the enclosed code as phase `name` of `build`, the dict
+        yielded takes facts known along the way, like bytes or layers.
+        """
+        if not self.enabled:
+            yield {}
+            return
+        start = time.time()
+        status = 'failed'
+        try:
+            yield facts
+            status = 'ok'
+        finally:
+            self.record(build, name, start, time.time() - start, status,
+                        **facts)
+
+    def record(self, build, name, start, duration, status='ok', **facts):
+        if not self.enabled:
+            return
+        thread = threading.current_thread().ident
+        with self._lock:
+            tid = self._threads.setdefault(thread, len(self._threads))
+            self._phases.append({
+                'build': build,
+                'phase': name,
+                'start': start - self.started,
+                'duration': duration,
+                'status': status,
+                'thread': tid,
+                'facts': facts,
+            })
+
+    def phases(self):
+        with self._lock:
+            return sorted(self._phases, key=lambda p: p['start'])
+
+    def write_report(self, filename, summary=None):
+        """a json line per phase, then one for the whole run."""
+        try:
+            self._write_report(filename, summary)
+        except IOError as e:
+            LOG.error("failed to write report %s: %s", filename, e)
+            return
+        LOG.info("report written to %s", filename)
+
+    def _write_report(self, filename, summary):
+        with open(filename, 'w') as f:
+            for phase in self.phases():
+                entry = dict(phase['facts'])
+                entry.update((k, v) for k, v in phase.items() if k != 'facts')
+                entry['type'] = 'phase'
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.write(json.dumps({
+                'type': 'run',
+                'duration': time.time() - self.started,
+                'summary': summary or {},
+            }, sort_keys=True) + '\n')
+
+    def write_trace(self, filename):
+        """chrome trace events, to be opened in chrome://tracing."""
+        events = []
+        for phase in self.phases():
+            args = dict(phase['facts'])
+            args['status'] = phase['status']
+            events.append({
+                'name': '%s: %s' % (phase['build'], phase['phase']),
+                'cat': phase['phase'],
+                'ph': 'X',
+                'ts': int(phase['start'] * 1e6),
+                'dur': int(phase['duration'] * 1e6),
+                'pid': 1,
+                'tid': phase['thread'],
+                'args': args,
+            })
+        try:
+            with open(filename, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                          f)
+        except IOError as e:
+            LOG.error("failed to write trace %s: %s", filename, e)
+            return
+        LOG.info("trace written to %s", filename)
+
+
+def counted(chunks, facts, key='bytes'):
+    """pass `chunks` through, adding up their size in `facts[key]`"""
+    facts[key] = 0
+
+    def count():
+        for chunk in chunks:
+            facts[key] += len(chunk)
+            yield chunk
+    return count()
+
+
+Recorder = _Recorder()
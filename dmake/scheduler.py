@@ -0,0 +1,137 @@
+import heapq
+import logging
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from dmake.graph import BuildGraph
+
+
+LOG = logging.getLogger(__name__)
+# how often waits wake up, untimed waits of python 2 ignore ctrl-c
+POLL_INTERVAL = 0.1
+
+
+def _get(queue):
+    while True:
+        try:
+            return queue.get(True, POLL_INTERVAL)
+        except Queue.Empty:
+            pass
+
+
+class Scheduler(object):
+    """run builds concurrently, each as soon as its dependencies finished.
+
+    `order` is a topologically sorted list of the builds to run, and
+    `graph` is a `BuildGraph`, or a dict mapping a build's name to the names
+    it has to wait for. dependencies not present in `order` are considered
+    satisfied.
+    """
+
+    def __init__(self, order, graph, jobs=1):
+        self.order = list(order)
+        if not isinstance(graph, BuildGraph):
+            graph = BuildGraph(graph)
+        self.graph = graph
+        self.jobs = max(1, jobs)
+
+    def run(self, func):
+        """call `func(name)` for every build, return failures by name.
+
+        once a build fails no new build is started, builds already running
+        are waited for. on ctrl-c no new build is started either, and the
+        builds running are left behind.
+        """
+        # ready builds are started in the order given
+        index = dict((name, i) for i, name in enumerate(self.order))
+        waiting = {}
+        ready = []
+        for name in self.order:
+            waiting[name] = len([dep for dep in self.graph.dependencies[name]
+                                 if dep in index])
+            if not waiting[name]:
+                ready.append((index[name], name))
+        heapq.heapify(ready)
+        started = set()
+        finished = Queue.Queue()
+        failures = {}
+        running = 0
+
+        pool = ThreadPool(self.jobs)
+        interrupted = False
+        try:
+            while True:
+                while not failures and running < self.jobs and ready:
+                    _, name = heapq.heappop(ready)
+                    started.add(name)
+                    pool.apply_async(self._call, (func, name, finished))
+                    running += 1
+
+                if not running:
+                    break
+
+                name, error = _get(finished)
+                running -= 1
+                if error is not None:
+                    failures[name] = error
+                    continue
+                for dependent in self.graph.dependents[name]:
+                    if dependent in waiting:
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            heapq.heappush(ready,
+                                           (index[dependent], dependent))
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+        finally:
+            pool.close()
+            # the pool threads are daemons, they end with the process
+            if not interrupted:
+                pool.join()
+
+        skipped = [n for n in self.order if n not in started]
+        if failures and skipped:
+            LOG.info("skipped builds due to previous failures: %s",
+                     ", ".join(skipped))
+        return failures
+
+    @staticmethod
+    def _call(func, name, finished):
+        try:
+            func(name)
+        except Exception as e:
+            finished.put((name, e))
+        else:
+            finished.put((name, None))
+
+
+class PushQueue(object):
+    """push tagged images in the background while later builds go on.
+
+    `join` is the barrier: it waits for every submitted push and returns
+    the ones that failed, as a list of (name, exception).
+    """
+
+    def __init__(self, func, workers=1):
+        self.func = func
+        self._pool = ThreadPool(max(1, workers))
+        self._results = []
+
+    def submit(self, name):
+        LOG.debug("%s: queued for pushing", name)
+        self._results.append((name, self._pool.apply_async(self.func,
+                                                           (name,))))
+
+    def join(self):
+        self._pool.close()
+        failures = []
+        for name, result in self._results:
+            while not result.ready():
+                result.wait(POLL_INTERVAL)
+            try:
+                result.get()
+            except Exception as e:
+                failures.append((name, e))
+        self._pool.join()
+        return failures
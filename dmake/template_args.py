@@ -1,9 +1,15 @@
+import os
 import re
+import zlib
+import signal
+import string
 import datetime
 import logging
+import threading
 import subprocess
+from multiprocessing.pool import ThreadPool
 
-from dmake import utils
+from dmake import config as dmake_config
 
 
 LOG = logging.getLogger(__name__)
@@ -15,6 +21,9 @@ _label_template_args = None
 
 
 class TemplateArgsGenerator(object):
+    # names of the args produced, None if they are not known in advance
+    keys = None
+
     def gen_args(self):
         raise StopIteration
         # yield needed to make gen_args a generator function
@@ -25,6 +34,7 @@ class DateTimeGenerator(TemplateArgsGenerator):
     def __init__(self, name, format):
         self.name = name
         self.format = format
+        self.keys = (name,)
 
     def gen_args(self):
         yield self.name, datetime.datetime.now().strftime(self.format)
@@ -36,16 +46,24 @@ class DateGenerator(DateTimeGenerator):
 
 
 class ExternalCmdGenerator(TemplateArgsGenerator):
-    def __init__(self, key=None, cmd=None):
+    def __init__(self, key=None, cmd=None, timeout=None):
         self.key = key or self.__class__.key
         self.cmd = cmd or self.__class__.cmd
+        self.timeout = timeout
+        self.keys = (self.key,)
+        self._args = None
+        self._lock = threading.Lock()
 
     def gen_args(self):
+        # the same generator serves both tag and label args, run it once
+        with self._lock:
+            if self._args is None:
+                self._args = list(self._run())
+        return iter(self._args)
+
+    def _run(self):
         try:
-            value = subprocess.check_output(self.cmd,
-                                            stderr=subprocess.STDOUT,
-                                            shell=not isinstance(self.cmd,
-                                                                 list))
+            value = self._output()
             value = value.strip()
             if value:
                 yield self.key, value.strip()
@@ -59,11 +77,49 @@ class ExternalCmdGenerator(TemplateArgsGenerator):
             LOG.log(log_level, "failed to run %s: %s", self.cmd, e)
             pass
 
+    def _output(self):
+        shell = not isinstance(self.cmd, list)
+        if self.timeout is None:
+            return subprocess.check_output(self.cmd,
+                                           stderr=subprocess.STDOUT,
+                                           shell=shell)
+
+        # run in a process group of its own, so that the whole pipeline
+        # of a shell command is killed on timeout
+        process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, shell=shell,
+                                   preexec_fn=os.setsid)
+        expired = []
+
+        def kill():
+            expired.append(True)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            timer.cancel()
+        if expired:
+            output = "timed out after %ss" % self.timeout
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, self.cmd,
+                                                output)
+        return output
+
 
 class GitCommitGenerator(ExternalCmdGenerator):
     key = 'fcommitid'
     cmd = 'git rev-parse HEAD'
 
+    def __init__(self, key=None, cmd=None, timeout=None):
+        super(GitCommitGenerator, self).__init__(key, cmd, timeout)
+        self.keys = (self.key, 'scommitid')
+
     def gen_args(self):
         for k, v in super(GitCommitGenerator, self).gen_args():
             yield k, v
@@ -90,10 +146,224 @@ class GitDescribeGenerator(ExternalCmdGenerator):
     cmd = 'git describe --tags'
 
 
-def _template_args(generators):
+class GitMetadata(object):
+    """facts about the git working copy, gathered once with a single git
+    command when possible, or read from the .git directory if git is not
+    installed.
+    """
+
+    keys = ('fcommitid', 'scommitid', 'git_branch', 'git_tag',
+            'git_describe', 'commitmsg')
+
+    def __init__(self, path=None):
+        self.path = path
+        self._fields = None
+        self._lock = threading.Lock()
+
+    def fields(self):
+        with self._lock:
+            if self._fields is None:
+                try:
+                    self._fields = self._from_git()
+                except OSError:
+                    LOG.info("git is not available, reading .git directly")
+                    self._fields = self._from_git_dir()
+            return self._fields
+
+    def _git(self, *args):
+        return subprocess.check_output(('git',) + args, cwd=self.path,
+                                       stderr=subprocess.STDOUT)
+
+    def _from_git(self):
+        try:
+            output = self._git('log', '-1', '--format=%H%n%h%n%D%n%s')
+        except subprocess.CalledProcessError as e:
+            LOG.warning("failed to run git log: %s", e.output.strip())
+            return {}
+
+        commit, short, refs, subject = (output.split('\n', 3) + [''] * 4)[:4]
+        branch, tags = 'HEAD', []
+        for ref in refs.split(', '):
+            if ref.startswith('HEAD -> '):
+                branch = ref[len('HEAD -> '):]
+            elif ref.startswith('tag: '):
+                tags.append(ref[len('tag: '):])
+        fields = self._fields_of(commit, branch, sorted(tags),
+                                 '%s %s' % (short, subject.strip()))
+
+        if 'git_describe' not in fields:
+            try:
+                fields['git_describe'] = self._git('describe',
+                                                   '--tags').strip()
+            except subprocess.CalledProcessError as e:
+                # having 0 tags is not worthy of warning
+                log_level = logging.WARNING
+                if "No names found" in e.output:
+                    log_level = logging.INFO
+                LOG.log(log_level, "failed to run git describe: %s", e)
+        return fields
+
+    @staticmethod
+    def _fields_of(commit, branch, tags, commitmsg=None):
+        fields = {}
+        if commit:
+            fields['fcommitid'] = commit
+            fields['scommitid'] = commit[:7]
+        if branch:
+            fields['git_branch'] = branch
+        if tags:
+            fields['git_tag'] = tags[0]
+            fields['git_describe'] = tags[0]
+        if commitmsg:
+            fields['commitmsg'] = commitmsg
+        return fields
+
+    def _find_git_dir(self):
+        path = os.path.abspath(self.path or os.getcwd())
+        while True:
+            git_dir = os.path.join(path, '.git')
+            if os.path.isfile(git_dir):
+                with open(git_dir) as f:
+                    content = f.read().strip()
+                if content.startswith('gitdir:'):
+                    return os.path.join(path, content[len('gitdir:'):].strip())
+            if os.path.isdir(git_dir):
+                return git_dir
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def _from_git_dir(self):
+        git_dir = self._find_git_dir()
+        if git_dir is None:
+            LOG.warning("not in a git repository")
+            return {}
+        repo = _GitDir(git_dir)
+        head = repo.read('HEAD')
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            branch = ref[len('refs/heads/'):] if ref.startswith(
+                'refs/heads/') else ref
+            commit = repo.resolve(ref)
+        else:
+            branch, commit = 'HEAD', head
+        tags = sorted(name[len('refs/tags/'):]
+                      for name, target in repo.refs('refs/tags/')
+                      if target == commit)
+        commitmsg = None
+        subject = repo.commit_subject(commit) if commit else None
+        if subject is not None:
+            commitmsg = '%s %s' % (commit[:7], subject)
+        return self._fields_of(commit, branch, tags, commitmsg)
+
+
+class _GitDir(object):
+    """minimal reader of refs and loose objects of a .git directory"""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._packed = None
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.git_dir, name)) as f:
+                return f.read().strip()
+        except IOError:
+            return ''
+
+    def packed_refs(self):
+        """map of packed ref names to their (peeled) object ids"""
+        if self._packed is None:
+            self._packed = {}
+            last = None
+            for line in self.read('packed-refs').splitlines():
+                if line.startswith('#') or not line:
+                    continue
+                if line.startswith('^') and last is not None:
+                    self._packed[last] = line[1:]
+                    continue
+                sha, _, last = line.partition(' ')
+                self._packed[last] = sha
+        return self._packed
+
+    def resolve(self, ref):
+        target = self.read(ref) or self.packed_refs().get(ref, '')
+        if target.startswith('ref: '):
+            return self.resolve(target[len('ref: '):])
+        return target or None
+
+    def refs(self, prefix):
+        refs = dict((name, sha) for name, sha in self.packed_refs().items()
+                    if name.startswith(prefix))
+        ref_dir = os.path.join(self.git_dir, prefix)
+        for parent, _, files in os.walk(ref_dir):
+            for name in files:
+                ref = os.path.relpath(os.path.join(parent, name),
+                                      self.git_dir).replace(os.sep, '/')
+                refs[ref] = self.peel(self.read(ref))
+        return refs.items()
+
+    def object(self, sha):
+        path = os.path.join(self.git_dir, 'objects', sha[:2], sha[2:])
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (IOError, zlib.error):
+            return None, None
+        header, _, body = data.partition('\0')
+        return header.split(' ', 1)[0], body
+
+    def peel(self, sha):
+        kind, body = self.object(sha)
+        if kind == 'tag' and body.startswith('object '):
+            return body.split('\n', 1)[0][len('object '):]
+        return sha
+
+    def commit_subject(self, sha):
+        kind, body = self.object(sha)
+        if kind != 'commit':
+            return None
+        _, _, message = body.partition('\n\n')
+        return message.split('\n', 1)[0].strip()
+
+
+class GitMetadataGenerator(TemplateArgsGenerator):
+    keys = GitMetadata.keys
+
+    def __init__(self, metadata=None):
+        self.metadata = metadata or _git_metadata
+
+    def gen_args(self):
+        for key in self.keys:
+            value = self.metadata.fields().get(key)
+            if value:
+                yield key, value
+
+
+_git_metadata = GitMetadata()
+
+
+def _template_args(generators, wanted=None):
+    """evaluate the generators which may produce one of the `wanted` args,
+    or all of them if `wanted` is None.
+    """
+    if wanted is not None:
+        generators = [g for g in generators
+                      if g.keys is None or set(g.keys) & wanted]
+    if len(generators) > 1:
+        # most generators run external commands, run them side by side
+        pool = ThreadPool(len(generators))
+        try:
+            produced = pool.map(lambda g: list(g.gen_args()), generators)
+        finally:
+            pool.close()
+    else:
+        produced = [list(g.gen_args()) for g in generators]
+
     result = {}
-    for g in generators:
-        for k, v in g.gen_args():
+    for args in produced:
+        for k, v in args:
             if not validate_tag_name(v):
                 result[k] = correct_tag_name(v)
                 LOG.warn("%s is not a valid docker tag name,"
@@ -104,6 +374,41 @@ def _template_args(generators):
     return result
 
 
+def referenced_args(templates):
+    """names of the args referred in the format fields of `templates`"""
+    names = set()
+    formatter = string.Formatter()
+    for template in templates:
+        try:
+            fields = [f for _, f, _, _ in formatter.parse(template)]
+        except ValueError:
+            # reported when the template is actually used
+            continue
+        for field in fields:
+            if field:
+                names.add(re.split(r'[.\[]', field, 1)[0])
+    return names
+
+
+def wanted_template_args(builds):
+    """args referred by the pushes, cache images and labels of `builds`, as
+    a tuple of (tag args, label args).
+    """
+    tag_args, label_args = set(), set()
+    for build in builds:
+        tag_args |= referenced_args(rule.tag_template for rule in build.pushes)
+        tag_args |= referenced_args(build.cache_from)
+        if build.cache_to:
+            tag_args |= referenced_args([build.cache_to])
+        for rule in build.pushes:
+            if rule.mode == 'on_tag':
+                tag_args.add('git_tag')
+            elif rule.mode.startswith('on_branch:'):
+                tag_args.add('git_branch')
+        label_args |= referenced_args(build.labels)
+    return tag_args, label_args
+
+
 def validate_tag_name(name):
     return TAG_NAME_PATTERN.match(name) is not None
 
@@ -126,38 +431,36 @@ def correct_tag_name(name):
     return ''.join(tmp_lst)[:128]
 
 
-def tag_template_args(extra_generators=None):
+def tag_template_args(extra_generators=None, wanted=None):
     global _tag_template_args
     if _tag_template_args is not None:
         return _tag_template_args
     extra_generators = extra_generators or []
-    generators = [GitCommitGenerator(), GitCommitMsgGenerator(),
-                  GitBranchGenerator(), GitTagGenerator(),
-                  GitDescribeGenerator(), DateGenerator()]
+    generators = [GitMetadataGenerator(), DateGenerator()]
     generators.extend(extra_generators)
-    _tag_template_args = _template_args(generators)
+    _tag_template_args = _template_args(generators, wanted)
     return _tag_template_args
 
 
-def label_template_args(extra_generators=None):
+def label_template_args(extra_generators=None, wanted=None):
     global _label_template_args
     if _label_template_args is not None:
         return _label_template_args
     extra_generators = extra_generators or []
-    generators = [GitCommitGenerator(), GitCommitMsgGenerator(),
-                  GitBranchGenerator(), GitTagGenerator(),
-                  GitDescribeGenerator()]
+    generators = [GitMetadataGenerator()]
     generators.extend(extra_generators)
-    _label_template_args = _template_args(generators)
+    _label_template_args = _template_args(generators, wanted)
     return _label_template_args
 
 
-def init_tag_names(dmakefile):
-    data = utils.load_yaml(dmakefile)
-    configurations = data.get('tag-names', None)
-    extra_generators = create_extra_generators(configurations)
-    label_template_args(extra_generators)
-    tag_template_args(extra_generators)
+def init_tag_names(config):
+    """`config` is a `dmake.config.Config`, or the path to load it from"""
+    if isinstance(config, basestring):
+        config = dmake_config.load(config)
+    extra_generators = create_extra_generators(config.tag_names)
+    tag_args, label_args = wanted_template_args(config.builds.values())
+    label_template_args(extra_generators, label_args)
+    tag_template_args(extra_generators, tag_args)
 
 
 def create_extra_generators(configurations):
@@ -172,18 +475,18 @@ def create_extra_generators(configurations):
     tag_name_generators = []
 
     for config in configurations:
-        if not validate_tag_name_config(config):
-            continue
-        name, type_, value = config['name'], config['type'], config['value']
-        cls = configurable_tag_name_generators.get(type_, None)
-        if cls is not None:
-            tag_name_generators.append(cls(name, value))
+        if not isinstance(config, dmake_config.TagNameConfig):
+            config = dmake_config.TagNameConfig.from_dict(config)
+            if config is None:
+                continue
+        cls = configurable_tag_name_generators.get(config.type, None)
+        if cls is ExternalCmdGenerator:
+            tag_name_generators.append(cls(config.name, config.value,
+                                           config.timeout))
+        elif cls is not None:
+            tag_name_generators.append(cls(config.name, config.value))
     return tag_name_generators
 
 
 def validate_tag_name_config(config):
-    for key in ('name', 'type', 'value'):
-        if key not in config:
-            LOG.warn("%s absent in %s", key, config)
-            return False
-    return True
+    return dmake_config.TagNameConfig.from_dict(config) is not None
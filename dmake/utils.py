@@ -1,16 +1,30 @@
 import os
+import re
+import json
+import time
+import shutil
 import logging
+import threading
+import itertools
+from collections import OrderedDict
 
-import yaml
 import docker
 from distutils.version import LooseVersion
 from docker import utils as docker_utils
 
 from dmake.errors import *  # noqa
+from dmake.cache import cache_dir, save_file
+from dmake.graph import BuildGraph
 
 
 LOG = logging.getLogger(__name__)
-_docker = None
+
+DOCKER_CLIENTS = 4
+DOCKER_TIMEOUTS = {'api': 60, 'build': 3600, 'push': 1800}
+API_VERSION_TTL = 24 * 3600
+MATRIX_KEY_PATTERN = re.compile(r'^[A-Za-z_]\w*$')
+MATRIX_NAME_PATTERN = re.compile(r'^(.+)\[(.*)\]$')
+MATRIX_VARIABLE_PATTERN = re.compile(r'\{(\w+)\}')
 
 
 class _GarbageCleaner(object):
@@ -27,7 +41,7 @@ class _GarbageCleaner(object):
         if os.path.isfile(filename) or os.path.islink(filename):
             os.remove(filename)
         if os.path.isdir(filename):
-            os.rmdir(filename)
+            shutil.rmtree(filename)
 
     def clean_all(self):
         for filename in self._files:
@@ -37,25 +51,184 @@ class _GarbageCleaner(object):
 GarbageCleaner = _GarbageCleaner()
 
 
-def docker_client():
-    global _docker
-    if _docker is None:
+class _Summary(object):
+    """counters of a run, reported when it is done."""
+
+    def __init__(self):
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def get(self, name):
+        return self._counts.get(name, 0)
+
+    def reset(self):
+        with self._lock:
+            self._counts = OrderedDict()
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def report(self, logger):
+        for name, n in self._counts.items():
+            logger.info("summary: %s: %d", name, n)
+
+
+Summary = _Summary()
+
+
+class _DockerClients(object):
+    """the docker api clients of a run, bound to the threads using them.
+
+    a thread gets its own client for each kind of call, until `size` clients
+    of a kind exist, then threads share them in turn. 'build' and 'push'
+    clients wait longer on a silent daemon than 'api' ones, as a build step
+    or a layer upload may print nothing for minutes.
+
+    the api version negotiated with a daemon is cached per DOCKER_HOST, so
+    that later runs skip asking for it. when the daemon turns out to be
+    older than the cached version, it is negotiated again.
+    """
+
+    def __init__(self, size=DOCKER_CLIENTS):
+        self.size = size
+        self.timeouts = dict(DOCKER_TIMEOUTS)
+        self.version_cache = None
+        self._version = None
+        self._clients = {}
+        self._bound = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self, kind='api'):
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        if kind not in clients:
+            clients[kind] = self._bind(kind)
+        return clients[kind]
+
+    def _bind(self, kind):
+        with self._lock:
+            clients = self._clients.setdefault(kind, [])
+            n = self._bound.get(kind, 0)
+            self._bound[kind] = n + 1
+            if len(clients) < max(1, self.size):
+                clients.append(self._create(self.timeouts[kind]))
+                return clients[-1]
+            return clients[n % len(clients)]
+
+    def _create(self, timeout):
         params = docker_utils.kwargs_from_env()
-        params['version'] = 'auto'
+        params['version'] = self._version or self._cached_version() or 'auto'
+        params['timeout'] = timeout
         if LooseVersion(docker.__version__) < LooseVersion('2.0.0'):
-            _docker = docker.client.Client(**params)
+            client = docker.client.Client(**params)
         else:
-            _docker = docker.api.client.APIClient(**params)
-    return _docker
+            client = docker.api.client.APIClient(**params)
+        if self._version is None:
+            self._version = client._version
+            if params['version'] == 'auto':
+                self._save_version(client._version)
+        if params['version'] != 'auto':
+            self._renegotiating(client)
+        return client
+
+    def _renegotiating(self, client):
+        # a daemon downgraded, or another one behind the same DOCKER_HOST,
+        # rejects the cached version: negotiate, and retry the request
+        request = client.request
+
+        def retried(method, url, **kwargs):
+            response = request(method, url, **kwargs)
+            if not _version_too_new(response):
+                return response
+            stale = '/v%s/' % client._version
+            self._renegotiate(client)
+            if stale in url and _replayable(kwargs.get('data')):
+                url = url.replace(stale, '/v%s/' % client._version, 1)
+                response = request(method, url, **kwargs)
+            return response
+        client.request = retried
+
+    def _renegotiate(self, client):
+        with self._lock:
+            if client._version == self._version:
+                LOG.info("docker api version %s is too new for the daemon, "
+                         "negotiating it again", self._version)
+                self._version = client._retrieve_server_version()
+                self._save_version(self._version)
+            for clients in self._clients.values():
+                for c in clients:
+                    c._version = self._version
+            client._version = self._version
+
+    def _cache_path(self):
+        return self.version_cache or os.path.join(cache_dir(),
+                                                  'api-versions.json')
+
+    def _read_versions(self):
+        try:
+            with open(self._cache_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _cached_version(self):
+        entry = self._read_versions().get(_docker_host())
+        if not entry or time.time() - entry['time'] > API_VERSION_TTL:
+            return None
+        LOG.debug("using cached docker api version %s", entry['version'])
+        return entry['version']
+
+    def _save_version(self, version):
+        versions = self._read_versions()
+        versions[_docker_host()] = {'version': version, 'time': time.time()}
+        save_file(self._cache_path(), lambda f: json.dump(versions, f),
+                  'docker api versions')
+
+    def reset(self):
+        """drop every client, for a daemon that changed."""
+        with self._lock:
+            for clients in self._clients.values():
+                for client in clients:
+                    client.close()
+            self._clients = {}
+            self._bound = {}
+            self._version = None
+            self._local = threading.local()
+
+
+def _version_too_new(response):
+    # "client version 1.40 is too new. Maximum supported API version is ..."
+    return response.status_code == 400 and 'is too new' in response.text
+
+
+def _replayable(data):
+    return data is None or isinstance(data, (basestring, dict))
 
 
-def load_yaml(filename='.docker-make.yml'):
-    try:
-        with open(filename) as f:
-            return yaml.safe_load(f)
-    except (IOError, yaml.YAMLError) as e:
-        err_msg = getattr(e, '__module__', '') + '.' + e.__class__.__name__
-        raise ConfigurationError(u"{}: {}".format(err_msg, e))
+def _docker_host():
+    return os.environ.get('DOCKER_HOST') or 'default'
+
+
+DockerClients = _DockerClients()
+
+
+def docker_client(kind='api'):
+    """the docker client of the calling thread for `kind` of calls: 'api',
+    'build' or 'push'.
+    """
+    return DockerClients.get(kind)
+
+
+def docker_is_remote():
+    # clients of local unix sockets and named pipes use a 'http+' scheme
+    return not docker_client().base_url.startswith('http+')
 
 
 def validate(config):
@@ -70,57 +243,151 @@ def validate(config):
             if dep not in builds:
                 raise ValidateError("%s depends on %s, which is not present in"
                                     "the current configuration." % (name, dep))
+        rewrite_from = build.get('rewrite_from')
+        if rewrite_from and rewrite_from not in builds:
+            raise ValidateError("%s rewrites from %s, which is not present in"
+                                " the current configuration." %
+                                (name, rewrite_from))
     return True
 
 
+def dependency_graph(builds):
+    """map each build's name to the names of the builds it waits for.
+
+    `rewrite_from` is an implicit dependency, as the image id of the build
+    it refers to is needed to build.
+    """
+    graph = {}
+    for name, build in builds.iteritems():
+        deps = set(build.get('depends_on', None) or [])
+        if build.get('rewrite_from'):
+            deps.add(build['rewrite_from'])
+        graph[name] = deps
+    return graph
+
+
 def sort_builds_dict(builds):
-    # Topological sort (Cormen/Tarjan algorithm)
-    unmarked = builds.keys()
-    temporary_marked = set()
-    sorted_builds = []
-
-    def visit(n):
-        if n in temporary_marked:
-            if n in builds[n].get('depends_on', []):
-                raise DependencyError('A build can not'
-                                      ' depend on itself: %s' % n['name'])
-            raise DependencyError('Circular dependency between %s' %
-                                  ' and '.join(temporary_marked))
-
-        if n in unmarked:
-            temporary_marked.add(n)
-            builds_dep_on_n = [name for name, build in builds.iteritems()
-                               if
-                               n in build.get('depends_on', [])]
-            for m in builds_dep_on_n:
-                visit(m)
-            temporary_marked.remove(n)
-            unmarked.remove(n)
-            sorted_builds.insert(0, n)
-
-    while unmarked:
-        visit(unmarked[-1])
-
-    return sorted_builds
-
-
-def get_sorted_build_dicts_from_yaml(filename):
-    config = load_yaml(filename)
-    validate(config)
-    builds = config["builds"]
-    builds_order = sort_builds_dict(builds)
-    return builds_order, builds
-
-
-def expand_wants(candidates, wants):
-    ret = set()
-    wants = set(wants)
-    while wants:
-        want = wants.pop()
-        if want not in candidates:
+    return BuildGraph(dependency_graph(builds)).topological_order()
+
+
+def matrix_name(name, values):
+    """`app[jdk=17,os=alpine]`, the name of a build of a matrix"""
+    return '%s[%s]' % (name, ','.join('%s=%s' % (k, values[k])
+                                      for k in sorted(values)))
+
+
+def matrix_selection(name):
+    """`app[jdk=17]` as ('app', {'jdk': '17'}), `app` as ('app', {}), None
+    for a malformed selection.
+    """
+    match = MATRIX_NAME_PATTERN.match(name)
+    if match is None:
+        return name, {}
+    base, selection = match.groups()
+    items = [item.split('=', 1) for item in selection.split(',')]
+    if not all(len(item) == 2 for item in items):
+        return None
+    return base, dict(items)
+
+
+def _substitute(value, values):
+    if isinstance(value, basestring):
+        return MATRIX_VARIABLE_PATTERN.sub(
+            lambda m: values.get(m.group(1), m.group(0)), value)
+    if isinstance(value, list):
+        return [_substitute(item, values) for item in value]
+    if isinstance(value, dict):
+        return dict((k, _substitute(v, values)) for k, v in value.items())
+    return value
+
+
+def _validate_matrix(name, matrix):
+    if not isinstance(matrix, dict) or not matrix:
+        raise ValidateError("matrix of build %s should be a dict" % name)
+    for key, values in matrix.items():
+        if not MATRIX_KEY_PATTERN.match(str(key)):
+            raise ValidateError("invalid matrix key of build %s: %s" %
+                                (name, key))
+        if not isinstance(values, list) or not values:
+            raise ValidateError("matrix values of %s of build %s should be a "
+                                "non-empty list" % (key, name))
+        for value in values:
+            if (isinstance(value, (list, dict)) or value is None or
+                    set(',=[]') & set('%s' % value)):
+                raise ValidateError("invalid matrix value of %s of build "
+                                    "%s: %s" % (key, name, value))
+
+
+def expand_matrix(builds):
+    """builds with a `matrix` replaced by one build per combination of its
+    values, named like `app[jdk=17]`, with `{jdk}` in the strings of their
+    options replaced. a matrix build named in `depends_on` stands for every
+    build of it.
+    """
+    if not isinstance(builds, dict):
+        return builds
+    expanded = {}
+    variants = {}
+    for name, build in builds.iteritems():
+        if not isinstance(build, dict) or 'matrix' not in build:
+            expanded[name] = build
+            continue
+        matrix = build['matrix']
+        _validate_matrix(name, matrix)
+        keys = sorted(matrix)
+        options = dict((k, v) for k, v in build.items() if k != 'matrix')
+        names = variants[name] = []
+        for combination in itertools.product(*[matrix[k] for k in keys]):
+            values = dict(zip(keys, ['%s' % v for v in combination]))
+            variant = matrix_name(name, values)
+            if variant in builds:
+                raise ValidateError("build %s of matrix %s is defined "
+                                    "already" % (variant, name))
+            expanded[variant] = _substitute(options, values)
+            names.append(variant)
+
+    if not variants:
+        return expanded
+    for name, build in expanded.items():
+        if not isinstance(build, dict):
+            continue
+        if build.get('rewrite_from') in variants:
+            raise ValidateError("%s rewrites from matrix %s, which has more "
+                                "than one image, select one like %s" %
+                                (name, build['rewrite_from'],
+                                 variants[build['rewrite_from']][0]))
+        depends_on = build.get('depends_on')
+        if isinstance(depends_on, list) and set(depends_on) & set(variants):
+            expanded[name] = dict(build, depends_on=[
+                n for dep in depends_on for n in variants.get(dep, [dep])])
+    return expanded
+
+
+def expand_wants(graph, wants):
+    """the wanted builds and every build they depend on, including the ones
+    they rewrite from. `graph` is a `dmake.graph.BuildGraph`.
+
+    a matrix build is wanted by its name for all of its builds, or like
+    `app[jdk=17]` for the ones with these values.
+    """
+    names = set()
+    for want in wants:
+        if want in graph:
+            names.add(want)
+            continue
+        selection = matrix_selection(want)
+        if selection is None:
             raise BuildUnDefined(want)
-        ret.add(want)
-        for dep in candidates[want].depends_on:
-            if dep not in ret:
-                wants.add(dep)
-    return ret
+        matched = [name for name in graph.dependencies
+                   if _selected(name, *selection)]
+        if not matched:
+            raise BuildUnDefined(want)
+        names.update(matched)
+    return names | graph.ancestors(names)
+
+
+def _selected(name, base, values):
+    selection = matrix_selection(name)
+    if selection is None or selection[0] != base or not selection[1]:
+        return False
+    return all(selection[1].get(k) == v for k, v in values.items())
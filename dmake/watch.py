@@ -0,0 +1,164 @@
+"""wait for files of build contexts to change, with inotify when pyinotify
+is installed, by polling otherwise.
+"""
+import os
+import time
+import logging
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+LOG = logging.getLogger(__name__)
+POLL_INTERVAL = 1.0
+DEBOUNCE = 0.3
+SKIPPED_DIRS = ('.git', '.hg', '.svn')
+
+
+def watch_roots(directories):
+    """`directories` without the ones inside another of them"""
+    roots = []
+    for directory in sorted(set(os.path.abspath(d) for d in directories)):
+        if not any(directory == root or directory.startswith(root + os.sep)
+                   for root in roots):
+            roots.append(directory)
+    return roots
+
+
+def _relpath(path):
+    return os.path.relpath(path).replace(os.sep, '/')
+
+
+def _skipped(directory, contexts):
+    """whether no file of `directory` can be part of the `contexts`, as a
+    list of (path, IgnoreRules), watching everything when there are none.
+    """
+    if os.path.basename(directory) in SKIPPED_DIRS:
+        return True
+    if not contexts:
+        return False
+    for root, rules in contexts:
+        # the directories leading to a context are walked through
+        if root == directory or root.startswith(directory + os.sep):
+            return False
+        if directory.startswith(root + os.sep):
+            path = os.path.relpath(directory, root).replace(os.sep, '/')
+            if not rules.excluded(path) or rules.may_include_below(path):
+                return False
+    return True
+
+
+def _abs_contexts(contexts):
+    return [(os.path.abspath(root), rules) for root, rules in contexts]
+
+
+class PollingWatcher(object):
+    """compare the size, mtime and inode of every file with the previous
+    look at them.
+    """
+
+    def __init__(self, roots, files=(), contexts=()):
+        self.roots = roots
+        self.files = [os.path.abspath(f) for f in files]
+        self.contexts = _abs_contexts(contexts)
+        self._stamps = self._snapshot()
+
+    def _stamp(self, path, stamps):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return
+        stamps[path] = (st.st_size, st.st_mtime, st.st_ino)
+
+    def _snapshot(self):
+        stamps = {}
+        for root in self.roots:
+            for parent, dirs, files in os.walk(root):
+                dirs[:] = [d for d in dirs if not _skipped(
+                    os.path.join(parent, d), self.contexts)]
+                for name in files:
+                    self._stamp(os.path.join(parent, name), stamps)
+        for path in self.files:
+            self._stamp(path, stamps)
+        return stamps
+
+    def changes(self, timeout):
+        """paths changed, created or removed since the last call, relative
+        to the current directory, after waiting `timeout` seconds.
+        """
+        time.sleep(timeout)
+        stamps = self._snapshot()
+        changed = set(path for path, stamp in stamps.items()
+                      if self._stamps.get(path) != stamp)
+        changed.update(path for path in self._stamps if path not in stamps)
+        self._stamps = stamps
+        return set(_relpath(path) for path in changed)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """collect the paths of inotify events of the roots and files."""
+
+    def __init__(self, roots, files=(), contexts=()):
+        self._paths = set()
+        self._files = set(os.path.abspath(f) for f in files)
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._manager, self._event)
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+
+        contexts = _abs_contexts(contexts)
+
+        def skipped(path):
+            return _skipped(path, contexts)
+        for root in roots:
+            self._manager.add_watch(root, mask, rec=True, auto_add=True,
+                                    exclude_filter=skipped)
+        for path in self._files:
+            self._manager.add_watch(os.path.dirname(path), mask)
+        self._roots = roots
+
+    def _event(self, event):
+        path = event.pathname
+        if (path in self._files or
+                any(path.startswith(root + os.sep) for root in self._roots)):
+            self._paths.add(_relpath(path))
+
+    def changes(self, timeout):
+        if self._notifier.check_events(timeout=int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        paths, self._paths = self._paths, set()
+        return paths
+
+    def close(self):
+        self._notifier.stop()
+
+
+def watcher(roots, files=(), contexts=()):
+    """watch the `roots`, but the directories none of the `contexts`, as a
+    list of (path, IgnoreRules), may take files from, and the `files`.
+    """
+    if pyinotify is not None:
+        return InotifyWatcher(roots, files, contexts)
+    LOG.info("pyinotify is not installed, polling for changes every %.1fs",
+             POLL_INTERVAL)
+    return PollingWatcher(roots, files, contexts)
+
+
+def wait(watcher, debounce=DEBOUNCE, interval=POLL_INTERVAL):
+    """block until some files changed, and then did not change for
+    `debounce` seconds, and return their paths.
+    """
+    paths = set()
+    while True:
+        changed = watcher.changes(debounce if paths else interval)
+        if changed:
+            paths |= changed
+        elif paths:
+            return paths
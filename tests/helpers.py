@@ -0,0 +1,24 @@
+import os
+import shutil
+import tempfile
+
+
+class WorkDirMixin(object):
+    """tests running in a temporary directory of their own."""
+
+    def enter_workdir(self):
+        """create the directory, change to it and return its path, both
+        undone on cleanup.
+        """
+        self.addCleanup(os.chdir, os.getcwd())
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        os.chdir(path)
+        return path
+
+    def write(self, path, content='x\n'):
+        """append `content` to `path`, creating it and its directories"""
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(content)
@@ -0,0 +1,553 @@
+import io
+import os
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import threading
+
+import unittest2
+from mock import mock
+
+from dmake import build as dmake_build
+from dmake import context
+from dmake import report
+from dmake import utils
+from dmake.errors import BuildFailed, ExtractFailed, PushFailed
+from .helpers import WorkDirMixin
+
+
+TEMPLATE_ARGS = {'fcommitid': 'c0ffee', 'git_branch': 'master'}
+
+
+def push_stream(tag, layers, digest='sha256:abc'):
+    yield {'status': 'The push refers to a repository [...]'}
+    for layer, status in layers:
+        yield {'status': 'Preparing', 'id': layer, 'progressDetail': {}}
+        if status == 'Pushed':
+            yield {'status': 'Pushing', 'id': layer,
+                   'progressDetail': {'current': 512, 'total': 1024}}
+        yield {'status': status, 'id': layer, 'progressDetail': {}}
+    yield {'status': '%s: digest: %s size: 1234' % (tag, digest)}
+    yield {'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': digest,
+                                         'Size': 1234}}
+
+
+@mock.patch('dmake.template_args.tag_template_args',
+            return_value=TEMPLATE_ARGS)
+@mock.patch('dmake.template_args.label_template_args',
+            return_value=TEMPLATE_ARGS)
+class BuildPushTests(unittest2.TestCase):
+    def make_build(self, pushes):
+        return dmake_build.Build('app', '/', 'Dockerfile', pushes=pushes)
+
+    @mock.patch('dmake.utils.docker_client')
+    def test_tags_of_a_repo_pushed_in_order(self, docker_client, *_):
+        docker = docker_client.return_value
+        docker.inspect_image.return_value = {}
+        docker.push.side_effect = lambda repo, tag, **kw: push_stream(
+            tag, [('l1', 'Pushed')])
+        build = self.make_build([
+            'always=hub.example.com/app:{fcommitid}',
+            'always=hub.example.com/app:latest',
+            'never=hub.example.com/app:never',
+            'on_branch:master=mirror.example.com/app:latest',
+        ])
+        build.push(jobs=4)
+        calls = [c[0] for c in docker.push.call_args_list]
+        self.assertEqual(len(calls), 3)
+        hub_calls = [c for c in calls if c[0] == 'hub.example.com/app']
+        self.assertEqual(hub_calls, [('hub.example.com/app', 'c0ffee'),
+                                     ('hub.example.com/app', 'latest')])
+
+    @mock.patch('dmake.utils.docker_client')
+    def test_registries_pushed_concurrently(self, docker_client, *_):
+        both_started = threading.Event()
+        started = []
+
+        def push(repo, tag, **kwargs):
+            started.append(repo)
+            if len(started) == 2:
+                both_started.set()
+            self.assertTrue(both_started.wait(5))
+            return push_stream(tag, [])
+
+        docker_client.return_value.inspect_image.return_value = {}
+        docker_client.return_value.push.side_effect = push
+        build = self.make_build(['always=a.example.com/app:latest',
+                                 'always=b.example.com/app:latest'])
+        build.push(jobs=2)
+        self.assertEqual(sorted(started), ['a.example.com/app',
+                                           'b.example.com/app'])
+
+    @mock.patch('dmake.utils.docker_client')
+    def test_all_failures_reported(self, docker_client, *_):
+        def push(repo, tag, **kwargs):
+            yield {'errorDetail': {'message': 'denied: %s' % repo},
+                   'error': 'denied'}
+
+        docker_client.return_value.inspect_image.return_value = {}
+        docker_client.return_value.push.side_effect = push
+        build = self.make_build(['always=a.example.com/app:latest',
+                                 'always=b.example.com/app:latest'])
+        with self.assertRaises(PushFailed) as cm:
+            build.push(jobs=2)
+        self.assertIn('denied: a.example.com/app', cm.exception.message)
+        self.assertIn('denied: b.example.com/app', cm.exception.message)
+
+
+class PushProgressTests(unittest2.TestCase):
+    def test_summary(self):
+        progress = dmake_build.PushProgress('app', 'repo', 'latest')
+        for line in push_stream('latest', [('l1', 'Pushed'),
+                                           ('l2', 'Layer already exists'),
+                                           ('l3', 'Mounted from library/x')]):
+            progress.feed(line)
+        self.assertEqual(progress.uploaded, ['l1'])
+        self.assertEqual(sorted(progress.existed), ['l2', 'l3'])
+        self.assertEqual(progress.digest, 'sha256:abc')
+
+    def test_error(self):
+        progress = dmake_build.PushProgress('app', 'repo', 'latest')
+        with self.assertRaises(PushFailed):
+            progress.feed({'error': 'unauthorized'})
+
+
+class BuildOutputTests(unittest2.TestCase):
+    STREAM = ('{"stream":"Step 1/2 : FROM busybox"}\r\n'
+              '{"stream":"\\n"}\r\n{"stream":" ---\\u003e abc\\n"}\r\n'
+              '{"stream":"Step 2/2 : RUN make"}\r\n'
+              '{"stream":"\\n"}\r\n{"stream":" ---\\u003e Using cache\\n"}\r\n'
+              '{"aux":{"ID":"sha256:f00"}}\r\n'
+              '{"stream":"Successfully built f00\\n"}\r\n')
+
+    def test_chunk_boundaries(self):
+        for size in (1, 7, len(self.STREAM)):
+            output = dmake_build.BuildOutput('app')
+            for i in range(0, len(self.STREAM), size):
+                output.feed(self.STREAM[i:i + size])
+            output.close()
+            self.assertEqual(output.image_id, 'sha256:f00')
+            self.assertEqual([(n, i, c) for n, i, _, c in output.steps],
+                             [(1, 'FROM busybox', False),
+                              (2, 'RUN make', True)])
+            self.assertEqual(output.cached_steps, 1)
+
+    def test_successfully_built_fallback(self):
+        output = dmake_build.BuildOutput('app')
+        output.feed('{"aux":"trace"}\n{"stream":"Successfully built f00\\n"}')
+        output.close()
+        self.assertEqual(output.image_id, 'f00')
+
+    def test_error(self):
+        output = dmake_build.BuildOutput('app')
+        with self.assertRaisesRegexp(BuildFailed, 'returned a non-zero'):
+            output.feed('garbage\n{"errorDetail":{"message":"returned '
+                        'a non-zero code: 1"},"error":"x"}\n')
+
+
+class FakeDocker(object):
+    def __init__(self, version='1.30'):
+        self._version = version
+        self.builds = []
+        self.base_url = 'http+docker://localunixsocket'
+
+    def build(self, path=None, fileobj=None, custom_context=False,
+              encoding=None, dockerfile=None, buildargs=None, rm=False,
+              labels=None, platform=None, cache_from=None, timeout=None):
+        context = None
+        if custom_context:
+            context = b''.join(fileobj)
+        self.builds.append({'dockerfile': dockerfile, 'labels': labels,
+                            'custom_context': custom_context,
+                            'context': context, 'platform': platform,
+                            'buildargs': buildargs,
+                            'cache_from': cache_from, 'timeout': timeout})
+        return iter(['{"stream": "Successfully built img%d\\n"}' %
+                     len(self.builds)])
+
+
+@mock.patch('dmake.cache.BuildCache.enabled', False)
+@mock.patch('dmake.template_args.label_template_args',
+            return_value=TEMPLATE_ARGS)
+class BuildLabelsTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.write('Dockerfile', 'FROM busybox\n')
+
+    def build(self, docker):
+        with mock.patch('dmake.utils.docker_client', return_value=docker):
+            build = dmake_build.Build(
+                'app', '/', 'Dockerfile',
+                labels=['com.example.commit={fcommitid}',
+                        'com.example.msg=say "hi"'])
+            build.build()
+        return build
+
+    def test_labels_in_primary_build(self, *_):
+        docker = FakeDocker()
+        build = self.build(docker)
+        self.assertEqual(len(docker.builds), 1)
+        self.assertEqual(docker.builds[0]['labels'],
+                         {'com.example.commit': 'c0ffee',
+                          'com.example.msg': 'say "hi"'})
+        self.assertEqual(build.final_image, 'img1')
+
+    def test_phases_recorded(self, *_):
+        recorder = report._Recorder()
+        recorder.enabled = True
+        with mock.patch('dmake.report.Recorder', recorder):
+            self.build(FakeDocker())
+        phases = dict((p['phase'], p['facts']) for p in recorder.phases())
+        self.assertEqual(sorted(phases), ['build', 'upload'])
+        self.assertGreater(phases['upload']['bytes'], 0)
+        self.assertEqual(phases['build']['image'], 'img1')
+
+    def test_build_timeout(self, *_):
+        docker = FakeDocker()
+        with mock.patch.dict(utils.DockerClients.timeouts, build=7200):
+            self.build(docker)
+        self.assertEqual(docker.builds[0]['timeout'], 7200)
+
+    def test_fallback_on_old_daemons(self, *_):
+        docker = FakeDocker(version='1.22')
+        build = self.build(docker)
+        self.assertEqual(len(docker.builds), 2)
+        self.assertIsNone(docker.builds[0]['labels'])
+        self.assertFalse(docker.builds[1]['custom_context'])
+        self.assertEqual(build.non_labeled_image, 'img1')
+        self.assertEqual(build.final_image, 'img2')
+
+
+class OldDocker(FakeDocker):
+    # docker-py < 3.1 can not build for a platform
+    def build(self, path=None, fileobj=None, custom_context=False,
+              encoding=None, dockerfile=None, buildargs=None, rm=False,
+              labels=None, timeout=None):
+        response = FakeDocker.build(self, path, fileobj, custom_context,
+                                    encoding, dockerfile, buildargs, rm,
+                                    labels, timeout=timeout)
+        params = self._post(self.base_url + '/v%s/build' % self._version,
+                            params={'dockerfile': dockerfile})
+        self.builds[-1]['platform'] = params.get('platform')
+        return response
+
+    def _post(self, url, params=None, **kwargs):
+        return params
+
+
+@mock.patch('dmake.cache.BuildCache.enabled', False)
+@mock.patch('dmake.template_args.tag_template_args',
+            return_value=TEMPLATE_ARGS)
+@mock.patch('dmake.template_args.label_template_args',
+            return_value=TEMPLATE_ARGS)
+class PlatformsTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.write('Dockerfile', 'FROM busybox\n')
+
+    def build(self, docker, **kwargs):
+        build = dmake_build.Build(
+            'app', '/', 'Dockerfile',
+            platforms=['linux/amd64', 'linux/arm64'],
+            pushes=['always=hub.example.com/app:{fcommitid}'], **kwargs)
+        with mock.patch('dmake.utils.docker_client', return_value=docker):
+            build.build()
+        return build
+
+    def test_built_per_platform(self, *_):
+        docker = FakeDocker()
+        build = self.build(docker)
+        self.assertEqual(sorted(b['platform'] for b in docker.builds),
+                         ['linux/amd64', 'linux/arm64'])
+        images = build.platform_images()
+        self.assertEqual(sorted(images), ['linux/amd64', 'linux/arm64'])
+        self.assertEqual(build.final_image, images['linux/amd64'])
+
+    def test_old_docker_py(self, *_):
+        docker = OldDocker(version='1.32')
+        self.build(docker)
+        self.assertEqual(sorted(b['platform'] for b in docker.builds),
+                         ['linux/amd64', 'linux/arm64'])
+        docker.build(dockerfile='Dockerfile')
+        self.assertIsNone(docker.builds[-1]['platform'])
+
+    def test_old_daemon(self, *_):
+        with self.assertRaises(BuildFailed):
+            self.build(OldDocker(version='1.31'))
+
+    def test_extract_paths(self, *_):
+        build = dmake_build.Build('app', '/', 'Dockerfile',
+                                  extract=['/bin:./out/',
+                                           '/app.tar.gz:app.tgz',
+                                           '/app:./bin/app'])
+        variant = build.for_platform('linux/arm/v7')
+        self.assertEqual([os.path.relpath(path['dst'], build.context)
+                          for path in variant.extract],
+                         ['out-linux-arm-v7', 'app-linux-arm-v7.tgz',
+                          'bin/app-linux-arm-v7'])
+        self.assertTrue(variant.extract[0]['dst'].endswith('/'))
+
+    def test_tagged_and_pushed_as_a_list(self, *_):
+        docker = FakeDocker()
+        build = self.build(docker)
+        docker.tag = mock.Mock()
+        docker.inspect_image = mock.Mock(return_value={})
+        docker.push = mock.Mock(side_effect=lambda repo, tag, **kw:
+                                push_stream(tag, []))
+        server = mock.Mock()
+        server.manifest.side_effect = lambda path, tag: {'digest': tag}
+        with mock.patch('dmake.utils.docker_client', return_value=docker), \
+                mock.patch('dmake.registry.registry',
+                           return_value=(server, 'app')):
+            build.tag()
+            build.push()
+        self.assertEqual(sorted(c[0][1:] for c in docker.tag.call_args_list),
+                         [('hub.example.com/app', 'c0ffee-linux-amd64'),
+                          ('hub.example.com/app', 'c0ffee-linux-arm64')])
+        self.assertEqual([c[0] for c in docker.push.call_args_list],
+                         [('hub.example.com/app', 'c0ffee-linux-amd64'),
+                          ('hub.example.com/app', 'c0ffee-linux-arm64')])
+        server.put_manifest_list.assert_called_once_with('app', 'c0ffee', [
+            ('linux/amd64', {'digest': 'c0ffee-linux-amd64'}),
+            ('linux/arm64', {'digest': 'c0ffee-linux-arm64'})])
+
+
+@mock.patch('dmake.cache.BuildCache.enabled', False)
+@mock.patch('dmake.template_args.tag_template_args',
+            return_value=TEMPLATE_ARGS)
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class CacheFromTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.write('Dockerfile', 'FROM busybox\n')
+        self.docker = FakeDocker()
+        self.docker.pulls = []
+        self.docker.pull = self.pull
+        self.docker.tag = mock.Mock()
+        self.docker.inspect_image = mock.Mock(return_value={})
+        self.docker.push = mock.Mock(side_effect=lambda repo, tag, **kw:
+                                     push_stream(tag, []))
+        patcher = mock.patch('dmake.utils.docker_client',
+                             return_value=self.docker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pull(self, repo, tag, stream=False, decode=False):
+        self.docker.pulls.append((repo, tag))
+        if tag == 'gone':
+            yield {'error': 'manifest for %s:%s not found' % (repo, tag)}
+            return
+        yield {'status': 'Downloaded newer image for %s:%s' % (repo, tag)}
+
+    def test_pulled_and_used(self, *_):
+        build = dmake_build.Build('app', '/', 'Dockerfile', cache_from=[
+            'hub.example.com/app:{git_branch}', 'hub.example.com/app:master',
+            'hub.example.com/app:gone', 'hub.example.com/app:{git_tag}'])
+        build.build()
+        self.assertEqual(sorted(self.docker.pulls),
+                         [('hub.example.com/app', 'gone'),
+                          ('hub.example.com/app', 'master')])
+        self.assertEqual(self.docker.builds[0]['cache_from'],
+                         ['hub.example.com/app:master'])
+        self.assertNotIn('BUILDKIT_INLINE_CACHE',
+                         self.docker.builds[0]['buildargs'])
+
+    def test_old_daemons(self, *_):
+        self.docker._version = '1.24'
+        build = dmake_build.Build('app', '/', 'Dockerfile',
+                                  cache_from=['hub.example.com/app:master'])
+        build.build()
+        self.assertEqual(self.docker.pulls, [])
+        self.assertIsNone(self.docker.builds[0]['cache_from'])
+
+    def test_cache_to(self, *_):
+        build = dmake_build.Build('app', '/', 'Dockerfile',
+                                  cache_to='hub.example.com/app:cache')
+        build.build()
+        self.assertEqual(self.docker.builds[0]['buildargs'],
+                         {'BUILDKIT_INLINE_CACHE': '1'})
+        build.push()
+        self.docker.tag.assert_called_once_with(
+            'img1', 'hub.example.com/app', 'cache')
+        self.docker.push.assert_called_once_with(
+            'hub.example.com/app', 'cache', stream=True, decode=True)
+
+    def test_cache_to_failure_ignored(self, *_):
+        self.docker.push.side_effect = lambda repo, tag, **kw: iter(
+            [{'error': 'denied'}])
+        build = dmake_build.Build('app', '/', 'Dockerfile',
+                                  cache_to='hub.example.com/app:cache')
+        build.build()
+        build.push()
+
+
+class RewriteFromTests(WorkDirMixin, unittest2.TestCase):
+    def test_rewrite_dockerfile(self):
+        dockerfile = ('# syntax\n'
+                      'FROM --platform=$BUILDPLATFORM golang:1.9 as builder\n'
+                      'RUN make\n'
+                      'from builder AS test\n'
+                      'FROM\talpine\n'
+                      'COPY --from=builder /app /app\n')
+        self.assertEqual(
+            dmake_build.rewrite_dockerfile(dockerfile, 'sha256:1'),
+            '# syntax\n'
+            'FROM --platform=$BUILDPLATFORM sha256:1 as builder\n'
+            'RUN make\n'
+            'from builder AS test\n'
+            'FROM\tsha256:1\n'
+            'COPY --from=builder /app /app\n')
+
+    @mock.patch('dmake.cache.BuildCache.enabled', False)
+    @mock.patch('dmake.template_args.label_template_args', return_value={})
+    def test_working_tree_untouched(self, *_):
+        self.enter_workdir()
+        self.write('Dockerfile', 'FROM busybox\n')
+        docker = FakeDocker()
+        with mock.patch('dmake.utils.docker_client', return_value=docker):
+            build = dmake_build.Build('app', '/', 'Dockerfile',
+                                      rewrite_from='base')
+            build.rewrite_from = 'sha256:1'
+            build.build()
+        archive = tarfile.open(fileobj=io.BytesIO(docker.builds[0]['context']))
+        self.assertEqual(archive.extractfile('Dockerfile').read(),
+                         b'FROM sha256:1\n')
+        with open('Dockerfile') as f:
+            self.assertEqual(f.read(), 'FROM busybox\n')
+
+
+def make_archive(files, links=()):
+    buf = io.BytesIO()
+    archive = tarfile.open(fileobj=buf, mode='w')
+    for name, target, type in links:
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = target
+        archive.addfile(info)
+    for name, content in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+    archive.close()
+    return buf.getvalue()
+
+
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class BuildExtractTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.archive = make_archive([('bin/tool', b'\x00\x01binary'),
+                                     ('../evil', b'x')])
+        patcher = mock.patch('dmake.utils.docker_client')
+        self.docker = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.docker.create_container.return_value = {'Id': 'c1'}
+        self.docker.get_archive.side_effect = lambda c, src: (
+            io.BytesIO(self.archive), {})
+
+    def extract(self, rules):
+        build = dmake_build.Build('app', '/', 'Dockerfile', extract=rules)
+        build._extract_contents('img', build.extract)
+        self.docker.remove_container.assert_called_once_with({'Id': 'c1'})
+
+    def test_save_archive(self, *_):
+        self.extract(['/usr/bin:./bin.tar'])
+        with open('bin.tar', 'rb') as f:
+            self.assertEqual(f.read(), self.archive)
+
+    def test_unpack(self, *_):
+        self.extract(['/usr/bin:./out/'])
+        with open('out/bin/tool', 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01binary')
+        self.assertFalse(os.path.exists('evil'))
+
+    def test_links_leaving_the_directory_skipped(self, *_):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        self.archive = make_archive(
+            [('link/pwned', b'x'), ('bin/tool', b'ok')],
+            links=[('link', outside, tarfile.SYMTYPE),
+                   ('up', '../..', tarfile.SYMTYPE),
+                   ('hard', '../evil', tarfile.LNKTYPE),
+                   ('self', 'bin', tarfile.SYMTYPE)])
+        self.extract(['/usr/bin:./out/'])
+        self.assertEqual(os.listdir(outside), [])
+        self.assertEqual(sorted(os.listdir('out')), ['bin', 'link', 'self'])
+        self.assertFalse(os.path.islink('out/link'))
+        with open('out/self/tool', 'rb') as f:
+            self.assertEqual(f.read(), b'ok')
+
+    def test_checksum(self, *_):
+        digest = hashlib.sha256(self.archive).hexdigest()
+        self.extract(['/usr/bin:./bin.tar:sha256=%s' % digest])
+        self.assertTrue(os.path.exists('bin.tar'))
+        with self.assertRaises(ExtractFailed):
+            self.extract(['/usr/bin:./out/:sha256=%s' % ('0' * 64)])
+
+    def test_failed_extract_leaves_nothing(self, *_):
+        with self.assertRaises(ExtractFailed):
+            self.extract(['/usr/bin:./bin.tar:sha256=%s' % ('0' * 64)])
+        self.assertEqual(os.listdir('.'), [])
+
+    def test_paths_extracted_concurrently(self, *_):
+        both_requested = threading.Event()
+        requested = []
+
+        def get_archive(container, src):
+            requested.append(src)
+            if len(requested) == 2:
+                both_requested.set()
+            self.assertTrue(both_requested.wait(5))
+            return io.BytesIO(self.archive), {}
+
+        self.docker.get_archive.side_effect = get_archive
+        self.extract(['/usr/bin:./bin.tar', '/usr/lib:./lib/'])
+        self.assertEqual(sorted(requested), ['/usr/bin', '/usr/lib'])
+        self.assertEqual(sorted(os.listdir('.')), ['bin.tar', 'lib'])
+        self.assertEqual(os.listdir('lib'), ['bin'])
+
+
+@mock.patch('dmake.cache.BuildCache.enabled', False)
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class ExtractedIntoSharedContextTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.write('Dockerfile.dwait', 'FROM golang\n')
+        self.write('Dockerfile', 'FROM busybox\nADD dwait.bin.tar /\n')
+        self.write('main.go', 'package main\n')
+        index = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index)
+        self.docker = FakeDocker()
+        self.docker.create_container = mock.Mock(return_value={'Id': 'c1'})
+        self.docker.remove_container = mock.Mock()
+        self.docker.get_archive = mock.Mock(side_effect=lambda c, src: (
+            io.BytesIO(make_archive([('dwait', b'bin')])), {}))
+        for name, value in (
+                ('dmake.context.ContextScanner',
+                 context._ContextScanner(index)),
+                ('dmake.context.SharedContexts', context._SharedContexts()),
+                ('dmake.utils.docker_client',
+                 mock.Mock(return_value=self.docker))):
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_compile_then_deploy(self, *_):
+        # the layout of the readme: dresponse adds what dwait extracted
+        dwait = dmake_build.Build('dwait', '/', 'Dockerfile.dwait',
+                                  extract=['/go/bin/.:./dwait.bin.tar'])
+        dresponse = dmake_build.Build('dresponse', '/', 'Dockerfile',
+                                      depends_on=['dwait'])
+        for build in (dwait, dresponse):
+            build.share_context()
+        dwait.build()
+        dresponse.build()
+        names = [sorted(tarfile.open(
+            fileobj=io.BytesIO(build['context'])).getnames())
+            for build in self.docker.builds]
+        self.assertEqual(names, [
+            ['Dockerfile', 'Dockerfile.dwait', 'main.go'],
+            ['Dockerfile', 'Dockerfile.dwait', 'dwait.bin.tar', 'main.go']])
+        self.assertIn('dwait.bin.tar', [
+            e[0] for e in dresponse.scan_context().entries])
@@ -0,0 +1,161 @@
+import os
+
+import unittest2
+from docker import errors as docker_errors
+from mock import mock
+
+from dmake import build as dmake_build
+from dmake import cache
+from dmake import context
+from .helpers import WorkDirMixin
+
+
+class BuildCacheTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(self.enter_workdir(), 'sub',
+                                     'builds.json')
+
+    def test_persist(self):
+        c = cache._BuildCache(self.filename)
+        self.assertIsNone(c.get('k1'))
+        c.put('k1', 'sha256:1', 'app')
+        c.save()
+        self.assertEqual(cache._BuildCache(self.filename).get('k1'),
+                         'sha256:1')
+
+    def test_save_merges_concurrent_runs(self):
+        c1 = cache._BuildCache(self.filename)
+        c2 = cache._BuildCache(self.filename)
+        c1.get('k')
+        c2.put('k2', 'sha256:2')
+        c2.save()
+        c1.put('k1', 'sha256:1')
+        c1.save()
+        c = cache._BuildCache(self.filename)
+        self.assertEqual(c.get('k1'), 'sha256:1')
+        self.assertEqual(c.get('k2'), 'sha256:2')
+
+    def test_failed_save_leaves_nothing(self):
+        def dump(f):
+            f.write('{')
+            raise IOError('disk full')
+        self.assertFalse(cache.save_file(self.filename, dump, 'test'))
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), [])
+        c = cache._BuildCache(self.filename)
+        c.put('k1', 'sha256:1')
+        with mock.patch('json.dump', side_effect=IOError('disk full')):
+            c.save()
+        # kept for the next save
+        c.save()
+        self.assertEqual(cache._BuildCache(self.filename).get('k1'),
+                         'sha256:1')
+
+    def test_disabled_does_not_save(self):
+        c = cache._BuildCache(self.filename)
+        c.enabled = False
+        c.put('k1', 'sha256:1')
+        c.save()
+        self.assertFalse(os.path.exists(self.filename))
+
+
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+@mock.patch('dmake.utils.docker_client')
+class BuildCacheKeyTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.context = self.enter_workdir()
+        self.cache = cache._BuildCache(os.path.join(self.context, 'c.json'))
+        self.scanner = context._ContextScanner(
+            os.path.join(self.context, 'index'))
+        for name, value in (('dmake.cache.BuildCache', self.cache),
+                            ('dmake.context.ContextScanner', self.scanner)):
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.write('Dockerfile', 'FROM busybox\nCOPY . /app\n')
+        self.write('app.py', 'print 1\n')
+        self.write('ignored/big.bin', 'x' * 100)
+
+    def write(self, path, content):
+        # replaced rather than appended to
+        if os.path.exists(path):
+            os.remove(path)
+        WorkDirMixin.write(self, path, content)
+        # contexts are scanned once per run
+        self.scanner._scans.clear()
+
+    def make_build(self, **kwargs):
+        return dmake_build.Build('app', '/', 'Dockerfile',
+                                 dockerignore=['ignored', 'c.json', 'index'],
+                                 **kwargs)
+
+    def test_key_tracks_inputs(self, docker_client, *_):
+        docker_client.return_value.inspect_image.return_value = {'Id': 'b1'}
+        build = self.make_build()
+        key = build.cache_key({})
+        self.assertEqual(key, self.make_build().cache_key({}))
+
+        self.write('ignored/big.bin', 'y')
+        self.assertEqual(key, build.cache_key({}))
+        self.assertNotEqual(key, build.cache_key({'A': '1'}))
+
+        docker_client.return_value.inspect_image.return_value = {'Id': 'b2'}
+        self.assertNotEqual(key, build.cache_key({}))
+        docker_client.return_value.inspect_image.return_value = {'Id': 'b1'}
+
+        self.write('app.py', 'print 2\n')
+        self.assertNotEqual(key, build.cache_key({}))
+
+    def test_parent_from_args(self, docker_client, *_):
+        inspect = docker_client.return_value.inspect_image
+        inspect.side_effect = lambda image: {'Id': 'id-' + image}
+        self.write('Dockerfile', 'ARG BASE=busybox\nARG TAG\n'
+                                 'FROM ${BASE}:${TAG:-1} AS base\nFROM base\n')
+        build = self.make_build()
+        self.assertEqual(build._parent_image_ids({}), ['id-busybox:1'])
+        self.assertEqual(build._parent_image_ids({'BASE': 'alpine',
+                                                  'TAG': '3'}),
+                         ['id-alpine:3'])
+        self.assertNotEqual(build.cache_key({}),
+                            build.cache_key({'BASE': 'alpine'}))
+
+    def test_unknown_parent_not_cached(self, docker_client, *_):
+        docker = docker_client.return_value
+        docker.inspect_image.side_effect = docker_errors.APIError('bad')
+        self.write('Dockerfile', 'ARG BASE\nFROM $BASE\n')
+        build = self.make_build()
+        self.assertIsNone(build.cache_key({}))
+        self.write('Dockerfile', 'FROM busybox\n')
+        self.assertIsNone(build.cache_key({}))
+        with mock.patch.object(build, '_build_image',
+                               return_value='img1') as build_locked:
+            self.assertEqual(build._build(), 'img1')
+            self.assertEqual(build._build(), 'img1')
+        self.assertEqual(build_locked.call_count, 2)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_hit_skips_build(self, docker_client, *_):
+        docker_client.return_value.inspect_image.return_value = {'Id': 'b1'}
+        build = self.make_build()
+        with mock.patch.object(build, '_build_image',
+                               return_value='img1') as build_locked:
+            self.assertEqual(build._build(), 'img1')
+            self.assertEqual(build._build(), 'img1')
+        build_locked.assert_called_once_with({})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_stale_image_rebuilt(self, docker_client, *_):
+        docker = docker_client.return_value
+        build = self.make_build()
+        with mock.patch.object(build, '_build_image',
+                               return_value='img1') as build_locked:
+            docker.inspect_image.return_value = {'Id': 'b1'}
+            build._build()
+
+            def inspect_image(image):
+                if image == 'img1':
+                    raise docker_errors.NotFound('gone')
+                return {'Id': 'b1'}
+            docker.inspect_image.side_effect = inspect_image
+            build._build()
+        self.assertEqual(build_locked.call_count, 2)
+        self.assertEqual(self.cache.stale, 1)
@@ -0,0 +1,65 @@
+import subprocess
+
+import unittest2
+from mock import mock
+
+from dmake import build as dmake_build
+from dmake import changes
+from dmake.errors import DmakeError
+from .helpers import WorkDirMixin
+
+
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class ChangesTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.enter_workdir()
+        for path in ('.docker-make.yml', 'base/Dockerfile', 'app/Dockerfile',
+                     'app/src/main.py', 'app/docs/index.md'):
+            self.write(path)
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.git('-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-qm',
+                 'init')
+
+    def git(self, *args):
+        subprocess.check_call(('git',) + args)
+
+    def affected(self):
+        builds = [
+            dmake_build.Build('base', '/base', 'Dockerfile'),
+            dmake_build.Build('app', '/app', 'Dockerfile',
+                              dockerignore=['docs']),
+            dmake_build.Build('root', '/', 'base/Dockerfile',
+                              dockerignore=['app']),
+        ]
+        return changes.affected_builds(builds,
+                                       changes.changed_files('HEAD'),
+                                       '.docker-make.yml')
+
+    def test_nothing_changed(self, *_):
+        self.assertEqual(self.affected(), set())
+
+    def test_context_files(self, *_):
+        self.write('app/docs/index.md')
+        self.assertEqual(self.affected(), set())
+        self.write('app/src/new.py')
+        self.assertEqual(self.affected(), set(['app']))
+
+    def test_dockerfile(self, *_):
+        self.write('base/Dockerfile')
+        self.assertEqual(self.affected(), set(['base', 'root']))
+
+    def test_moved_file(self, *_):
+        self.git('mv', 'app/src/main.py', 'base/main.py')
+        self.git('-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-qm',
+                 'move')
+        self.assertEqual(changes.changed_files('HEAD~1'),
+                         set(['app/src/main.py', 'base/main.py']))
+
+    def test_config_affects_all(self, *_):
+        self.write('.docker-make.yml')
+        self.assertEqual(self.affected(), set(['base', 'app', 'root']))
+
+    def test_bad_ref(self, *_):
+        with self.assertRaises(DmakeError):
+            changes.changed_files('no-such-ref')
@@ -0,0 +1,81 @@
+import unittest2
+from mock import mock
+
+import dmake.build
+from dmake import cli
+from dmake import config
+from .helpers import WorkDirMixin
+
+
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class WatchTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.enter_workdir()
+        for path in ('.docker-make.yml', 'Dockerfile', 'Dockerfile.dwait',
+                     'dwait.go', 'docs/index.md'):
+            self.write(path)
+        self.config = config.Config.from_dict({'builds': {
+            'dwait': {
+                'context': '/', 'dockerfile': 'Dockerfile.dwait',
+                'dockerignore': ['Dockerfile', 'notes'],
+                'extract': ['/usr/src/dwait/bin/.:./dwait.bin.tar',
+                            '/usr/src/dwait/docs:./out/'],
+            },
+            'dresponse': {
+                'context': '/', 'dockerfile': 'Dockerfile',
+                'dockerignore': ['docs', 'notes', '*.dwait', '*.go'],
+                'depends_on': ['dwait'],
+            },
+        }})
+        self.args = mock.Mock(dmakefile='.docker-make.yml')
+        self.runs = []
+        self.failing = set()
+        for name, value in (('dmake.watch.watcher', mock.Mock()),
+                            ('dmake.cli._run', self.run_builds)):
+            patcher = mock.patch(name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_builds(self, config, builds, order, args):
+        self.runs.append(order)
+        for name in order:
+            builds[name].final_image = (None if name in self.failing
+                                        else 'sha256:' + name)
+        return 1 if self.failing & set(order) else None
+
+    def watch(self, *changes, **kwargs):
+        builds = dict(
+            (name, dmake.build.Build(name=name, **build.kwargs()))
+            for name, build in self.config.builds.items())
+        for name in builds:
+            builds[name].final_image = 'sha256:' + name
+        changes = iter(changes)
+
+        def wait(watcher):
+            for paths in changes:
+                return set(paths)
+            raise KeyboardInterrupt()
+        with mock.patch('dmake.watch.wait', side_effect=wait):
+            return cli._watch(self.config, builds, self.config.order,
+                              self.args, kwargs.get('status'))
+
+    def test_affected_builds_and_dependents(self, *_):
+        self.assertIsNone(self.watch(['Dockerfile'], ['docs/index.md']))
+        self.assertEqual(self.runs, [['dresponse'], ['dwait', 'dresponse']])
+
+    def test_extracts_ignored(self, *_):
+        self.watch(['dwait.bin.tar', '.dmake-extract.x3f', 'out/index.md',
+                    '.dmake-extract.k2/index.md'],
+                   ['.docker-make.yml'])
+        self.assertEqual(self.runs, [])
+
+    def test_failed_builds_retried(self, *_):
+        self.failing.add('dresponse')
+        self.assertEqual(self.watch(['Dockerfile'], ['notes/todo']), 1)
+        self.assertEqual(self.runs, [['dresponse'], ['dresponse']])
+        self.failing.clear()
+        self.assertIsNone(self.watch(['Dockerfile'], ['notes/todo']))
+        self.assertEqual(self.runs[2:], [['dresponse']])
+
+    def test_status_kept(self, *_):
+        self.assertEqual(self.watch(status=1), 1)
@@ -0,0 +1,154 @@
+import os
+
+import unittest2
+from mock import mock
+
+from dmake import config
+from dmake.errors import ConfigurationError, ValidateError
+from .helpers import WorkDirMixin
+
+
+CONFIG = """
+tag-names:
+  - name: time
+    type: datetime
+    value: '%%H%%M'
+  - name: broken
+    type: cmd
+builds:
+  base:
+    context: /
+    dockerfile: Dockerfile.base
+  app:
+    context: /app
+    dockerfile: Dockerfile
+    depends_on:
+      - base
+    pushes:
+      - 'always=hub.example.com:5000/app:{fcommitid}'
+    extract:
+      - '/usr/bin:./out/:sha256=%s'
+""" % ('A' * 64)
+
+
+class ConfigTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = self.enter_workdir()
+        self.filename = os.path.join(self.tmpdir, '.docker-make.yml')
+        self.write(CONFIG)
+        patcher = mock.patch('dmake.cache.cache_dir',
+                             return_value=os.path.join(self.tmpdir, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, content):
+        # the configuration is replaced rather than appended to
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        WorkDirMixin.write(self, self.filename, content)
+
+    def test_model(self):
+        c = config.load(self.filename)
+        self.assertEqual(c.order, ['base', 'app'])
+        self.assertEqual([t.name for t in c.tag_names], ['time'])
+        app = c.builds['app']
+        self.assertEqual(list(app.pushes[0]),
+                         ['always', 'hub.example.com:5000/app', '{fcommitid}'])
+        self.assertEqual((app.extract[0].dst, app.extract[0].unpack,
+                          app.extract[0].sha256), ('./out/', True, 'a' * 64))
+        self.assertEqual(c.graph.dependencies,
+                         {'base': set(), 'app': set(['base'])})
+        self.assertEqual(app.kwargs()['depends_on'], ['base'])
+
+    def test_errors(self):
+        self.write('builds: {app: {context: /}}')
+        with self.assertRaises(ValidateError):
+            config.load(self.filename)
+        self.write('builds: {app: {context: /, dockerfile: D, image: x}}')
+        with self.assertRaises(ValidateError):
+            config.load(self.filename)
+        self.write('builds: {app: {context: /, dockerfile: D, '
+                   'pushes: [latest]}}')
+        with self.assertRaises(ConfigurationError):
+            config.load(self.filename)
+        self.write('builds: [')
+        with self.assertRaises(ConfigurationError):
+            config.load(self.filename)
+        with self.assertRaises(ConfigurationError):
+            config.load(os.path.join(self.tmpdir, 'absent.yml'))
+
+    def test_matrix(self):
+        self.write('''
+builds:
+  base:
+    context: /
+    dockerfile: Dockerfile.{os}
+    matrix: {jdk: [8, 17], os: [alpine]}
+    buildargs: ['JDK={jdk}']
+    pushes: ['always=hub.example.com/base:{fcommitid}-jdk{jdk}']
+    labels: ['com.example.jdk={jdk}', 'com.example.commit={fcommitid}']
+  app:
+    context: /app
+    dockerfile: Dockerfile
+    matrix: {jdk: [8, 17]}
+    rewrite_from: 'base[jdk={jdk},os=alpine]'
+  tests:
+    context: /tests
+    dockerfile: Dockerfile
+    depends_on: [app]
+''')
+        c = config.load(self.filename)
+        self.assertEqual(c.order, ['base[jdk=17,os=alpine]', 'app[jdk=17]',
+                                   'base[jdk=8,os=alpine]', 'app[jdk=8]',
+                                   'tests'])
+        base = c.builds['base[jdk=17,os=alpine]']
+        self.assertEqual(base.dockerfile, 'Dockerfile.alpine')
+        self.assertEqual(base.buildargs, ['JDK=17'])
+        self.assertEqual(base.pushes[0].tag_template, '{fcommitid}-jdk17')
+        self.assertEqual(base.labels, ['com.example.jdk=17',
+                                       'com.example.commit={fcommitid}'])
+        self.assertEqual(c.builds['app[jdk=8]'].rewrite_from,
+                         'base[jdk=8,os=alpine]')
+        self.assertEqual(sorted(c.builds['tests'].depends_on),
+                         ['app[jdk=17]', 'app[jdk=8]'])
+
+    def test_matrix_errors(self):
+        for build in ('matrix: [8, 17]', 'matrix: {jdk: []}',
+                      'matrix: {jdk: [8, "1,2"]}', 'matrix: {j-k: [8]}'):
+            self.write('builds: {app: {context: /, dockerfile: D, %s}}' %
+                       build)
+            with self.assertRaises(ValidateError):
+                config.load(self.filename)
+        self.write('builds: {base: {context: /, dockerfile: D, '
+                   'matrix: {jdk: [8, 17]}}, '
+                   'app: {context: /, dockerfile: D, rewrite_from: base}}')
+        with self.assertRaisesRegexp(ValidateError, 'base\\[jdk=8\\]'):
+            config.load(self.filename)
+
+    def test_platforms(self):
+        self.write('builds: {app: {context: /, dockerfile: D, '
+                   'platforms: [linux/amd64, linux/arm/v7]}}')
+        self.assertEqual(config.load(self.filename).builds['app'].platforms,
+                         ['linux/amd64', 'linux/arm/v7'])
+        for platforms in ('linux/amd64', '[amd64]', '[linux/amd64, '
+                          'linux/amd64]'):
+            self.write('builds: {app: {context: /, dockerfile: D, '
+                       'platforms: %s}}' % platforms)
+            with self.assertRaises(ValidateError):
+                config.load(self.filename)
+
+    def test_cache(self):
+        config.load(self.filename, use_cache=True)
+        with mock.patch('dmake.config._parse') as parse:
+            c = config.load(self.filename, use_cache=True)
+            self.assertEqual(c.order, ['base', 'app'])
+
+            # same content, new mtime
+            os.utime(self.filename, (0, 0))
+            config.load(self.filename, use_cache=True)
+            self.assertFalse(parse.called)
+
+        self.write(CONFIG.replace('base:', 'base2:', 1)
+                   .replace('- base', '- base2'))
+        c = config.load(self.filename, use_cache=True)
+        self.assertEqual(c.order, ['base2', 'app'])
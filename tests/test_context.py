@@ -0,0 +1,249 @@
+import io
+import os
+import tarfile
+
+import unittest2
+from mock import mock
+
+from docker.utils import build as docker_build_utils
+
+from dmake import context
+from .helpers import WorkDirMixin
+
+
+class IgnoreRulesTests(unittest2.TestCase):
+    def test_patterns(self):
+        rules = context.IgnoreRules(['.git', '*.pyc', 'docs/**/*.md',
+                                     '/build/', '# comment'])
+        self.assertTrue(rules.excluded('.git'))
+        self.assertTrue(rules.excluded('.git/HEAD'))
+        self.assertTrue(rules.excluded('a.pyc'))
+        self.assertFalse(rules.excluded('pkg/a.pyc'))
+        self.assertTrue(rules.excluded('docs/a/b/c.md'))
+        self.assertFalse(rules.excluded('docs/a/b/c.txt'))
+        self.assertTrue(rules.excluded('build/out'))
+        self.assertFalse(rules.excluded('# comment'))
+
+    def test_double_star(self):
+        rules = context.IgnoreRules(['**/node_modules', '**/*.md'])
+        for path in ('node_modules', 'node_modules/x', 'a/node_modules/x',
+                     'README.md', 'a/b/c.md'):
+            self.assertTrue(rules.excluded(path), path)
+        self.assertFalse(rules.excluded('a/node_modules_x'))
+
+    def test_exceptions_later_rules_win(self):
+        rules = context.IgnoreRules(['*.md', '!README.md', 'README*'])
+        self.assertTrue(rules.excluded('CHANGES.md'))
+        self.assertTrue(rules.excluded('README.md'))
+        rules = context.IgnoreRules(['*.md', '!README.md'])
+        self.assertFalse(rules.excluded('README.md'))
+
+    def test_may_include_below(self):
+        rules = context.IgnoreRules(['vendor', '!vendor/keep/*'],
+                                    always_include=['sub/Dockerfile'])
+        self.assertTrue(rules.may_include_below('vendor'))
+        self.assertFalse(rules.may_include_below('other'))
+        self.assertTrue(rules.may_include_below('sub'))
+
+
+class DockerPyTests(WorkDirMixin, unittest2.TestCase):
+    """the files of a context are the ones docker-py sends"""
+
+    def setUp(self):
+        self.root = self.enter_workdir()
+        for path in ('Dockerfile', 'README.md', 'a/x.py', 'a/b/c.md',
+                     'src/main.py', 'src/x.pyc', 'node_modules/x/index.js',
+                     'a/node_modules/y.js', 'docs/a/b.md', 'docs/a/b.txt',
+                     'build/out/bin', '.git/HEAD'):
+            self.write(path, path)
+
+    def check(self, patterns):
+        scan = context._ContextScanner(self.root).scan(self.root, patterns)
+        expected = docker_build_utils.exclude_paths(self.root, patterns)
+        self.assertEqual(sorted(e[0] for e in scan.entries),
+                         sorted(p.replace(os.sep, '/') for p in expected))
+
+    def test_patterns(self):
+        for patterns in (['**/node_modules', '**/*.md'],
+                         ['docs/**/*.md', '*.pyc', '.git', '/build/'],
+                         ['**/*.pyc', 'a/**', 'src/'],
+                         ['**', '!src', '!Dockerfile'],
+                         ['*/node_modules', 'a/b']):
+            self.check(patterns)
+
+
+class ContextScannerTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        workdir = self.enter_workdir()
+        # the index is kept out of the context
+        self.root = os.path.join(workdir, 'context')
+        self.index_dir = os.path.join(workdir, 'index')
+        self.write('Dockerfile', 'FROM busybox\n')
+        self.write('src/app.py', 'print 1\n')
+        self.write('vendor/lib.py', 'x' * 10)
+        self.write('vendor/keep/keep.py', 'y')
+
+    def write(self, path, content, age=60):
+        path = os.path.join(self.root, path)
+        if os.path.exists(path):
+            os.remove(path)
+        WorkDirMixin.write(self, path, content)
+        st = os.stat(path)
+        os.utime(path, (st.st_atime - age, st.st_mtime - age))
+
+    def test_scan(self):
+        scanner = context._ContextScanner(self.index_dir)
+        scan = scanner.scan(self.root, ['vendor', '!vendor/keep'])
+        paths = [e[0] for e in scan.entries]
+        self.assertEqual(paths, ['Dockerfile', 'src', 'src/app.py',
+                                 'vendor/keep', 'vendor/keep/keep.py'])
+        self.assertEqual(scan.file_count, 3)
+        self.assertEqual(scan.total_bytes, len('FROM busybox\nprint 1\ny'))
+        self.assertIs(scan, scanner.scan(self.root, ['vendor',
+                                                     '!vendor/keep']))
+
+    def test_dockerfile_always_included(self):
+        self.write('docker/Dockerfile', 'FROM busybox\n')
+        scanner = context._ContextScanner(self.index_dir)
+        scan = scanner.scan(self.root, ['docker', 'vendor'],
+                            'docker/Dockerfile')
+        self.assertIn('docker/Dockerfile', [e[0] for e in scan.entries])
+
+    def test_only_changed_files_rehashed(self):
+        scanner = context._ContextScanner(self.index_dir)
+        digest = scanner.scan(self.root, []).digest
+        scanner.save()
+
+        scanner = context._ContextScanner(self.index_dir)
+        with mock.patch('hashlib.sha256', wraps=context.hashlib.sha256) as h:
+            self.assertEqual(scanner.scan(self.root, []).digest, digest)
+        # only the digest of the whole context is computed
+        self.assertEqual(h.call_count, 1)
+        self.assertEqual(scanner.hashed_bytes, 0)
+
+        self.write('src/app.py', 'print 2\n')
+        scanner = context._ContextScanner(self.index_dir)
+        self.assertNotEqual(scanner.scan(self.root, []).digest, digest)
+        self.assertEqual(scanner.hashed_bytes, len('print 2\n'))
+
+    def test_recent_files_not_indexed(self):
+        self.write('src/app.py', 'print 2\n', age=0)
+        scanner = context._ContextScanner(self.index_dir)
+        scanner.scan(self.root, [])
+        scanner.save()
+        scanner = context._ContextScanner(self.index_dir)
+        scanner.scan(self.root, [])
+        self.assertEqual(scanner.hashed_bytes, len('print 2\n'))
+
+
+class StreamContextTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.root = self.enter_workdir()
+        for path, content in (('Dockerfile', 'FROM busybox\n'),
+                              ('src/app.py', 'print 1\n'),
+                              ('big.bin', os.urandom(3 * context.CHUNK_SIZE)),
+                              ('.git/HEAD', 'ref: refs/heads/master\n')):
+            self.write(path, content)
+        os.symlink('src/app.py', 'link')
+        self.scan = context._ContextScanner(self.root).scan(self.root,
+                                                            ['.git'])
+
+    def check_archive(self, fileobj, mode):
+        archive = tarfile.open(fileobj=fileobj, mode=mode)
+        members = dict((m.name, m) for m in archive.getmembers())
+        self.assertEqual(sorted(members), ['Dockerfile', 'big.bin', 'link',
+                                           'src', 'src/app.py'])
+        self.assertTrue(members['src'].isdir())
+        self.assertEqual(members['link'].linkname, 'src/app.py')
+        with open(os.path.join(self.root, 'big.bin'), 'rb') as f:
+            self.assertEqual(archive.extractfile('big.bin').read(), f.read())
+        self.assertEqual(archive.extractfile('src/app.py').read(),
+                         'print 1\n')
+
+    def test_plain(self):
+        chunks = list(context.stream_context(self.scan))
+        self.assertTrue(len(chunks) > 1)
+        self.check_archive(io.BytesIO(b''.join(chunks)), 'r:')
+
+    def test_gzip(self):
+        data = b''.join(context.stream_context(self.scan, 'gzip'))
+        self.check_archive(io.BytesIO(data), 'r:gz')
+
+
+class SharedContextsTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.root = self.enter_workdir()
+        for path in ('Dockerfile.a', 'Dockerfile.b', 'src/app.py'):
+            self.write(path, path)
+        scanner = context._ContextScanner(self.root)
+        patcher = mock.patch('dmake.context.ContextScanner', scanner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shared = context._SharedContexts()
+
+    def names(self, chunks, mode='r:'):
+        archive = tarfile.open(fileobj=io.BytesIO(b''.join(chunks)),
+                               mode=mode)
+        return sorted(m.name for m in archive.getmembers())
+
+    def test_archive_replayed(self):
+        patterns = ['Dockerfile.*']
+        self.shared.register(self.root, patterns, 'Dockerfile.a')
+        self.shared.register(self.root, patterns, 'Dockerfile.b')
+        self.assertEqual(self.names(self.shared.stream(
+            self.root, patterns, 'Dockerfile.a', 'gzip'), 'r:gz'),
+            ['Dockerfile.a', 'src', 'src/app.py'])
+
+        # the second build does not read the context again
+        os.remove(os.path.join(self.root, 'src/app.py'))
+        self.assertEqual(self.names(self.shared.stream(
+            self.root, patterns, 'Dockerfile.b', 'gzip'), 'r:gz'),
+            ['Dockerfile.b', 'src', 'src/app.py'])
+
+    def test_changed_during_the_run(self):
+        patterns = []
+        self.shared.register(self.root, patterns, 'Dockerfile.a')
+        self.shared.register(self.root, patterns, 'Dockerfile.b')
+        b''.join(self.shared.stream(self.root, patterns, 'Dockerfile.a'))
+        self.write('out.tar', 'built by a')
+        self.shared.changed(os.path.join(self.root, 'out.tar'))
+        self.assertIn('out.tar', self.names(self.shared.stream(
+            self.root, patterns, 'Dockerfile.b')))
+        self.assertIn('out.tar', [e[0] for e in self.shared.scan(
+            self.root, patterns, 'Dockerfile.b').entries])
+
+    def test_other_dockerfiles_left_out(self):
+        patterns = ['Dockerfile.*']
+        self.shared.register(self.root, patterns, 'Dockerfile.a')
+        self.shared.register(self.root, patterns, 'Dockerfile.b')
+        scan = self.shared.scan(self.root, patterns, 'Dockerfile.a')
+        self.assertEqual([e[0] for e in scan.entries],
+                         ['Dockerfile.a', 'src', 'src/app.py'])
+
+        context.ContextScanner.forget_scans()
+        self.write('Dockerfile.b', 'RUN true\n')
+        self.assertEqual(self.shared.scan(self.root, patterns,
+                                          'Dockerfile.a').digest, scan.digest)
+
+    def test_overrides(self):
+        patterns = ['Dockerfile.a']
+        self.shared.register(self.root, patterns, 'Dockerfile.b')
+        self.shared.register(self.root, patterns, 'Dockerfile.b')
+        for _ in range(2):
+            data = b''.join(self.shared.stream(
+                self.root, patterns, 'Dockerfile.b', 'gzip',
+                [('Dockerfile.b', b'FROM sha256:1\n')]))
+            archive = tarfile.open(fileobj=io.BytesIO(data), mode='r:gz')
+            self.assertEqual(archive.extractfile('Dockerfile.b').read(),
+                             b'FROM sha256:1\n')
+        with open(os.path.join(self.root, 'Dockerfile.b')) as f:
+            self.assertNotIn('sha256', f.read())
+
+    def test_unshared_context_streamed(self):
+        self.shared.register(self.root, [], 'Dockerfile.a')
+        self.shared.register(self.root, ['src'], 'Dockerfile.b')
+        self.assertEqual(self.names(self.shared.stream(
+            self.root, ['src'], 'Dockerfile.b')),
+            ['Dockerfile.a', 'Dockerfile.b'])
+        group = self.shared._group(self.root, ['src'])
+        self.assertIsNone(group.spool)
@@ -0,0 +1,73 @@
+import unittest2
+
+from dmake import utils
+from dmake.errors import BuildUnDefined, DependencyError
+from dmake.graph import BuildGraph
+
+
+class BuildGraphTests(unittest2.TestCase):
+    def setUp(self):
+        # base <- java <- java-app1, base <- php, java-app1 rewrites from php
+        self.graph = BuildGraph({
+            'base': [],
+            'java': ['base'],
+            'php': ['base'],
+            'java-app1': ['java', 'php'],
+            'tools': [],
+        })
+
+    def test_topological_order(self):
+        self.assertEqual(self.graph.topological_order(),
+                         ['base', 'java', 'php', 'java-app1', 'tools'])
+
+    def test_deep_chain(self):
+        deps = dict(('b%d' % i, ['b%d' % (i - 1)] if i else [])
+                    for i in range(5000))
+        order = BuildGraph(deps).topological_order()
+        self.assertEqual(order[:2], ['b0', 'b1'])
+        self.assertEqual(order[-1], 'b4999')
+
+    def test_cycle_path(self):
+        graph = BuildGraph({'a': ['c'], 'b': ['a'], 'c': ['b'], 'd': ['a']})
+        with self.assertRaises(DependencyError) as cm:
+            graph.topological_order()
+        self.assertEqual(cm.exception.message,
+                         'Circular dependency: a -> c -> b -> a')
+        with self.assertRaisesRegexp(DependencyError, 'itself: a'):
+            BuildGraph({'a': ['a']}).topological_order()
+
+    def test_ancestors_descendants(self):
+        self.assertEqual(self.graph.ancestors(['java-app1']),
+                         set(['base', 'java', 'php']))
+        self.assertEqual(self.graph.descendants(['php']),
+                         set(['java-app1']))
+        self.assertEqual(self.graph.descendants(['tools']), set())
+
+    def test_expand_wants(self):
+        self.assertEqual(utils.expand_wants(self.graph, ['php', 'tools']),
+                         set(['base', 'php', 'tools']))
+        with self.assertRaises(BuildUnDefined):
+            utils.expand_wants(self.graph, ['nope'])
+
+    def test_expand_matrix_wants(self):
+        graph = BuildGraph({
+            'base[jdk=8]': [],
+            'base[jdk=17]': [],
+            'app[jdk=8,os=alpine]': ['base[jdk=8]'],
+            'app[jdk=17,os=alpine]': ['base[jdk=17]'],
+            'app[jdk=17,os=debian]': ['base[jdk=17]'],
+        })
+        self.assertEqual(utils.expand_wants(graph, ['app[jdk=8]']),
+                         set(['app[jdk=8,os=alpine]', 'base[jdk=8]']))
+        self.assertEqual(utils.expand_wants(graph, ['base']),
+                         set(['base[jdk=8]', 'base[jdk=17]']))
+        self.assertEqual(
+            utils.expand_wants(graph, ['app[os=debian,jdk=17]']),
+            set(['app[jdk=17,os=debian]', 'base[jdk=17]']))
+        for want in ('app[jdk=11]', 'app[jdk]', 'ap'):
+            with self.assertRaises(BuildUnDefined):
+                utils.expand_wants(graph, [want])
+
+    def test_sort_builds_dict_follows_rewrite_from(self):
+        builds = {'base': {}, 'app': {'rewrite_from': 'base'}}
+        self.assertEqual(utils.sort_builds_dict(builds), ['base', 'app'])
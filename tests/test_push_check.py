@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+import unittest2
+from mock import mock
+
+from dmake import build as dmake_build
+from dmake import utils
+
+
+class _Daemon(BaseHTTPServer.BaseHTTPRequestHandler):
+    """the docker daemon and the registry behind it, as far as a push
+    needs them: local images with their repo digests, and the manifest
+    digests of the tags in the registry.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        self.server.requests.append(('GET', path))
+        if path.endswith('/version'):
+            return self.reply(200, {'ApiVersion': '1.30'})
+        name = path.split('/', 3)[-1].rsplit('/', 1)[0]
+        if path.startswith('/v1.30/images/'):
+            return self.reply(200, {'Id': 'sha256:1',
+                                    'RepoDigests': self.server.local})
+        if path.startswith('/v1.30/distribution/'):
+            if name not in self.server.remote:
+                return self.reply(404, {'message': 'manifest unknown'})
+            return self.reply(200, {'Descriptor': {
+                'digest': self.server.remote[name]}})
+        self.reply(404, {'message': 'no such route'})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        self.server.requests.append(('POST', url.path))
+        tag = urlparse.parse_qs(url.query)['tag'][0]
+        self.reply(200, {'status': 'Pushed', 'aux': {'Tag': tag,
+                                                     'Digest': 'sha256:new'}})
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # clients of different kinds hold connections open at once
+    daemon_threads = True
+
+
+@mock.patch('dmake.template_args.tag_template_args', return_value={})
+@mock.patch('dmake.template_args.label_template_args', return_value={})
+class PushCheckTests(unittest2.TestCase):
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Daemon)
+        self.server.requests = []
+        self.server.local = []
+        self.server.remote = {}
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        clients = utils._DockerClients()
+        clients.version_cache = os.path.join(cache, 'api-versions.json')
+        self.addCleanup(clients.reset)
+        for patcher in (
+                mock.patch.dict(os.environ, {
+                    'DOCKER_HOST': 'tcp://127.0.0.1:%d' %
+                                   self.server.server_port,
+                    'DOCKER_CONFIG': cache}),
+                mock.patch('dmake.utils.DockerClients', clients)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def push(self, force=False):
+        build = dmake_build.Build(
+            'app', '/', 'Dockerfile', force_push=force,
+            pushes=['always=registry.example.com/app:latest'])
+        skipped = utils.Summary.get('pushes skipped, already in registry')
+        build.push()
+        skipped = (utils.Summary.get('pushes skipped, already in registry') -
+                   skipped)
+        pushes = [path for method, path in self.server.requests
+                  if method == 'POST']
+        return pushes, skipped
+
+    def checked(self):
+        return [path for _, path in self.server.requests
+                if '/distribution/' in path]
+
+    def test_up_to_date_skipped(self, *_):
+        self.server.local = ['registry.example.com/app@sha256:a']
+        self.server.remote['registry.example.com/app:latest'] = 'sha256:a'
+        self.assertEqual(self.push(), ([], 1))
+
+    def test_changed_pushed(self, *_):
+        self.server.local = ['registry.example.com/app@sha256:a']
+        self.server.remote['registry.example.com/app:latest'] = 'sha256:b'
+        self.assertEqual(self.push(), (
+            ['/v1.30/images/registry.example.com/app/push'], 0))
+
+    def test_missing_tag_pushed(self, *_):
+        self.server.local = ['registry.example.com/app@sha256:a']
+        self.assertEqual(len(self.push()[0]), 1)
+
+    def test_never_pushed_not_checked(self, *_):
+        self.server.local = ['other.example.com/app@sha256:a']
+        self.server.remote['registry.example.com/app:latest'] = 'sha256:a'
+        self.assertEqual(len(self.push()[0]), 1)
+        self.assertFalse(self.checked())
+
+    def test_force_push(self, *_):
+        self.server.local = ['registry.example.com/app@sha256:a']
+        self.server.remote['registry.example.com/app:latest'] = 'sha256:a'
+        self.assertEqual(len(self.push(force=True)[0]), 1)
+        self.assertFalse(self.checked())
+
+    def test_docker_hub_names(self, *_):
+        self.assertTrue(dmake_build._same_repo('docker.io/library/busybox',
+                                               'busybox'))
+        self.assertTrue(dmake_build._same_repo('user/app',
+                                               'docker.io/user/app'))
+        self.assertFalse(dmake_build._same_repo('a.example.com/app', 'app'))
@@ -0,0 +1,131 @@
+import json
+import base64
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+import unittest2
+from mock import mock
+
+from dmake import registry
+from dmake.errors import PushFailed
+
+
+class _Registry(BaseHTTPServer.BaseHTTPRequestHandler):
+    """a registry asking for bearer tokens, which it hands out at /token to
+    `user:secret`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def authorized(self):
+        if self.headers.get('Authorization') == 'Bearer t0ken':
+            return True
+        self.reply(401, headers={'WWW-Authenticate': (
+            'Bearer realm="http://127.0.0.1:%d/token",service="registry"' %
+            self.server.server_port)})
+        return False
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        self.server.scopes.append(query.get('scope'))
+        credentials = 'Basic ' + base64.b64encode('user:secret')
+        if url.path != '/token' or \
+                self.headers.get('Authorization') != credentials:
+            return self.reply(403)
+        self.reply(200, json.dumps({'token': 't0ken'}))
+
+    def do_HEAD(self):
+        if not self.authorized():
+            return
+        tag = self.path.rsplit('/', 1)[-1]
+        if tag not in self.server.manifests:
+            return self.reply(404)
+        digest, size = self.server.manifests[tag]
+        self.reply(200, headers={'Docker-Content-Digest': digest,
+                                 'Content-Type': registry.MANIFEST,
+                                 'Content-Length': str(size)})
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.lists[self.path] = (self.headers['Content-Type'],
+                                        json.loads(body))
+        self.reply(201, headers={'Docker-Content-Digest': 'sha256:list'})
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RegistryTests(unittest2.TestCase):
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Registry)
+        self.server.manifests = {'1-linux-amd64': ('sha256:a', 528),
+                                 '1-linux-arm-v7': ('sha256:b', 529)}
+        self.server.lists = {}
+        self.server.scopes = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.name = '127.0.0.1:%d' % self.server.server_port
+        patcher = mock.patch('docker.auth.load_config', return_value={
+            self.name: {'username': 'user', 'password': 'secret'}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        # close the connections kept by the registry, ending their handlers
+        server = registry._registries.pop(self.name, None)
+        if server is not None:
+            server._session.close()
+
+    def test_manifest_list(self):
+        server, path = registry.registry(self.name + '/team/app')
+        self.assertEqual(path, 'team/app')
+        manifests = [(platform, server.manifest(path, tag)) for platform, tag
+                     in (('linux/amd64', '1-linux-amd64'),
+                         ('linux/arm/v7', '1-linux-arm-v7'))]
+        self.assertEqual(manifests[0][1], {'mediaType': registry.MANIFEST,
+                                           'digest': 'sha256:a', 'size': 528})
+        self.assertEqual(server.put_manifest_list(path, '1', manifests),
+                         'sha256:list')
+        content_type, body = self.server.lists['/v2/team/app/manifests/1']
+        self.assertEqual(content_type, registry.MANIFEST_LIST)
+        self.assertEqual(body['manifests'][1], {
+            'mediaType': registry.MANIFEST, 'digest': 'sha256:b',
+            'size': 529,
+            'platform': {'os': 'linux', 'architecture': 'arm',
+                         'variant': 'v7'}})
+        # the token is asked for once per repo
+        self.assertEqual(self.server.scopes,
+                         ['repository:team/app:pull,push'])
+
+    def test_missing_manifest(self):
+        server, path = registry.registry(self.name + '/app')
+        with self.assertRaises(PushFailed):
+            server.manifest(path, '2-linux-amd64')
+
+    def test_docker_hub(self):
+        server, path = registry.registry('busybox')
+        self.assertEqual((server.url, path), (registry.HUB_URL,
+                                              'library/busybox'))
@@ -0,0 +1,54 @@
+import os
+import json
+import shutil
+import tempfile
+
+import unittest2
+
+from dmake import report
+
+
+class RecorderTests(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.recorder = report._Recorder()
+        self.recorder.enabled = True
+
+    def test_disabled(self):
+        self.recorder.enabled = False
+        with self.recorder.phase('app', 'build') as facts:
+            facts['steps'] = 3
+        self.assertEqual(self.recorder.phases(), [])
+
+    def test_phases(self):
+        with self.recorder.phase('app', 'upload') as facts:
+            b''.join(report.counted([b'ab', b'c'], facts))
+        with self.assertRaises(RuntimeError):
+            with self.recorder.phase('app', 'build', steps=0):
+                raise RuntimeError()
+        upload, build = self.recorder.phases()
+        self.assertEqual((upload['phase'], upload['status'], upload['facts']),
+                         ('upload', 'ok', {'bytes': 3}))
+        self.assertEqual((build['phase'], build['status'], build['facts']),
+                         ('build', 'failed', {'steps': 0}))
+
+    def test_write(self):
+        with self.recorder.phase('app', 'push', repo='r') as facts:
+            facts['layers'] = 2
+        filename = os.path.join(self.tmpdir, 'report.jsonl')
+        self.recorder.write_report(filename, {'pushes skipped': 1})
+        with open(filename) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([(l['type'], l.get('phase')) for l in lines],
+                         [('phase', 'push'), ('run', None)])
+        self.assertEqual((lines[0]['repo'], lines[0]['layers']), ('r', 2))
+        self.assertEqual(lines[1]['summary'], {'pushes skipped': 1})
+
+        filename = os.path.join(self.tmpdir, 'trace.json')
+        self.recorder.write_trace(filename)
+        with open(filename) as f:
+            event, = json.load(f)['traceEvents']
+        self.assertEqual((event['name'], event['ph'], event['args']),
+                         ('app: push', 'X',
+                          {'repo': 'r', 'layers': 2, 'status': 'ok'}))
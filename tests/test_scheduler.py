@@ -0,0 +1,125 @@
+import time
+import thread
+import threading
+
+import unittest2
+
+from dmake.scheduler import Scheduler, PushQueue
+
+
+class SchedulerTests(unittest2.TestCase):
+    def setUp(self):
+        # base <- java <- java-app1, base <- php
+        self.order = ['base', 'java', 'php', 'java-app1']
+        self.deps = {
+            'base': set(),
+            'java': set(['base']),
+            'php': set(['base']),
+            'java-app1': set(['java']),
+        }
+
+    def test_serial_follows_order(self):
+        executed = []
+        failures = Scheduler(self.order, self.deps).run(executed.append)
+        self.assertEqual(failures, {})
+        self.assertEqual(executed, self.order)
+
+    def test_dependencies_finish_first(self):
+        lock = threading.Lock()
+        finished = set()
+
+        def func(name):
+            with lock:
+                for dep in self.deps[name]:
+                    self.assertIn(dep, finished)
+            with lock:
+                finished.add(name)
+
+        failures = Scheduler(self.order, self.deps, jobs=4).run(func)
+        self.assertEqual(failures, {})
+        self.assertEqual(finished, set(self.order))
+
+    def test_independent_builds_run_concurrently(self):
+        barrier = threading.Event()
+        started = []
+
+        def func(name):
+            if name in ('java', 'php'):
+                started.append(name)
+                if len(started) == 2:
+                    barrier.set()
+                self.assertTrue(barrier.wait(5))
+
+        failures = Scheduler(self.order, self.deps, jobs=2).run(func)
+        self.assertEqual(failures, {})
+
+    def test_fail_fast(self):
+        executed = []
+
+        def func(name):
+            executed.append(name)
+            if name == 'java':
+                raise RuntimeError('boom')
+
+        failures = Scheduler(self.order, self.deps).run(func)
+        self.assertEqual(list(failures), ['java'])
+        self.assertIsInstance(failures['java'], RuntimeError)
+        self.assertEqual(executed, ['base', 'java'])
+
+    def test_unscheduled_dependencies_are_satisfied(self):
+        executed = []
+        failures = Scheduler(['java-app1'], self.deps).run(executed.append)
+        self.assertEqual(failures, {})
+        self.assertEqual(executed, ['java-app1'])
+
+    def test_interrupted(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        executed = []
+
+        def func(name):
+            executed.append(name)
+            threading.Timer(0.1, thread.interrupt_main).start()
+            release.wait(5)
+
+        start = time.time()
+        with self.assertRaises(KeyboardInterrupt):
+            Scheduler(self.order, self.deps).run(func)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(executed, ['base'])
+
+
+class PushQueueTests(unittest2.TestCase):
+    def test_push_does_not_block_builds(self):
+        release = threading.Event()
+        pushed = []
+
+        def push(name):
+            self.assertTrue(release.wait(5))
+            pushed.append(name)
+
+        queue = PushQueue(push)
+
+        def build(name):
+            queue.submit(name)
+            if name == 'b':
+                # 'a' is still being pushed while 'b' is built
+                self.assertEqual(pushed, [])
+                release.set()
+
+        failures = Scheduler(['a', 'b'], {'a': set(), 'b': set(['a'])}).run(
+            build)
+        self.assertEqual(failures, {})
+        self.assertEqual(queue.join(), [])
+        self.assertEqual(pushed, ['a', 'b'])
+
+    def test_join_reports_every_failure(self):
+        def push(name):
+            if name != 'ok':
+                raise RuntimeError(name)
+
+        queue = PushQueue(push)
+        for name in ('bad1', 'ok', 'bad2'):
+            queue.submit(name)
+        failures = queue.join()
+        self.assertEqual([name for name, _ in failures], ['bad1', 'bad2'])
@@ -1,9 +1,15 @@
+import os
+import zlib
+import shutil
+import hashlib
+import tempfile
 import subprocess
 from datetime import datetime
 
 import unittest2
 from mock import mock
 
+from dmake import config as dmake_config
 from dmake import template_args
 
 
@@ -86,6 +92,21 @@ class ExternalCmdGeneratorTests(unittest2.TestCase):
         self.assertIsNone(args)
         mocked_check_output.assert_called_once_with('echo dummy', shell=True, stderr=-2)
 
+    @mock.patch('subprocess.check_output', return_value='dummy')
+    def test_run_once(self, mocked_check_output):
+        generator = template_args.ExternalCmdGenerator('dummy', 'echo dummy')
+        self.assertEqual(list(generator.gen_args()), [('dummy', 'dummy')])
+        self.assertEqual(list(generator.gen_args()), [('dummy', 'dummy')])
+        mocked_check_output.assert_called_once()
+
+    def test_timeout(self):
+        generator = template_args.ExternalCmdGenerator(
+            'dummy', 'sleep 10; echo dummy', timeout=0.2)
+        self.assertEqual(list(generator.gen_args()), [])
+        generator = template_args.ExternalCmdGenerator(
+            'dummy', 'echo dummy', timeout=5)
+        self.assertEqual(list(generator.gen_args()), [('dummy', 'dummy')])
+
 
 class GitGeneratorsTests(unittest2.TestCase):
     @mock.patch('subprocess.check_output', return_value='56903369fd200ea021dbb75f357f94b7fb5e829e')
@@ -132,6 +153,88 @@ class GitGeneratorsTests(unittest2.TestCase):
         mocked_check_output.assert_called_once_with('git describe --tags', shell=True, stderr=-2)
 
 
+class GitMetadataTests(unittest2.TestCase):
+    COMMIT = '56903369fd200ea021dbb75f357f94b7fb5e829e'
+
+    @mock.patch('subprocess.check_output')
+    def test_single_git_command(self, mocked_check_output):
+        mocked_check_output.return_value = '\n'.join([
+            self.COMMIT, '5690336',
+            'HEAD -> master, tag: 1.1.3, origin/master, tag: 1.1.2',
+            'refactor and add unit tests.\n'])
+        fields = template_args.GitMetadata().fields()
+        self.assertEqual(fields, {
+            'fcommitid': self.COMMIT,
+            'scommitid': '5690336',
+            'git_branch': 'master',
+            'git_tag': '1.1.2',
+            'git_describe': '1.1.2',
+            'commitmsg': '5690336 refactor and add unit tests.',
+        })
+        mocked_check_output.assert_called_once_with(
+            ('git', 'log', '-1', '--format=%H%n%h%n%D%n%s'), cwd=None,
+            stderr=-2)
+
+    @mock.patch('subprocess.check_output')
+    def test_describe_without_tag(self, mocked_check_output):
+        mocked_check_output.side_effect = [
+            '\n'.join([self.COMMIT, '5690336', 'HEAD', 'msg\n']),
+            '1.1.2-5-g5690336\n']
+        metadata = template_args.GitMetadata()
+        fields = metadata.fields()
+        self.assertEqual(fields['git_branch'], 'HEAD')
+        self.assertNotIn('git_tag', fields)
+        self.assertEqual(fields['git_describe'], '1.1.2-5-g5690336')
+        self.assertIs(metadata.fields(), fields)
+        self.assertEqual(mocked_check_output.call_count, 2)
+
+    def write_object(self, git_dir, kind, body):
+        data = '%s %d\0%s' % (kind, len(body), body)
+        sha = hashlib.sha1(data).hexdigest()
+        path = os.path.join(git_dir, 'objects', sha[:2], sha[2:])
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(data))
+        return sha
+
+    def write(self, git_dir, name, content):
+        path = os.path.join(git_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    @mock.patch('subprocess.check_output', side_effect=OSError(2, 'ENOENT'))
+    def test_read_git_dir(self, _):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        git_dir = os.path.join(root, '.git')
+        commit = self.write_object(git_dir, 'commit', 'tree %s\n\nfix it\n'
+                                   % ('0' * 40))
+        tag = self.write_object(git_dir, 'tag', 'object %s\ntype commit\n'
+                                % commit)
+        self.write(git_dir, 'HEAD', 'ref: refs/heads/feature/x\n')
+        self.write(git_dir, 'refs/tags/v2', tag + '\n')
+        self.write(git_dir, 'packed-refs', '\n'.join([
+            '# pack-refs with: peeled fully-peeled sorted',
+            '%s refs/heads/feature/x' % commit,
+            '%s refs/tags/v1' % ('1' * 40),
+            '^%s' % commit,
+            '%s refs/tags/v0' % ('2' * 40)]))
+        subdir = os.path.join(root, 'sub')
+        os.mkdir(subdir)
+
+        fields = template_args.GitMetadata(subdir).fields()
+        self.assertEqual(fields, {
+            'fcommitid': commit,
+            'scommitid': commit[:7],
+            'git_branch': 'feature/x',
+            'git_tag': 'v1',
+            'git_describe': 'v1',
+            'commitmsg': '%s fix it' % commit[:7],
+        })
+
+
 class ArgsExportingFunctionTests(unittest2.TestCase):
     @mock.patch('datetime.datetime')
     def test__template_args(self, mocked_datetime):
@@ -141,6 +244,35 @@ class ArgsExportingFunctionTests(unittest2.TestCase):
         self.assertEqual(ret, {'date': '20160721'})
         mocked_datetime.now.assert_called_once()
 
+    @mock.patch('subprocess.check_output', return_value='dummy')
+    def test__template_args_wanted(self, mocked_check_output):
+        generators = [template_args.DateGenerator(),
+                      template_args.ExternalCmdGenerator('used', 'echo a'),
+                      template_args.ExternalCmdGenerator('unused', 'echo b')]
+        ret = template_args._template_args(generators, set(['used']))
+        self.assertEqual(ret, {'used': 'dummy'})
+        mocked_check_output.assert_called_once_with('echo a', shell=True,
+                                                    stderr=-2)
+
+    def test_wanted_template_args(self):
+        builds = [
+            dmake_config.BuildConfig(
+                'app', '/', 'Dockerfile',
+                pushes=['always=repo/app:{fcommitid}-{version!s}',
+                        'on_tag=repo/app:{date}',
+                        'on_branch:master=repo/app:latest'],
+                labels=['commit={fcommitid}', 'ref={a.b}', 'bad={']),
+            dmake_config.BuildConfig(
+                'base', '/', 'Dockerfile',
+                cache_from=['repo/base:{git_branch}'],
+                cache_to='repo/base:cache-{scommitid}'),
+        ]
+        tag_args, label_args = template_args.wanted_template_args(builds)
+        self.assertEqual(tag_args, set(['fcommitid', 'version', 'date',
+                                        'git_tag', 'git_branch',
+                                        'scommitid']))
+        self.assertEqual(label_args, set(['fcommitid', 'a']))
+
     @mock.patch('dmake.template_args._template_args', return_value={})
     def test_tag_template_args(self, mocked__template_args):
         self.assertIsNone(template_args._tag_template_args)
@@ -148,9 +280,7 @@ class ArgsExportingFunctionTests(unittest2.TestCase):
         self.assertEqual(ret, {})
         self.assertEqual(template_args._tag_template_args, {})
         ta = template_args
-        generator_classes = [ta.GitCommitGenerator, ta.GitCommitMsgGenerator,
-                             ta.GitBranchGenerator, ta.GitTagGenerator,
-                             ta.GitDescribeGenerator, ta.DateGenerator]
+        generator_classes = [ta.GitMetadataGenerator, ta.DateGenerator]
         for obj, cls in zip(mocked__template_args.call_args[0][0],
                             generator_classes):
             self.assertIsInstance(obj, cls)
@@ -162,9 +292,7 @@ class ArgsExportingFunctionTests(unittest2.TestCase):
         self.assertEqual(ret, {})
         self.assertEqual(template_args._label_template_args, {})
         ta = template_args
-        generator_classes = [ta.GitCommitGenerator, ta.GitCommitMsgGenerator,
-                             ta.GitBranchGenerator, ta.GitTagGenerator,
-                             ta.GitDescribeGenerator]
+        generator_classes = [ta.GitMetadataGenerator]
         for obj, cls in zip(mocked__template_args.call_args[0][0],
                             generator_classes):
             self.assertIsInstance(obj, cls)
@@ -214,14 +342,22 @@ class ArgsExportingFunctionTests(unittest2.TestCase):
         self.assertIsInstance(result[0],
                               template_args.DateTimeGenerator)
 
-    @mock.patch('dmake.utils.load_yaml')
     @mock.patch('dmake.template_args.label_template_args')
     @mock.patch('dmake.template_args.tag_template_args')
     def test_init_tag_names(self, patched_tag_template_args,
-                                  patched_label_template_args,
-                                  patched_load_yaml):
-        patched_load_yaml.return_value = {'tag-names': []}
-        template_args.init_tag_names('.docker-make.yml')
-        patched_load_yaml.assert_called_once_with('.docker-make.yml')
-        patched_label_template_args.assert_called_once_with([])
-        patched_tag_template_args.assert_called_once_with([])
+                            patched_label_template_args):
+        config = dmake_config.Config.from_dict({
+            'tag-names': [{'name': 'version', 'type': 'cmd',
+                           'value': 'echo 1', 'timeout': 3}],
+            'builds': {'app': {'context': '/', 'dockerfile': 'Dockerfile',
+                               'pushes': ['always=repo/app:{date}'],
+                               'labels': ['commit={fcommitid}']}},
+        })
+        template_args.init_tag_names(config)
+        generators = patched_label_template_args.call_args[0][0]
+        self.assertEqual(len(generators), 1)
+        self.assertEqual(generators[0].timeout, 3)
+        patched_label_template_args.assert_called_once_with(
+            generators, set(['fcommitid']))
+        patched_tag_template_args.assert_called_once_with(
+            generators, set(['date']))
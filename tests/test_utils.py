@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+import unittest2
+from mock import mock
+
+from dmake import utils
+
+
+class DockerClientsTests(unittest2.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch('docker.api.client.APIClient',
+                             side_effect=self.client)
+        self.api_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ,
+                                  {'DOCKER_HOST': 'tcp://docker:2375'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.daemon_version = '1.30'
+        self.requests = []
+
+    def client(self, **params):
+        client = mock.Mock(params=params)
+        client._version = (self.daemon_version if params['version'] == 'auto'
+                           else params['version'])
+        client.request.side_effect = self.request
+        client._retrieve_server_version.side_effect = (
+            lambda: self.daemon_version)
+        return client
+
+    def request(self, method, url, **kwargs):
+        self.requests.append(url)
+        if url.startswith('/v%s/' % self.daemon_version):
+            return mock.Mock(status_code=200, text='{}')
+        return mock.Mock(status_code=400, text=(
+            'client version 1.30 is too new. Maximum supported API version '
+            'is %s' % self.daemon_version))
+
+    def clients(self, size=4):
+        clients = utils._DockerClients(size)
+        clients.version_cache = os.path.join(self.dir, 'api-versions.json')
+        return clients
+
+    def in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_bound_to_threads(self):
+        clients = self.clients()
+        client = clients.get()
+        self.assertIs(clients.get(), client)
+        self.assertIsNot(self.in_thread(clients.get), client)
+        self.assertIsNot(clients.get('build'), client)
+
+    def test_size(self):
+        clients = self.clients(size=2)
+        got = [self.in_thread(clients.get) for _ in range(5)]
+        self.assertEqual(len(set(got)), 2)
+        self.assertEqual(self.api_client.call_count, 2)
+
+    def test_timeouts(self):
+        clients = self.clients()
+        clients.timeouts['build'] = 7200
+        self.assertEqual(clients.get('build').params['timeout'], 7200)
+        self.assertEqual(clients.get('push').params['timeout'],
+                         utils.DOCKER_TIMEOUTS['push'])
+        self.assertEqual(clients.get().params['timeout'],
+                         utils.DOCKER_TIMEOUTS['api'])
+
+    def test_version_negotiated_once(self):
+        clients = self.clients()
+        self.assertEqual(clients.get().params['version'], 'auto')
+        self.assertEqual(clients.get('build').params['version'], '1.30')
+        # a later run reuses it
+        self.assertEqual(self.clients().get().params['version'], '1.30')
+
+    def test_version_cached_per_host(self):
+        self.clients().get()
+        with mock.patch.dict(os.environ, {'DOCKER_HOST': 'tcp://other:2375'}):
+            self.assertEqual(self.clients().get().params['version'], 'auto')
+        with open(os.path.join(self.dir, 'api-versions.json')) as f:
+            self.assertEqual(sorted(json.load(f)),
+                             ['tcp://docker:2375', 'tcp://other:2375'])
+
+    def test_cached_version_expires(self):
+        self.clients().get()
+        later = time.time() + utils.API_VERSION_TTL + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.clients().get().params['version'], 'auto')
+
+    def test_cached_version_renegotiated(self):
+        self.clients().get()
+        self.daemon_version = '1.25'
+        clients = self.clients()
+        client = clients.get()
+        build = clients.get('build')
+        self.assertEqual(client._version, '1.30')
+        response = client.request('GET', '/v1.30/info')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.requests, ['/v1.30/info', '/v1.25/info'])
+        self.assertEqual(build._version, '1.25')
+        # the new version is cached
+        self.assertEqual(self.clients().get().params['version'], '1.25')
+
+        # streamed bodies can not be sent again, later requests go through
+        self.daemon_version = '1.24'
+        client = self.clients().get('build')
+        response = client.request('POST', '/v1.25/build', data=iter(['x']))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(client._version, '1.24')
+
+    def test_reset(self):
+        clients = self.clients()
+        client = clients.get()
+        clients.reset()
+        client.close.assert_called_once_with()
+        self.assertIsNot(clients.get(), client)
@@ -0,0 +1,70 @@
+import os
+
+import unittest2
+from mock import mock
+
+from dmake import watch
+from dmake.context import IgnoreRules
+from .helpers import WorkDirMixin
+
+
+class PollingWatcherTests(WorkDirMixin, unittest2.TestCase):
+    def setUp(self):
+        self.enter_workdir()
+        for path in ('app/Dockerfile', 'app/src/main.py', 'app/.git/HEAD',
+                     '.docker-make.yml'):
+            self.write(path)
+        self.watcher = watch.PollingWatcher([os.path.abspath('app')],
+                                            ['.docker-make.yml'])
+
+    def test_changes(self):
+        self.assertEqual(self.watcher.changes(0), set())
+        self.write('app/src/main.py')
+        self.write('app/src/new.py')
+        os.remove('app/Dockerfile')
+        self.assertEqual(self.watcher.changes(0), set([
+            'app/src/main.py', 'app/src/new.py', 'app/Dockerfile']))
+        self.assertEqual(self.watcher.changes(0), set())
+
+    def test_files_and_skipped_dirs(self):
+        self.write('.docker-make.yml')
+        self.write('app/.git/HEAD')
+        self.write('other.txt')
+        self.assertEqual(self.watcher.changes(0), set(['.docker-make.yml']))
+
+    def test_excluded_dirs_skipped(self):
+        for path in ('app/node_modules/left-pad/index.js', 'app/docs/keep.md',
+                     'app/docs/old.md', 'app/lib/util.py'):
+            self.write(path)
+        contexts = [
+            ('app', IgnoreRules(['node_modules', 'docs', 'lib',
+                                 '!docs/keep.md'])),
+            ('app/lib', IgnoreRules([])),
+        ]
+        watcher = watch.PollingWatcher([os.path.abspath('app')],
+                                       contexts=contexts)
+        self.assertEqual(
+            sorted(os.path.relpath(path) for path in watcher._stamps),
+            ['app/Dockerfile', 'app/docs/keep.md', 'app/docs/old.md',
+             'app/lib/util.py', 'app/src/main.py'])
+        for path in ('app/node_modules/left-pad/index.js', 'app/docs/keep.md',
+                     'app/lib/util.py'):
+            self.write(path)
+        self.assertEqual(watcher.changes(0), set([
+            'app/docs/keep.md', 'app/lib/util.py']))
+
+
+class WaitTests(unittest2.TestCase):
+    def test_bursts_debounced(self):
+        watcher = mock.Mock()
+        watcher.changes.side_effect = [set(), set(['a']), set(['b', 'a']),
+                                       set(), set(['c'])]
+        self.assertEqual(watch.wait(watcher, debounce=0.1, interval=1),
+                         set(['a', 'b']))
+        self.assertEqual([c[0][0] for c in watcher.changes.call_args_list],
+                         [1, 1, 0.1, 0.1])
+
+    def test_watch_roots(self):
+        self.assertEqual(watch.watch_roots(['/src/app', '/src', '/srcs',
+                                            '/src/app/lib']),
+                         ['/src', '/srcs'])